@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+This file is part of pyBAST, Bayesian Astrometry
+Copyright (C) Joshua S. Bloom. All Rights Reserved. 2012.
+
+See the license file as part of this project on github.
+
+An offline check of WD.prepare (see wd.py): the per-run master catalogue queries
+are answered by a local stand-in server (see sdss_standin.py), from responses
+recorded out of the master catalogue in this folder, and the match files written
+are compared with those written from that catalogue directly.
+
+    python check_prepare.py
+
+Code:
+https://github.com/berianjames/pyBAST
+"""
+
+import os, sys, shutil, tempfile
+import numpy as np
+import pyBA.parse
+import sdss, sdss_standin, wd
+
+here = os.path.dirname(os.path.abspath(__file__))
+master_file = os.path.join(here, "master_sdss342.1914_-0.90194.npz")
+runids = [2662,2728,4198,4207,4858,4917,7195]
+
+def record_responses(a,master,pos,responses):
+    """
+    writes the response of the stand-in to each per-run master catalogue query,
+    from the rows of that run in master
+    """
+    os.makedirs(responses)
+    rect = a.master_rect(pos)
+    names = master.dtype.names
+    fmt = ["%i" if master.dtype[n].kind in "iu" else "%.10f" for n in names]
+    for r in runids:
+        fsql = a._filtercomment(a.master_sql(rect,runid=r))
+        fname = os.path.join(responses, "%s.csv" % sdss.query_key(fsql,"csv"))
+        np.savetxt(fname, master[master.run == r], fmt=fmt, delimiter=",", \
+                   header=",".join(names), comments="")
+
+def compare(fname,ref):
+    "differences between a match file and a reference one"
+    (h, d), (href, dref) = pyBA.parse.read_match(fname), pyBA.parse.read_match(ref)
+    if len(d) != len(dref):
+        return ["%i matches rather than %i" % (len(d), len(dref))]
+    errors = []
+    if not np.all(d["master_objid"] == dref["master_objid"]):
+        errors.append("different master objects")
+    for c in ("master_dra","master_ddec","dra","ddec","raerr","decerr"):
+        if not np.allclose(d[c], dref[c], atol=2e-6):
+            errors.append("column %s differs" % c)
+    for k in ("converted source location (delta ra, delta dec)","observation time (day)"):
+        if not np.allclose(h.get(k, np.nan), href.get(k, np.nan), atol=2e-6, equal_nan=True):
+            errors.append("header %r differs" % k)
+    return errors
+
+def main():
+    master = np.load(master_file)["master"].view(np.recarray)
+    w = wd.WD()
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix="pybast_check_")
+    try:
+        ## reference match files, from the master catalogue directly
+        os.chdir(tmp)
+        os.mkdir("reference") ; os.chdir("reference")
+        a = sdss.sdssq(cachedir=None)
+        a.write_match_files(master,pos=w.pos,runids=runids)
+
+        ## match files from the stand-in, queried one run at a time
+        os.chdir(tmp)
+        record_responses(a,master,w.pos,"responses")
+        server = sdss_standin.serve("responses", failures=2)
+        w.prepare(runids=runids,url=server.url)
+        nrequests = server.nrequests
+
+        ## again, answered from the cache
+        w.prepare(runids=runids,url=server.url)
+        server.shutdown()
+
+        errors = []
+        if server.missed:
+            errors.append("%i queries had no recorded response" % server.missed)
+        if nrequests != len(runids) + 2:
+            errors.append("%i requests for %i runs" % (nrequests, len(runids)))
+        if server.nrequests != nrequests:
+            errors.append("%i requests not answered from the cache" % (server.nrequests - nrequests))
+        for fname, nmatch, t in w.a.generated_match_files:
+            errors += ["%s: %s" % (fname, e) for e in compare(fname, os.path.join("reference", fname))]
+        if len(w.a.generated_match_files) != len(runids):
+            errors.append("%i match files for %i runs" % (len(w.a.generated_match_files), len(runids)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+    print
+    for e in errors:
+        print "FAILED: %s" % e
+    if not errors:
+        print "prepare OK: %i match files from %i queries" % (len(runids), nrequests - 2)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,13 +12,28 @@ Code:
 https://github.com/berianjames/pyBAST
 """
 
-import os, sys, string,urllib2,urllib,copy
-from math import log10, radians, pi, sin, cos, atan2, sqrt
+import os, sys, string,urllib,copy
+import httplib, urlparse, hashlib
+from math import log10, pi
 import time, traceback, datetime
 import threading
 import StringIO
 import numpy as np
-from matplotlib.mlab import csv2rec
+import pyBA.store
+from pyBA.parse import read_match, write_match
+from pyBA.projection import gnomonic
+
+def query_key(fsql,fmt="csv"):
+    """
+    content address of a (comment-filtered) query: the SHA-1 digest of the SQL with
+    whitespace normalised, and the output format
+    """
+    return hashlib.sha1(fmt + "\n" + " ".join(fsql.split())).hexdigest()
+
+def is_error(rez):
+    "is a query response empty or an error message?"
+    tmp = rez.split("\n",1)[0]
+    return len(tmp) == 0 or tmp.find("error_message") != -1 or tmp.find("ERROR") != -1
 
 class sdssq(object):
     """
@@ -31,6 +46,25 @@ class sdssq(object):
     sdss_coadd_platescale = 0.396127      ## arcsec/pix
     def_t0                = 5.21972623E4  # fidual start time (days)
     
+    def __init__(self,url=None,cachedir="sdss_cache",nthreads=4,retries=3,backoff=1.0,timeout=300.0):
+        """
+        url -- query server (default: the Stripe82 CAS; see sdss_standin.py for a local stand-in)
+        cachedir -- directory of responses to queries already run, by content address
+                    of the query (None for no caching)
+        nthreads -- number of queries run at once by queries and recqueries
+        retries -- number of times a failed request is retried, after waiting
+                   backoff*2**i seconds
+        timeout -- of each request, in seconds
+        """
+        if url is not None:
+            self.dr_url = url
+        self.cachedir = cachedir
+        self.nthreads = nthreads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+    
     def _filtercomment(self,sql):
         "Get rid of comments starting with --. Function from Tomas Budavari's code (sqlcl.py)"
         fsql = ''
@@ -38,39 +72,125 @@ class sdssq(object):
             fsql += line.split('--')[0] + ' ' + os.linesep
         return fsql
     
-    def recquery(self,sql,url=dr_url,fmt=def_fmt):
-        """
-        makes a recarray of the query results
-        """
-        rez = self._query(sql,url=url,fmt=fmt)
-        #print rez.readlines()
-        #rez.seek(0)
+    def _rec(self,rez):
+        "makes a recarray of a query response"
         tmp = rez.readline()
         rez.seek(0)
-        if len(tmp) == 0 or tmp.find("error_message") != -1 or tmp.find("ERROR") != -1:
+        if is_error(tmp):
             print "rez:"
             print rez.readlines()
             return np.zeros((1,)).view(np.recarray)
        
         try:
-            return csv2rec(rez)
+            return read_match(rez)[1]
         except:
             print "err"
             print rez.readlines()
-            
-    def _query(self,sql,url=dr_url,fmt=def_fmt,verbose=False):
-        "Run query and return file object"
+    
+    def recquery(self,sql,url=None,fmt=def_fmt):
+        """
+        makes a recarray of the query results
+        """
+        return self._rec(self._query(sql,url=url,fmt=fmt))
+    
+    def recqueries(self,sqls,url=None,fmt=def_fmt):
+        """
+        makes a recarray of the results of each of many queries, run at once
+        """
+        return list(self.irecqueries(sqls,url=url,fmt=fmt))
+    
+    def irecqueries(self,sqls,url=None,fmt=def_fmt):
+        """
+        as recqueries, but yields each recarray in turn, as soon as its query is done
+        """
+        for rez in self.iqueries(sqls,url=url,fmt=fmt):
+            yield self._rec(rez)
+    
+    def queries(self,sqls,url=None,fmt=def_fmt):
+        """
+        runs many queries at once (nthreads at a time), returning a file object for each
+        """
+        return list(self.iqueries(sqls,url=url,fmt=fmt))
+    
+    def iqueries(self,sqls,url=None,fmt=def_fmt):
+        """
+        as queries, but yields each file object in turn (in order), as soon as its
+        query is done, while later queries run on
+        """
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.nthreads)
+        try:
+            for rez in pool.imap(lambda sql: self._query(sql,url=url,fmt=fmt), sqls):
+                yield rez
+        finally:
+            pool.close()
+            pool.join()
+    
+    def _cache_name(self,fsql,fmt):
+        "path of the cached response to a query"
+        if self.cachedir is None:
+            return None
+        return os.path.join(self.cachedir, "%s.%s" % (query_key(fsql,fmt),fmt))
+    
+    def _get(self,url,params):
+        """
+        GET url?params over an HTTP connection kept open for reuse by this thread
+        """
+        u = urlparse.urlsplit(url)
+        conns = self._local.__dict__.setdefault("conns", {})
+        key = (u.scheme, u.netloc)
+        if key not in conns:
+            conn = httplib.HTTPSConnection if u.scheme == "https" else httplib.HTTPConnection
+            conns[key] = conn(u.netloc, timeout=self.timeout)
+        conn = conns[key]
+        try:
+            conn.request("GET", u.path + "?" + params)
+            resp = conn.getresponse()
+            rez = resp.read()
+        except:
+            conn.close()
+            del conns[key]
+            raise
+        if resp.status != 200:
+            raise IOError("HTTP error %i (%s)" % (resp.status, resp.reason))
+        return rez
+    
+    def _query(self,sql,url=None,fmt=def_fmt,verbose=False):
+        "Run query (or find its response in the cache) and return file object"
 
+        url = url or self.dr_url
         fsql = self._filtercomment(sql)
         if verbose:
             print fsql
+        cname = self._cache_name(fsql,fmt)
+        if cname is not None and os.path.exists(cname):
+            f = open(cname,"r") ; rez = f.read() ; f.close()
+            return StringIO.StringIO(rez)
+        
         params = urllib.urlencode({'cmd': fsql, 'format': fmt})
-        try:
-                return StringIO.StringIO(urllib2.urlopen(url+'?%s' % params).read())
-        except:
-                print "TRIED: " + url+'?%s' % params
-                print "EXCEPT: sdss.py._query()"
-                return StringIO.StringIO() # This is an empty filehandler
+        for i in range(self.retries + 1):
+            try:
+                rez = self._get(url,params)
+                break
+            except Exception, e:
+                if i == self.retries:
+                    print "TRIED: " + url+'?%s' % params
+                    print "EXCEPT: sdss.py._query() %s" % e
+                    return StringIO.StringIO() # This is an empty filehandler
+                time.sleep(self.backoff*2**i)
+        
+        ## keep good responses; write under a temporary name, so that concurrent
+        ##   queries never see a partial file
+        if cname is not None and not is_error(rez):
+            if not os.path.exists(self.cachedir):
+                try:
+                    os.makedirs(self.cachedir)
+                except OSError:
+                    pass
+            tmp = "%s.%s.tmp" % (cname, threading.current_thread().ident)
+            f = open(tmp,"w") ; f.write(rez) ; f.close()
+            os.rename(tmp,cname)
+        return StringIO.StringIO(rez)
     
     def _old_get_master_cat(self,pos=(342.19156468,-0.90203402),errdeg=0.05,rcut=22.5):
         ## I'm not using the full HTM here
@@ -90,19 +210,31 @@ class sdssq(object):
 
     def dist(self,lon0, lat0, lon, lat):
         """
-        Calculates the distance between two points (decimal)
+        Calculates the distance between two points (decimal), or between a point
+        and arrays of points
         """
-        d_lat = radians(lat0 - lat)
-        d_lon = radians(lon0 - lon)
-        x = sin(d_lat/2.) ** 2 + \
-          cos(radians(lat0)) * cos(radians(lat)) *\
-          sin(d_lon/2.) ** 2
-        y = 2.0 * atan2(sqrt(x), sqrt(1.0 - x))
+        d_lat = np.radians(lat0 - lat)
+        d_lon = np.radians(lon0 - lon)
+        x = np.sin(d_lat/2.) ** 2 + \
+          np.cos(np.radians(lat0)) * np.cos(np.radians(lat)) *\
+          np.sin(d_lon/2.) ** 2
+        y = 2.0 * np.arctan2(np.sqrt(x), np.sqrt(1.0 - x))
         distance = y*180.0/pi
         return distance
 
+    def match_file_name(self,pos,runid):
+        "name of the match file of a run written by write_match_files"
+        return "match_astrom_%.4f_%.5f_run%i.dat" % (pos[0],pos[1],runid)
+
     def write_match_files(self,master,pos=(342.1913750,-0.9019444), scale=sdss_coadd_platescale,\
-        runids=[4198],t0=def_t0):
+        runids=[4198],t0=def_t0,binary=False):
+        """
+        writes one match file per run, of the matches in that run to master objects
+        (excluding the source of interest), in arcsec on the tangent plane about pos
+        
+        binary -- write the match files as .npz archives rather than text (both are
+                  read by pyBA.parse.read_match)
+        """
         
         self.generated_match_files = []
         
@@ -113,20 +245,20 @@ class sdssq(object):
                 print "I dont understnd runids = %s" % repr(runids)
                 return
         
-        ## figure out the special ID of the source we're interested in
+        ## figure out the special ID of the source we're interested in: the first
+        ##   match within 1.5 arcsec, or failing that the nearest
         mind = 100.0
         bestid = -1
         gotit = False
         mpos = tuple()
-        for x in master:
-            d = self.dist(pos[0],pos[1],x["ra"],x["dec"])
-            if d < mind:
-                mind = d
-                bestid = x["master_objid"]
-                mpos = (x["master_ra"],x["master_dec"])
-            if mind < 1.5/(3600.0):
-                gotit= True
-                break
+        if len(master) > 0:
+            d = self.dist(pos[0],pos[1],master["ra"],master["dec"])
+            close = np.nonzero(d < 1.5/(3600.0))[0]
+            gotit = len(close) > 0
+            i = close[0] if gotit else np.argmin(d)
+            mind = d[i]
+            bestid = master["master_objid"][i]
+            mpos = (master["master_ra"][i],master["master_dec"][i])
         
         if gotit:
             print "source of interest: mind=%.3f arcsec sourceid=%i" % (mind*3600, bestid)
@@ -134,73 +266,86 @@ class sdssq(object):
         else:
             print "couldn't find the source after %i sources searched" % len(master)
         
-        ## make conversion table for RA,DEC
-        convra = lambda ra: (ra - pos[0])*np.cos(pos[1])*3600.0
-        convdec = lambda dec: (dec - pos[1])*3600.0
-            
+        ## columns of every match file, converted in one pass to the tangent plane
+        ##   about pos (gnomonic projection, in arcsec), with their uncertainties
+        err = np.zeros((len(master),2,2))
+        err[:,0,0] = master["master_raerr"] ; err[:,1,1] = master["master_decerr"]
+        mdra, mddec, merr = gnomonic(master["master_ra"], master["master_dec"], pos, sigma=err)
+        err[:,0,0] = master["raerr"] ; err[:,1,1] = master["decerr"]
+        dra, ddec, err = gnomonic(master["ra"], master["dec"], pos, sigma=err)
+        cols = np.rec.fromarrays([master["master_objid"], master["objid"], \
+                    master["master_ra"], master["master_dec"], mdra, mddec, \
+                    merr[:,0,0], merr[:,1,1], merr[:,0,1], \
+                    master["ra"], master["dec"], dra, ddec, \
+                    err[:,0,0], err[:,1,1], err[:,0,1], master["master_rmag"], master["rmag"]], \
+                    names="master_objid,objid,master_ra,master_dec,master_dra,master_ddec," \
+                          "master_raerr,master_decerr,master_radeccov,ra,dec,dra,ddec," \
+                          "raerr,decerr,radeccov,master_rmag,rmag")
+        
+        ## group the rows by run (keeping their order within each run)
+        order = np.argsort(master.run, kind="mergesort")
+        runs, first, counts = np.unique(master.run[order], return_index=True, return_counts=True)
+        
         for r in runids:
-            ## get only the matches for this run
-            tmp = master[np.where(master.run == r)]
-            fname = "match_astrom_%.4f_%.5f_run%i.dat" % (pos[0],pos[1],r)
-            f = open(fname,"w")
-            f.write("# filename: %s \n" % fname)
-            f.write("# nominal center (used for x,y conversion): %f, %f\n" % (pos[0],pos[1]))
+            j = np.searchsorted(runs, r)
+            if j == len(runs) or runs[j] != r:
+                print "no matches for run %i" % r
+                continue
+            rows = order[first[j]:first[j] + counts[j]]
+            tmp = cols[rows]
+            t = master["time"][rows[0]]
+            
+            fname = self.match_file_name(pos,r)
+            header = [("filename", fname), ("nominal center (used for x,y conversion)", tuple(pos))]
             if gotit:
-                f.write("# source of interest\n")
-                f.write("#   master_objid: %i\n#    master_pos: %f, %f\n" % \
-                        (bestid,mpos[0],mpos[1]))
-                ttt = np.where(tmp["master_objid"] == bestid)
-                f.write("#   fiducal master location (delta ra, delta dec): %f, %f\n" % \
-                        (convra(mpos[0]),convdec(mpos[1])))
-                if len(ttt[0]) > 0:
-                    f.write("# converted source location (delta ra, delta dec): %f, %f\n" % \
-                            (convra(tmp[ttt]["ra"]),convdec(tmp[ttt]["dec"])))
-                    f.write("# source location (ra, dec): %f, %f\n" % \
-                                    (tmp[ttt]["ra"],tmp[ttt]["dec"]))
-                    f.write("# source error (raerr, decerr): %f, %f\n" % \
-                                (tmp[ttt]["raerr"],tmp[ttt]["decerr"]))                
+                header += [("source of interest", None), ("master_objid", bestid), \
+                           ("master_pos", mpos), \
+                           ("fiducal master location (delta ra, delta dec)", \
+                            tuple(np.ravel(gnomonic(mpos[0], mpos[1], pos))))]
+                ttt = np.nonzero(tmp["master_objid"] == bestid)[0]
+                if len(ttt) > 0:
+                    x = tmp[ttt[0]]
+                    header += [("converted source location (delta ra, delta dec)", (x["dra"],x["ddec"])), \
+                               ("source location (ra, dec)", (x["ra"],x["dec"])), \
+                               ("source error (raerr, decerr)", (x["raerr"],x["decerr"]))]
             else:
-                f.write("# could not find master source of interest\n")
-                
-            f.write("# observation time (day): %f\n# t0 (day): %f\n" % (tmp["time"][0],t0))
-            f.write("master_objid,objid,master_ra,master_dec,master_dra,master_ddec")
-            f.write(",master_raerr,master_decerr,master_radeccov,ra,dec,dra,ddec,raerr,decerr,radeccov")
-            f.write(",master_rmag,rmag\n")
-            for x in tmp[np.where(tmp["master_objid"] != bestid)]:
-                f.write("%i,%i" % (x["master_objid"],x["objid"]))
-                f.write(",%f,%f,%f,%f" % (x["master_ra"],x["master_dec"],\
-                         convra(x["master_ra"]),convdec(x["master_dec"])))
-                f.write(",%f,%f,0.0" % (x["master_raerr"],x["master_decerr"]))
-                f.write(",%f,%f,%f,%f" % (x["ra"],x["dec"],\
-                         convra(x["ra"]),convdec(x["dec"])))
-                f.write(",%f,%f,0.0" % (x["raerr"],x["decerr"]))
-                f.write(",%f,%f\n" % (x["master_rmag"],x["rmag"]))
-                
-            f.close()
-            print "wrote %i matches in file %s" % (len(tmp[np.where(tmp["master_objid"] != bestid)]),fname)
-            self.generated_match_files.append((fname,len(tmp[np.where(tmp["master_objid"] != bestid)]),tmp["time"][0]))
+                header += [("could not find master source of interest", None)]
+            header += [("observation time (day)", t), ("t0 (day)", t0)]
+            
+            tmp = tmp[tmp["master_objid"] != bestid]
+            write_match(fname, header, tmp, binary=binary)
+            print "wrote %i matches in file %s" % (len(tmp),fname)
+            self.generated_match_files.append((fname,len(tmp),t))
             
         ## sort the generated file list by time
         self.generated_match_files.sort(key=lambda x: x[2])
         
-    def get_master_cat(self,pos=(342.1913750, -0.9019444),errdeg=0.07,rcut=22.5,t0=def_t0,\
-        MASTER_PRE = "master_sdss",savefile=True):
+    def master_catstore(self,root="sdss_master",t0=def_t0):
         """
-        issue the monsterous nested query to get master catalog positions in Stripe82 over time
+        opens (or creates) a local store of master catalogue rows, placed by master
+        object position, for get_master_cat to reuse across neighbouring fields
         """
-        master_name = MASTER_PRE + "%.4f_%.5f.npz" % pos
-
-        if os.path.exists(master_name):
-            npzfile = np.load(master_name)
-            return npzfile["master"].view(np.recarray)
+        return pyBA.store.Catstore(root, ra="master_ra", dec="master_dec", \
+                                   key=["master_objid","objid"], meta={"t0": t0})
         
+    def master_rect(self,pos=(342.1913750, -0.9019444),errdeg=0.07):
+        "(ramin, ramax, decmin, decmax) of the master catalogue field about pos"
         ramin = pos[0] - 0.5*errdeg/np.cos(pos[1]) ; ramax = pos[0] + 0.5*errdeg/np.cos(pos[1]) 
         decmin = pos[1] - 0.5*errdeg ; decmax = pos[1] + 0.5*errdeg
+        return (ramin,ramax,decmin,decmax)
+        
+    def master_sql(self,rect,rcut=22.5,t0=def_t0,runid=None):
+        """
+        the monsterous nested query of master catalog positions in Stripe82 over time,
+        in the field rect (see master_rect), for every run or just runid
+        """
+        ramin,ramax,decmin,decmax = rect
         rc = "and p.r < %f" % rcut if rcut not in [None] else ""
+        rr = "where p.run = %i" % runid if runid is not None else ""
         
         ### Runs 106 and 206 are the deep coadds from Stripe82. Get the master catalog 
         ###    about the input position
-        q = """SELECT cc.rr0objid as master_objid,cc.rr0ra as master_ra,cc.qdec as master_dec,
+        return """SELECT cc.rr0objid as master_objid,cc.rr0ra as master_ra,cc.qdec as master_dec,
                cc.master_decerr,cc.master_raerr,cc.r as master_rmag, cc.darcsec,p.objid,p.r as rmag,
                cc.ra,cc.dec,p.rowcErr * %f as raerr,p.colcErr * %f as decerr,F.mjd_r - %f as time,p.run,p.rerun,p.camcol,p.field
                from (SELECT p.r, rr0.colcErr * %f as master_decerr, rr0.rowcErr * %f as master_raerr, dbo.fdistancearcmineq(rr0.ra,rr0.dec,q.ra,q.dec)*60 as darcsec,q.ra,q.dec,
@@ -219,14 +364,93 @@ class sdssq(object):
                 and dbo.fdistancearcmineq(rr0.ra,rr0.dec,q.ra,q.dec)*60 < 2 )  as cc
                 join PhotoObjAll p on cc.objid=p.objID
                 join Field F on F.fieldID = p.fieldID
+                %s
                  -- order by
                  -- time
                 
-        """ % (sdss_coadd_platescale, sdss_coadd_platescale, t0, \
-               sdss_coadd_platescale, sdss_coadd_platescale, ramin,ramax,decmin,decmax, rc)
+        """ % (self.sdss_coadd_platescale, self.sdss_coadd_platescale, t0, \
+               self.sdss_coadd_platescale, self.sdss_coadd_platescale, \
+               ramin,ramax,decmin,decmax, rc, rr)
+        
+    def _check_catstore(self,catstore,t0):
+        "checks that a catalogue store has times relative to t0"
+        if catstore is not None and catstore.meta.get("t0") != t0:
+            raise ValueError("catalogue store has times relative to t0=%s" % catstore.meta.get("t0"))
+        
+    def run_cats(self,pos=(342.1913750, -0.9019444),runids=[4198],errdeg=0.07,rcut=22.5,\
+        t0=def_t0,catstore=None):
+        """
+        yields (runid, master catalog rows of that run) for each run in turn, running
+        the per-run queries nthreads at a time (see iqueries), so that each run can be
+        used as soon as its rows arrive; runs whose query fails give None
+        
+        catstore -- local store of master catalogue rows (see master_catstore); runs
+                    of fields already covered by it are selected locally, and the
+                    results of queries are added to it
+        """
+        self._check_catstore(catstore,t0)
+        rect = self.master_rect(pos,errdeg)
+        tag = "rcut=%r" % (rcut,)
+        run_tag = lambda r: "%s run=%i" % (tag, r)
+        
+        local = set()
+        if catstore is not None:
+            local = set(r for r in runids if catstore.covers(rect, tag=tag) or \
+                        catstore.covers(rect, tag=run_tag(r)))
+        todo = [r for r in runids if r not in local]
+        rezs = self.irecqueries([self.master_sql(rect,rcut,t0,runid=r) for r in todo])
+        
+        for r in runids:
+            if r in local:
+                rez = catstore.rect(*rect)
+                rez = rez[rez.run == r]
+                yield r, rez if rcut is None else rez[rez.master_rmag < rcut]
+                continue
+            rez = next(rezs)
+            if rez is None or "master_ra" not in (rez.dtype.names or ()):
+                yield r, None
+                continue
+            if catstore is not None:
+                catstore.add(rez, rect, tag=run_tag(r))
+            yield r, rez
+        
+    def get_master_cat(self,pos=(342.1913750, -0.9019444),errdeg=0.07,rcut=22.5,t0=def_t0,\
+        MASTER_PRE = "master_sdss",savefile=True,catstore=None,runids=None):
+        """
+        issue the monsterous nested query to get master catalog positions in Stripe82 over time
+        
+        catstore -- local store of master catalogue rows (see master_catstore); fields
+                    already covered by it are selected locally rather than queried,
+                    and the results of queries are added to it
+        runids -- if given, get only these runs, by one query per run, run at once
+                  (see run_cats); otherwise every run, by a single query
+        """
+        master_name = MASTER_PRE + "%.4f_%.5f.npz" % pos
+        if runids == "all":
+            runids = None
+        
+        if os.path.exists(master_name) and catstore is None:
+            npzfile = np.load(master_name)
+            rez = npzfile["master"].view(np.recarray)
+            return rez if runids is None else rez[np.in1d(rez.run, runids)]
+        
+        if runids is not None:
+            rezs = [rez for r, rez in self.run_cats(pos,runids,errdeg,rcut,t0,catstore) \
+                    if rez is not None]
+            if not rezs:
+                return np.zeros((0,)).view(np.recarray)
+            return np.concatenate(rezs).view(np.recarray)
+        
+        rect = self.master_rect(pos,errdeg)
+        tag = "rcut=%r" % (rcut,)
+        self._check_catstore(catstore,t0)
+        if catstore is not None and catstore.covers(rect, tag=tag):
+            rez = catstore.rect(*rect)
+            return rez if rcut is None else rez[rez.master_rmag < rcut]
         
-        #print q
-        rez = self.recquery(q)
+        rez = self.recquery(self.master_sql(rect,rcut,t0))
+        if catstore is not None and rez is not None and "master_ra" in (rez.dtype.names or ()):
+            catstore.add(rez, rect, tag=tag)
         if savefile and not os.path.exists(master_name):
             np.savez(master_name,master=rez)
         return rez
@@ -4,13 +4,13 @@
 #  corresponding notebook (sdss_demo.ipynb).
 
 import pyBA
-import sdss
+import pyBA.parse
 import numpy as np
 
 np.set_printoptions(linewidth=125,suppress=True,precision=3)
 
 # Load data
-data = sdss.csv2rec("match_astrom_342.1914_-0.90194_run4198.dat")
+header, data = pyBA.parse.read_match("match_astrom_342.1914_-0.90194_run4198.dat")
 nties = len(data)
 print nties
 
@@ -18,8 +18,7 @@ print nties
 # the A objects will be the fiducial positions from the deep coadd
 # the B objects will be source positions in this epoch
 # both are given in arcseconds relative to a fiducial center
-objectsA = np.array( [ pyBA.Bivarg(mu=[x["master_dra"],x["master_ddec"]],sigma=np.array([x["master_raerr"],x["master_decerr"]])) for x in data ] )
-objectsB = np.array( [ pyBA.Bivarg(mu=[x["dra"],x["ddec"]], sigma=np.array([x["raerr"],x["decerr"]])) for x in data ] )
+objectsA, objectsB = pyBA.parse.objects_from_ties(pyBA.parse.ties_from_match(data))
 
 # Suggest starting point for background mapping
 S = pyBA.background.suggest_mapping(objectsA,objectsB)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+This file is part of pyBAST, Bayesian Astrometry
+Copyright (C) Joshua S. Bloom. All Rights Reserved. 2012.
+
+See the license file as part of this project on github.
+
+A local stand-in for the SDSS query server, serving recorded responses so that
+the query and prepare steps (see sdss.py and wd.py) can be tested and benchmarked
+offline.
+
+Recorded responses are a cache directory of sdss.sdssq: run the queries once
+against the real server (e.g. WD().prepare()), then serve its cache directory
+
+    python sdss_standin.py sdss_cache --port 8082
+
+and point the query object at the stand-in, with a fresh cache
+
+    a = sdss.sdssq(url="http://127.0.0.1:8082/x_sql.asp", cachedir=None)
+
+Queries without a recorded response get an error message, as the real server
+gives for bad SQL.
+
+Code:
+https://github.com/berianjames/pyBAST
+"""
+
+import os, time, threading
+import urlparse
+import BaseHTTPServer, SocketServer
+import sdss
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    answers GET requests of the SDSS query form (cmd=<sql>&format=<fmt>)
+    """
+    protocol_version = "HTTP/1.1"   ## keep connections open for reuse
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.nrequests += 1
+            fail = srv.nrequests <= srv.failures
+        if srv.delay:
+            time.sleep(srv.delay)
+
+        if fail:
+            self._reply(503, "service unavailable\n")
+            return
+
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        fsql = query.get("cmd", [""])[0]
+        fmt = query.get("format", [sdss.sdssq.def_fmt])[0]
+        fname = os.path.join(srv.responses, "%s.%s" % (sdss.query_key(fsql,fmt),fmt))
+        if os.path.exists(fname):
+            f = open(fname,"r") ; rez = f.read() ; f.close()
+        else:
+            with srv.lock:
+                srv.missed += 1
+            rez = "ERROR: no recorded response to this query\n"
+        self._reply(200, rez)
+
+    def _reply(self,code,body):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,*args)
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    threaded HTTP server of recorded query responses
+
+    responses -- directory of recorded responses (an sdssq cache directory)
+    failures -- number of initial requests answered with HTTP 503, to exercise retries
+    delay -- seconds to wait before answering each request, to mimic the real server
+    """
+    daemon_threads = True
+
+    def __init__(self,responses,port=0,failures=0,delay=0.0,verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), StandinHandler)
+        self.responses = responses
+        self.failures = failures
+        self.delay = delay
+        self.verbose = verbose
+        self.nrequests = 0
+        self.missed = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        "query URL of the stand-in"
+        return "http://%s:%i/x_sql.asp" % self.server_address
+
+def serve(responses,port=0,**kwargs):
+    """
+    starts a stand-in server in a background thread, returning the server (call its
+    shutdown method to stop it)
+    """
+    server = StandinServer(responses,port=port,**kwargs)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the SDSS query server.")
+    parser.add_argument("responses", help="directory of recorded responses (an sdssq cache)")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--failures", type=int, default=0, help="initial requests to fail")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds per request")
+    args = parser.parse_args()
+
+    server = StandinServer(args.responses, port=args.port, failures=args.failures, \
+                           delay=args.delay, verbose=True)
+    print "serving %s at %s" % (args.responses, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
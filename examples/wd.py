@@ -15,15 +15,56 @@ https://github.com/berianjames/pyBAST
 """
 
 import sys
-import os, copy
+import os, re, copy, time
+import collections
 import pyBA
+import pyBA.store
+import pyBA.motion
+import pyBA.parse
 import sdss
 import numpy as np
-import cPickle as pickle
 from pyBA.plotting import draw_objects
 from pylab import plot, cla, xlim, ylim
 from pylab import show
 
+def run_id(fname):
+    """
+    run ID of a match file written by sdssq.write_match_files
+    """
+    return int(re.search(r"run(\d+)", os.path.basename(fname)).group(1))
+
+def nearest_seed(fitted, t):
+    """
+    (background mapping, GP scale, GP amplitude) of the fitted epoch nearest in time
+    to t, from a list of (time, background mapping, GP scale, GP amplitude)
+    """
+    if not fitted:
+        return None
+    return min(fitted, key=lambda f: abs(float(f[0]) - float(t)))[1:]
+
+def source_obs(epoch_info):
+    """
+    position and covariance of the source measured in an epoch, from the header of
+    its match file, or None if it was not found
+    """
+    pos = epoch_info.get("converted source location (delta ra, delta dec)")
+    if not pos:
+        return None
+    return np.array(pos), np.diag(epoch_info["source error (raerr, decerr)"])
+
+def _fit_run(task):
+    """
+    fits the map of one epoch in a worker process of WD.run_pipeline
+    
+    returns the conditioned map, the fit statistics and the time spent
+    """
+    fname, seed, verbose = task
+    start = time.time()
+    data = pyBA.parse.read_match(fname)[1]
+    objectsA, objectsB = pyBA.parse.objects_from_ties(pyBA.parse.ties_from_match(data))
+    D, stats = WD().fit_warm(objectsA, objectsB, seed=seed, verbose=verbose)
+    return D, stats, time.time() - start
+
 class WD(object):
     """
     A worked example measuring the proper motion of a white dwarf on the sky.
@@ -34,143 +75,393 @@ class WD(object):
         " 224845.93−005407.0 pm = 204±5 mas/yr"
         self.pos = pos
         
-    def run(self,test=True):
+    def run(self,test=True,nproc=None):
         """
         main run method. set test=False if you want to run all the available epochs
+        
+        nproc -- if given, run the stages as a pipeline over nproc fitting processes
+                 (see run_pipeline)
+        """
+        runids = "all" if not test else [2662,2728,4198,4207,4858,4917,7195]
+        if nproc is not None:
+            self.run_pipeline(runids=runids,nproc=nproc)
+        else:
+            self.prepare(runids=runids)
+            self.fit_all()
+            self.locate_source()
+        self.gen_results()
+        
+    def run_pipeline(self,runids=[2662,2728,4198,4207,4858,4917,7195],nproc=2,maxqueue=None, \
+                     storedir="pyBAST_maps",clobber=False,minmatch=20,warm_start=True, \
+                     binary=False,verbose=False,url=None):
         """
-        self.prepare(runids="all" if not test else [2662,2728,4198,4207,4858,4917,7195])
-        self.fit_all()
-        self.locate_source()
+        runs prepare, fit_all and locate_source as a pipeline: the master catalogue
+        is queried one run at a time (several queries at once), each run's match file
+        is written and queued for fitting in a pool of nproc processes as soon as its
+        rows arrive, and each map is stored, and the source located in it, as soon as
+        its fit finishes
+        
+        maxqueue -- most epochs queued for fitting at once (default 2*nproc); ingest
+                    waits for fits to finish beyond this
+        clobber -- redo every stage; otherwise the stages whose output already exists
+                   are skipped (match files already written, maps already in the
+                   store, and source positions already located), so that an
+                   interrupted run resumes where it stopped
+        
+        the time spent in each stage is kept in self.timing (for fitting, summed
+        over the worker processes; "wait" is the time spent waiting for fits)
+        """
+        from multiprocessing import Pool
+        
+        start = time.time()
+        self.timing = dict((k, 0.0) for k in ("query","write","read","fit","wait","locate"))
+        self.fit_stats = {"cold": [], "warm": [], "diverged": []}
+        self.store = pyBA.store.Mapstore(storedir)
+        self.rez = {}
+        self.a = sdss.sdssq(url=url)
         
-    def prepare(self,runids=[2662,2728,4198,4207,4858,4917,7195]):
+        ## ingest: master catalogue rows for the runs without match files, run by
+        ##   run as their queries finish (all runs at once if the runs are not known)
+        clock = time.time()
+        if runids == "all":
+            self.master = self.a.get_master_cat(pos=self.pos)
+            runids = sorted(set(self.master.run))
+            missing = [r for r in runids if clobber or not os.path.exists(self.a.match_file_name(self.pos,r))]
+            ingest = iter([(r, self.master) for r in missing])
+        else:
+            missing = [r for r in runids if clobber or not os.path.exists(self.a.match_file_name(self.pos,r))]
+            ingest = self.a.run_cats(pos=self.pos,runids=missing)
+        missing = set(missing)
+        self.timing["query"] += time.time() - clock
+        
+        fitted = [(e["time"],) + tuple(self._seed(e["runid"])) for e in self.store.epochs] \
+                 if warm_start else []
+        
+        def locate(runid, t, fname, header, D):
+            ## store a fitted map, and map the source position through it
+            clock = time.time()
+            if D is not None:
+                self.store.add(runid, t, D, match_file=fname)
+                fitted.append((t, D.P.mu, D.scale, D.amp))
+            info = self.store.info(runid)
+            obs = source_obs(header)
+            if obs is not None and (clobber or "source_pos" not in info):
+                mu, sigma = self.store[runid].query(obs[0][None], obs[1][None]) if D is None \
+                            else D.query(obs[0][None], obs[1][None])
+                self.store.update(runid, source_pos=list(mu[0]), source_cov=sigma[0].tolist())
+                info = self.store.info(runid)
+            self.rez[header["filename"]] = copy.copy(header)
+            if obs is not None:
+                self.rez[header["filename"]]["pos"] = \
+                    (np.array([pyBA.Bivarg(mu=info["source_pos"], sigma=np.array(info["source_cov"]))]),)
+                if verbose:
+                    print "located source in run %s at %s" % (runid, info["source_pos"])
+            self.timing["locate"] += time.time() - clock
+        
+        def finish(job):
+            ## wait for the oldest fit, then store and locate it
+            runid, t, fname, header, result = job
+            clock = time.time()
+            D, stats, elapsed = result.get()
+            self.timing["wait"] += time.time() - clock
+            self.timing["fit"] += elapsed
+            for k, nfev in stats.items():
+                self.fit_stats[k].append(nfev)
+            print "fitted run %s (%.1f s)" % (runid, elapsed)
+            sys.stdout.flush()
+            locate(runid, t, fname, header, D)
+        
+        maxqueue = maxqueue or 2*nproc
+        pool = Pool(nproc)
+        queue = collections.deque()
+        try:
+            for r in runids:
+                fname = self.a.match_file_name(self.pos,r)
+                if r in missing:
+                    ## wait for this run's rows, and write its match file
+                    clock = time.time()
+                    _, master = next(ingest)
+                    self.timing["query"] += time.time() - clock
+                    clock = time.time()
+                    if master is None:
+                        print "no master catalogue rows for run %i" % r
+                        continue
+                    self.a.write_match_files(master,pos=self.pos,runids=[r],binary=binary)
+                    self.timing["write"] += time.time() - clock
+                    if not os.path.exists(fname):
+                        continue
+
+                clock = time.time()
+                header, data = pyBA.parse.read_match(fname)
+                t = header["observation time (day)"]
+                self.timing["read"] += time.time() - clock
+                
+                if len(data) < minmatch:
+                    print "skipping %s ... too few matches [%i]" % (fname,len(data))
+                    continue
+                if not clobber and r in self.store:
+                    locate(r, t, fname, header, None)
+                    continue
+                
+                ## backpressure: wait for the oldest fit while the queue is full, and
+                ##   hand on any fits already finished
+                while len(queue) >= maxqueue or (queue and queue[0][-1].ready()):
+                    finish(queue.popleft())
+                seed = nearest_seed(fitted, t) if warm_start else None
+                queue.append((r, t, fname, header, pool.apply_async(_fit_run, ((fname, seed, verbose),))))
+            
+            while queue:
+                finish(queue.popleft())
+        finally:
+            pool.close()
+            pool.join()
+        
+        self.timing["total"] = time.time() - start
+        if self.fit_stats["cold"] or self.fit_stats["warm"]:
+            self.report_fit_stats()
+        self.report_timing()
+    
+    def _seed(self,runid):
+        "(background mapping, GP scale, GP amplitude) of a stored map"
+        D = self.store[runid]
+        return D.P.mu, D.scale, D.amp
+    
+    def report_timing(self):
+        """
+        reports the time spent in each stage of the pipeline (see run_pipeline)
+        """
+        for k in ("query","write","read","fit","wait","locate"):
+            print "%-8s %8.2f s" % (k, self.timing[k])
+        print "%-8s %8.2f s" % ("total", self.timing["total"])
+    
+    def prepare(self,runids=[2662,2728,4198,4207,4858,4917,7195],binary=False,catstore=None,url=None):
         """
         get's the master catalog around the position and generates match files
+        
+        binary -- write the match files in binary form (faster to write and read)
+        catstore -- directory of a local master catalogue store, reused across
+                    neighbouring fields (see sdssq.master_catstore)
+        url -- query server (default: the Stripe82 CAS; see sdss_standin.py)
         """
-        self.a = sdss.sdssq()
-        ## this will make a query to the Stripe82 catalog
-        self.master = self.a.get_master_cat(pos=self.pos) ## this can take awhile
+        self.a = sdss.sdssq(url=url)
+        ## this will make queries to the Stripe82 catalog (one per run, several at
+        ##   once), unless the field is already in the local catalogue store
+        if catstore is not None:
+            catstore = self.a.master_catstore(catstore)
+        self.master = self.a.get_master_cat(pos=self.pos,catstore=catstore,runids=runids) ## this can take awhile
 
         ## this will generate the match files from the master catalog
-        self.a.write_match_files(self.master,runids=runids)
+        self.a.write_match_files(self.master,runids=runids,binary=binary)
 
         ## self.a.generated_match_files contains the paths now to the match files
         ##   along with the number of matches and the time of the observations
     
     def fit_all(self,save_output=True,clobber=False,minmatch=20,mymatches=[], \
-                sigma_reject=5.0,verbose=True):
+                sigma_reject=5.0,verbose=True,warm_start=True,shared_geometry=True, \
+                storedir="pyBAST_maps"):
         """
         runs through all the match files and fits the astrometry
         
-        clobber -- overwrite output file if it exists
-        save_output -- save the output file
+        clobber -- overwrite a run's map if it is already in the store
+        save_output -- save the maps to the store
+        storedir -- directory of the map store holding the fitted maps
         minmatch  -- minimum number of required matches to perform the mapping
         mymatches -- list of files to match (instead of what gets populated in prepare)
         sigma_reject -- rejection of outliers [not used for now!]
+        warm_start -- seed each epoch's fit from the nearest epoch (in time)
+                      already fitted, falling back to a cold start if it diverges
+        shared_geometry -- compute distances between master objects once for all epochs
         """
         if mymatches != []:
             matches = mymatches
         else:
             matches = self.a.generated_match_files
         
-        self.pybast_files = []
+        self.store = pyBA.store.Mapstore(storedir)
+        
+        ## fitted epochs as (time, background mapping, GP scale, GP amplitude),
+        ##   and evaluation counts for cold and warm fits
+        fitted = []
+        self.fit_stats = {"cold": [], "warm": [], "diverged": []}
         
+        ## read the match files that need fitting
+        todo = []
         for fname,nmatch,t in matches:
             
             if nmatch < minmatch:
                 print "skipping %s ... too few matches [%i]" % (fname,nmatch)
                 continue
             
+            runid = run_id(fname)
+            
+            if not clobber and runid in self.store:
+                print "skipping %s ... (map exists)" % (fname,)
+                continue
+            
+            todo.append((fname,t,runid,pyBA.parse.read_match(fname)[1]))
+        
+        ## every epoch ties to master catalogue objects, so share the distances
+        ##   between them across epochs
+        fiducials = None
+        if shared_geometry and todo:
+            ids, ix = np.unique(np.concatenate([data["master_objid"] for _,_,_,data in todo]), \
+                                return_index=True)
+            xy = np.concatenate([np.column_stack([data["master_dra"],data["master_ddec"]]) \
+                                 for _,_,_,data in todo])[ix]
+            fiducials = pyBA.Fiducials(ids, xy)
+        
+        for fname,t,runid,data in todo:
+            
             print "*"*60
             print "Working on %s" % (fname,)
             sys.stdout.flush() 
-            
-            outname = "".join(fname.split(".")[0:-1]) + ".pyBAST"
-            
-            if not clobber and os.path.exists(outname):
-                print " ... skipping (mapping file exists)"
-                self.pybast_files.append((outname,fname,t))    
-                continue
                 
-            data = sdss.csv2rec(fname)
             # Parse data array into objects
             # the A objects will be the fiducial positions from the deep coadd
             # the B objects will be source positions in this epoch
             # both are given in arcseconds relative to a fiducial center
-            objectsA = np.array( [ pyBA.Bivarg(mu=[x["master_dra"],x["master_ddec"]],\
-                                   sigma=np.array([x["master_raerr"],x["master_decerr"]])) \
-                                   for x in data ] )
-            objectsB = np.array( [ pyBA.Bivarg(mu=[x["dra"],x["ddec"]], \
-                                   sigma=np.array([x["raerr"],x["decerr"]])) \
-                                   for x in data ] )
+            objectsA, objectsB = pyBA.parse.objects_from_ties(pyBA.parse.ties_from_match(data))
+            geometry = (fiducials, data["master_objid"]) if fiducials is not None else None
             
-            # Suggest starting point for background mapping
-            S = pyBA.background.suggest_mapping(objectsA,objectsB)
-
-            # Get maximum a posteriori background mapping parameters
-            P = pyBA.background.MAP( objectsA, objectsB, mu0=S.mu, prior=pyBA.Bgmap(), norm_approx=True )
-            D = pyBA.Amap(P,objectsA, objectsB)
-            if verbose:
-                print " ... conditioning"
-                sys.stdout.flush()
-            D.condition()
+            seed = nearest_seed(fitted, t) if warm_start else None
+            D, stats = self.fit_warm(objectsA, objectsB, seed=seed, verbose=verbose, \
+                                     geometry=geometry)
+            for k, nfev in stats.items():
+                self.fit_stats[k].append(nfev)
+            fitted.append((t, D.P.mu, D.scale, D.amp))
             if verbose:
                 print D.hyperparams
                                    
             if save_output:
-                if clobber and os.path.exists(outname):
-                    os.remove(outname)
-                
-                output = open(outname, 'wb')
-                pickle.dump(D, output, protocol=-1)
+                self.store.add(runid, t, D, match_file=fname)
                 if verbose:
-                    print "   ... wrote %s" % outname
-                self.pybast_files.append((outname,fname,t))
-                
+                    print "   ... stored map for run %s" % runid
         
-    def locate_source(self,mypybastfiles=[]):
+        self.report_fit_stats()
+        
+    def fit_warm(self,objectsA,objectsB,seed=None,verbose=True,geometry=None):
+        """
+        fits an epoch from seed (see fit_epoch) if given, falling back to a cold
+        start if that diverges
+        
+        returns the conditioned map and the likelihood evaluations used, by kind
+        of fit ("cold", "warm" or "diverged")
+        """
+        stats = {}
+        D = None
+        if seed is not None:
+            D, nfev = self.fit_epoch(objectsA, objectsB, seed=seed, verbose=verbose, \
+                                     geometry=geometry)
+            if D is None:
+                print " ... warm start diverged; refitting from a cold start"
+                stats["diverged"] = nfev
+            else:
+                stats["warm"] = nfev
+        if D is None:
+            D, nfev = self.fit_epoch(objectsA, objectsB, verbose=verbose, geometry=geometry)
+            stats["cold"] = nfev
+        return D, stats
+    
+    def fit_epoch(self,objectsA,objectsB,seed=None,verbose=True,geometry=None):
+        """
+        fits the background mapping and conditions the distortion map for one epoch
+        
+        seed -- (background mapping parameters, GP scale, GP amplitude) from a
+                previous epoch to start from, instead of suggest_mapping and the
+                default GP hyperparameters
+        geometry -- (pyBA.Fiducials, master object IDs of objectsA) to reuse
+                    distances between master objects shared with other epochs
+        
+        returns the conditioned map and the number of likelihood evaluations
+        (background plus GP) used, or (None, evaluations) if a seeded fit diverged
+        """
+        if seed is None:
+            # Suggest starting point for background mapping
+            mu0 = pyBA.background.suggest_mapping(objectsA,objectsB).mu
+        else:
+            mu0 = seed[0]
+
+        # Get maximum a posteriori background mapping parameters
+        P, nfev, warnflag = pyBA.background.MAP( objectsA, objectsB, mu0=mu0, prior=pyBA.Bgmap(), \
+                                                 norm_approx=True, full_output=True )
+        if seed is not None and (warnflag != 0 or not np.all(np.isfinite(P.mu))):
+            return None, nfev
 
-        if mypybastfiles != []:
-            pybastf = mypybastfiles
+        kwargs = {} if seed is None else {"scale": seed[1], "amp": seed[2]}
+        if geometry is None:
+            D = pyBA.Amap(P,objectsA, objectsB, **kwargs)
         else:
-            pybastf = self.pybast_files
+            D = geometry[0].amap(P, objectsA, objectsB, geometry[1], **kwargs)
+        if verbose:
+            print " ... conditioning"
+            sys.stdout.flush()
+        ML_output = D.condition(full_output=True)
+        nfev += ML_output[3]
+        if seed is not None and (ML_output[4] != 0 or not np.isfinite(ML_output[2])):
+            return None, nfev
+
+        return D, nfev
+        
+    def report_fit_stats(self):
+        """
+        reports the likelihood evaluations used by cold- and warm-started fits,
+        and an estimate of those saved by warm starts (counting the cost of
+        warm starts that diverged)
+        """
+        cold = self.fit_stats["cold"]
+        warm = self.fit_stats["warm"]
+        diverged = self.fit_stats["diverged"]
+        print "fitted %i epochs from a cold start (%i evaluations)" % (len(cold), sum(cold))
+        print "fitted %i epochs from a warm start (%i evaluations)" % (len(warm), sum(warm))
+        if diverged:
+            print " ... %i warm starts diverged (%i evaluations)" % (len(diverged), sum(diverged))
+        if cold and warm:
+            saved = len(warm)*np.mean(cold) - sum(warm) - sum(diverged)
+            print " ... warm starts saved ~%i evaluations (%.0f%%)" % \
+                  (saved, 100.0*saved/(len(warm)*np.mean(cold)))
         
-        rez = {}    
-        for pyfile,fname,t in pybastf:
-            ## locate the position of the source
-            if not os.path.exists(fname) or not os.path.exists(pyfile):
-                print "Cannot locate the source for %s. Needed files not found." % fname
+    def locate_source(self,runids=None,storedir="pyBAST_maps",nproc=1):
+        """
+        maps the source position measured in each epoch through that epoch's map,
+        regressing all epochs in one batch
+        
+        runids -- runs to use (default: all runs in the map store)
+        nproc -- number of processes over which to spread the epochs
+        """
+        if not hasattr(self, "store"):
+            self.store = pyBA.store.Mapstore(storedir)
+        if runids is None:
+            runids = self.store.runids
+        
+        rez = {}
+        found = []
+        for runid in runids:
+            fname = self.store.info(runid)["match_file"]
+            if not os.path.exists(fname):
+                print "Cannot locate the source for run %s. Match file %s not found." % (runid,fname)
                 continue
-            f = open(fname,"r") ; header = [l[1:].strip() for l in f.readlines() if l[0] == "#"] ; f.close()
-            epoch_info = {}
-            for h in header:
-                if h.find(":") != -1:
-                    ttt = h.split(":")
-                    if ttt[1].find(",") != -1:
-                        v = tuple([float(x) for x in ttt[1].split(",")])
-                    else:
-                        v = ttt[1].strip()
-                    epoch_info[ttt[0].strip()] = v
+            epoch_info = pyBA.parse.read_match(fname)[0]
             rez[epoch_info["filename"]] = copy.copy(epoch_info)
-        
 
-            if not epoch_info.get("converted source location (delta ra, delta dec)"):
+            if source_obs(epoch_info) is None:
                 print "Source not found in file %s" % (epoch_info["filename"],)
                 continue
-            print "-"*60
-            pos = epoch_info["converted source location (delta ra, delta dec)"]
-            err = epoch_info["source error (raerr, decerr)"]
-            
-            print "Working on source in %s at position %s (t=%s day)" % \
-                  (epoch_info["filename"],pos,epoch_info['observation time (day)'])
+            found.append((runid, epoch_info))
+        
+        if found:
+            ## one source, measured in each epoch
+            pos = np.array([[source_obs(e)[0] for r,e in found]])
+            err = np.array([[source_obs(e)[1] for r,e in found]])
+            mu, sigma = self.store.regress(pos, err, runids=[r for r,e in found], nproc=nproc)
             
-            mapfile = open(pyfile, 'rb')
-            D = pickle.load(mapfile)
-            mapfile.close()
-            pos = epoch_info["converted source location (delta ra, delta dec)"]
-            BV = pyBA.Bivarg(mu=pos,sigma=np.array([err[0],err[1]]))
-            R = D.regression(BV)
-            print R[0]
-            rez[epoch_info["filename"]]["pos"] = R
+            for j, (runid, epoch_info) in enumerate(found):
+                print "-"*60
+                print "Located source in %s at position %s (t=%s day)" % \
+                      (epoch_info["filename"],epoch_info["converted source location (delta ra, delta dec)"],\
+                       epoch_info['observation time (day)'])
+                R = (np.array([pyBA.Bivarg(mu=mu[0,j], sigma=sigma[0,j])]),)
+                print R[0]
+                rez[epoch_info["filename"]]["pos"] = R
         
         self.rez = rez
     
@@ -193,12 +484,58 @@ class WD(object):
         xlim(-1.5,1.5)
         ylim(-1.5,1.5)
         
-    def gen_results(self):
+    def gen_results(self,nsigma=5.0,nproc=1,verbose=True):
+        """
+        calculates the proper motions of every master object in the field, and of the
+        source, from their positions in each epoch mapped through that epoch's map
+        
+        nsigma -- threshold for flagging an epoch as an outlier for an object
+        nproc -- number of processes over which to spread the epochs
+        
+        proper motions are in mas/yr
+        """
         ## TODO:
         ##   make a plot of RA/DEC v. time
         ##   make a plot of the location on the sky (including error ellipses)
-        ##   calculate the proper motion
-        pass
+        mas_per_yr = 1000.0*365.25 ## from arcsec/day
+        runids = self.store.runids
+        times = self.store.times
+        
+        ## positions of every master object in each epoch (NaN where not matched)
+        data = [pyBA.parse.read_match(self.store.info(r)["match_file"])[1] for r in runids]
+        ids = np.unique(np.concatenate([d["master_objid"] for d in data]))
+        xy = np.zeros((len(ids),len(runids),2)) + np.nan
+        err = np.zeros((len(ids),len(runids),2,2)) + np.nan
+        for j, d in enumerate(data):
+            k = np.searchsorted(ids, d["master_objid"])
+            xy[k,j,0] = d["dra"]
+            xy[k,j,1] = d["ddec"]
+            err[k,j] = 0.0
+            err[k,j,0,0] = d["raerr"]
+            err[k,j,1,1] = d["decerr"]
+        
+        mu, sigma = self.store.regress(xy, err, runids=runids, nproc=nproc)
+        x0, v, cov, chi2, ndof, flags = pyBA.motion.proper_motion(times, mu, sigma, nsigma=nsigma)
+        self.pm = {"master_objid": ids, "pos": x0, "pm": v*mas_per_yr, \
+                   "pm_cov": cov[:,2:4,2:4]*mas_per_yr**2, "chi2": chi2, "ndof": ndof, \
+                   "outliers": flags}
+        if verbose:
+            print "proper motions for %i master objects over %i epochs" % (len(ids), len(runids))
+            print " ... %i outlying epochs flagged" % flags.sum()
+        
+        ## the source, as located in each epoch
+        if getattr(self, "rez", None):
+            located = [e for e in self.rez.values() if "pos" in e]
+            if len(located) >= 2:
+                t = np.array([float(e['observation time (day)']) for e in located])
+                pos = np.array([[e["pos"][0][0].mu for e in located]])
+                err = np.array([[e["pos"][0][0].sigma for e in located]])
+                x0, v, cov, chi2, ndof, flags = pyBA.motion.proper_motion(t, pos, err, nsigma=nsigma)
+                self.source_pm = (v[0]*mas_per_yr, cov[0,2:4,2:4]*mas_per_yr**2, chi2[0], ndof[0])
+                if verbose:
+                    print "source proper motion (mas/yr): %.1f +/- %.1f, %.1f +/- %.1f (chi2 = %.1f for %i dof)" % \
+                          (self.source_pm[0][0], np.sqrt(self.source_pm[1][0,0]), \
+                           self.source_pm[0][1], np.sqrt(self.source_pm[1][1,1]), chi2[0], ndof[0])
            
 def main(test=True,hack=True):
     w = WD()
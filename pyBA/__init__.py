@@ -1,2 +1,2 @@
-from .classes import Bivarg, Bgmap, Amap
-from . import background, distortion, plotting
+from .classes import Bivarg, Bgmap, Amap, Fiducials, Surrogate, transform
+from . import background, distortion, plotting, parse, projection
@@ -1,7 +1,6 @@
 import numpy as np
 from numpy.linalg import solve, det, inv
-from pyBA.classes import Bgmap
-from functools import reduce
+from pyBA.classes import Bgmap, _inv2
 
 
 def distance(M,N):
@@ -13,39 +12,165 @@ def distance(M,N):
     db = (1./2.) * np.log( det(S) / np.sqrt( N.det*M.det ) )
     return da + db
 
-def suggest_mapping(M,N):
+def _distances(muM, sigM, muN, sigN):
+    """ Computes the Bhattacharyya distances between arrays (n x 2 centres,
+    n x 2 x 2 covariances) of distributions, pairwise along their first axis.
+    """
+    S = 0.5 * (sigM + sigN)
+    detS = S[:,0,0]*S[:,1,1] - S[:,0,1]*S[:,1,0]
+    detM = sigM[:,0,0]*sigM[:,1,1] - sigM[:,0,1]*sigM[:,1,0]
+    detN = sigN[:,0,0]*sigN[:,1,1] - sigN[:,0,1]*sigN[:,1,0]
+
+    d = muN - muM
+    chi2 = ( S[:,1,1]*d[:,0]*d[:,0] - (S[:,0,1] + S[:,1,0])*d[:,0]*d[:,1]
+             + S[:,0,0]*d[:,1]*d[:,1] ) / detS
+
+    da = (1./8.) * chi2
+    db = (1./2.) * np.log( detS / np.sqrt( detN*detM ) )
+    return da + db
+
+def _stream_distance(P, T, chunksize):
+    """ Sums the Bhattacharyya distances between the tie pairs in a
+    columnar tie array T (see pyBA.parse), with the second object of each
+    pair mapped through the background mapping P. The array is read in
+    chunks of chunksize rows, so that memory use is independent of the
+    number of ties when T is memory-mapped.
+    """
+    from pyBA.classes import _transform
+    from pyBA.parse import tie_arrays
+
+    total = 0.
+    for i in range(0, len(T), chunksize):
+        muM, sigM, muN, sigN = tie_arrays(T[i:i+chunksize])
+        muN, sigN = _transform(muN, sigN, P)
+        total += np.sum(_distances(muM, sigM, muN, sigN))
+
+    return total
+
+def _unpack(objects):
+    """ Gathers the centres and covariance matrices of a list (or nparray)
+    of Bivargs into n x 2 and n x 2 x 2 arrays.
+    """
+    mu = np.array([o.mu for o in objects], dtype=float)
+    sigma = np.array([o.sigma for o in objects], dtype=float)
+    return mu, sigma
+
+def _similarity(muM, muN, w, maxiter=20, tol=1e-12):
+    """ Weighted closed-form (Umeyama) fit of the mapping muM = U L muN + t,
+    where U is a rotation, L a diagonal scaling and t a translation.
+
+    Input: muM, muN - n x 2 arrays of matched centres
+           w - n-vector of (non-negative) weights
+    Output: theta, L, t
+    """
+    wsum = np.sum(w)
+    cM = w.dot(muM) / wsum
+    cN = w.dot(muN) / wsum
+    xM = muM - cM
+    xN = muN - cN
+
+    # Alternate between the rotation, from the SVD of the weighted
+    #  cross-covariance (forcing a proper rotation), and the per-axis
+    #  scalings with the rotation removed. With isotropic scaling the
+    #  first pass is exact; otherwise a few passes are needed.
+    L = np.ones(2)
+    for i in range(maxiter):
+        H = np.dot((w[:,None] * xM).T, L * xN)
+        Us, _, Vt = np.linalg.svd(H)
+        D = np.diag([1., np.sign(np.linalg.det(Us.dot(Vt))) or 1.])
+        U = Us.dot(D).dot(Vt)
+
+        xR = xM.dot(U)
+        Lnew = np.sum(w[:,None] * xR * xN, axis=0) / np.sum(w[:,None] * xN * xN, axis=0)
+        converged = np.allclose(Lnew, L, rtol=0, atol=tol)
+        L = Lnew
+        if converged:
+            break
+
+    theta = np.arctan2(U[1,0], U[0,0])
+    t = cM - U.dot(L * cN)
+
+    return theta, L, t
+
+def suggest_mapping(M,N,trim=0.1,niter=5):
     """ Suggests a start point for the background mapping fitting between
     two sets of objects. Formally, this is bad, as the data are being used
     twice. However, the likelihood surface is generally (always?) unimodal
     and smooth so that using the suggested starting point will not 
     change the outcome and will speed computation significantly.
 
+    The translation, rotation and scalings are found in closed form by a
+    weighted Procrustes (Umeyama) fit over all tie pairs, with each tie
+    weighted by the mean inverse variance of its combined covariance. If
+    trim > 0, the fit is repeated niter times, each time discarding the
+    fraction trim of ties with the largest (Mahalanobis) residuals.
+
     Input: M, N - lists (or nparrays) of Bivargs
+           trim - fraction of ties to reject as outliers
+           niter - number of trimming iterations
     Output: Bgmap object with infinite variance (i.e. uniform prior)
     """
-    nties = len(M)
-    Mmu = [o.mu for o in M]
-    Nmu = [o.mu for o in N]
+    muM, sigM = _unpack(M)
+    muN, sigN = _unpack(N)
+    nties = len(muM)
+
+    # Weights and precisions from combined tie covariances. Ties with
+    #  singular covariances (e.g. points) fall back to uniform weighting.
+    S = sigM + sigN
+    det = S[:,0,0]*S[:,1,1] - S[:,0,1]*S[:,1,0]
+    if np.all(det > 0):
+        W = _inv2(S)
+    else:
+        W = np.tile(np.eye(2), (nties,1,1))
+    w = 0.5 * (W[:,0,0] + W[:,1,1])
+
+    # Keep at least enough ties to constrain the mapping
+    nkeep = max(int(np.ceil((1. - trim) * nties)), min(nties, 3))
+    keep = np.arange(nties)
 
-    # Estimate translation by differencing means of object lists
-    muM = reduce( lambda x,y: x+y, Mmu ) / nties
-    muN = reduce( lambda x,y: x+y, Nmu ) / nties
-    dx = np.array( muM - muN )
+    for i in range(niter if trim > 0 else 1):
+        theta, L, t = _similarity(muM[keep], muN[keep], w[keep])
 
-    # Estimate scalings by ratioing ranges of object lists
-    rangeM = np.max( Mmu, axis=0 ) - np.min( Mmu, axis=0 )
-    rangeN = np.max( Nmu, axis=0 ) - np.min( Nmu, axis=0 )
-    L = rangeM / rangeN
+        if trim <= 0 or nkeep == nties:
+            break
 
-    # Estimate rotation? Not sure how!
-    theta = 0.0
+        # Rank all ties by their residual to the current fit
+        U = np.array([ [np.cos(theta),-np.sin(theta)],
+                       [np.sin(theta), np.cos(theta)] ])
+        r = muM - (L * muN).dot(U.T) - t
+        chi2 = np.einsum('ni,nij,nj->n', r, W, r)
+        new = np.sort(np.argsort(chi2)[:nkeep])
+        if np.array_equal(new, keep):
+            break
+        keep = new
 
-    # Estimate centre of rotation? 
+    return _from_similarity(theta, L, t)
+
+def _from_similarity(theta, L, t):
+    """ Expresses the fit of _similarity as a Bgmap object, taking the
+    centre of rotation at the origin, so that t = U dx.
+    """
     d0 = np.array([0., 0.])
+    dx = np.array([ np.cos(theta)*t[0] + np.sin(theta)*t[1],
+                   -np.sin(theta)*t[0] + np.cos(theta)*t[1] ])
 
     return Bgmap( dx=dx,theta=theta,d0=d0,L=L )
 
-def MAP(M,N,mu0=Bgmap().mu,prior=Bgmap(),norm_approx=True):
+def _subset_sizes(n, nstart, growth):
+    """ Sizes of the nested random subsets used in coarse-to-fine fitting:
+    nstart, nstart*growth, nstart*growth^2, ... up to (and always ending
+    with) the full set of n objects.
+    """
+    sizes = []
+    m = int(nstart)
+    while m < n:
+        sizes.append(m)
+        m = int(np.ceil(m * growth))
+    sizes.append(n)
+    return sizes
+
+def MAP(M,N,mu0=Bgmap().mu,prior=Bgmap(),norm_approx=True,
+        nstart=None,growth=4.,tol=1.,chunksize=100000,full_output=False):
     """Find the peak of the likelihood distribution for the 
     mapping between two image frames. Input is two lists
     of bivargs, of equal length, representing pairs of objects
@@ -56,25 +181,53 @@ def MAP(M,N,mu0=Bgmap().mu,prior=Bgmap(),norm_approx=True):
     Can also approximate background mapping likelihood distribution as a 
     multivariate normal distribution and reports back the mean and
     covariance matrix for the distribution.
+
+    If nstart is given, the fit is done coarse-to-fine: first on a random
+    subset of nstart ties, then warm-started on nested subsets growing by
+    a factor growth up to the full set. Intermediate stages are skipped
+    once no parameter moves between stages by more than tol times its
+    (Laplace) uncertainty; the fit always finishes on the full set of
+    ties, warm-started from the last subset fitted.
+
+    Instead of two lists of Bivargs, M may be a columnar (n x 10) tie
+    array (see pyBA.parse), with N set to None. This may be memory-mapped
+    (e.g. with parse.read_ties), in which case the likelihood is
+    accumulated over chunks of chunksize ties read in turn from disk.
+
+    If full_output is True, also returns the number of likelihood
+    evaluations made by the fitter and its warning flag (as for
+    scipy.optimize.fmin; non-zero if the iteration limit was reached).
     """
     from scipy.optimize import fmin_bfgs, fmin
 
+    from pyBA.classes import _transform
+
+    if nstart is not None and nstart < len(M):
+        return _coarse_to_fine(M, N, mu0, prior, norm_approx, nstart, growth, tol,
+                               chunksize, full_output)
+
+    if N is not None:
+        muM, sigM = _unpack(M)
+        muN, sigN = _unpack(N)
+
     def lnprob(P,M=M,N=N,prior=prior):
         """ Returns the log probability (\propto -0.5*chi^2) of the
         mapping parameter set P for mapping between two sets of objects
         M and N.
         """
-        llik = 0.5 * np.sum( distance(M[i],N[i].transform(P))
-                          for i in range(len(M)) )
+        if N is None:
+            llik = 0.5 * _stream_distance(P, M, chunksize)
+        else:
+            llik = 0.5 * np.sum( _distances(muM, sigM, *_transform(muN, sigN, P)) )
 
         return llik + prior.llik(P)
 
-    ML = fmin( lnprob,mu0,args=(M,N,prior),callback=None,
-               xtol=1.0e-2, ftol=1.0e-6, disp=False, 
-               maxiter=150 )
+    ML, _, _, nfev, warnflag = fmin( lnprob,mu0,args=(M,N,prior),callback=None,
+                                     xtol=1.0e-2, ftol=1.0e-6, disp=False, 
+                                     maxiter=150, full_output=True )
 
     if norm_approx is False:
-        return Bgmap(mu=ML)
+        P = Bgmap(mu=ML)
     else:
         # Compute covariance matrix
         sigma = np.empty( (7,7) )
@@ -112,27 +265,69 @@ def MAP(M,N,mu0=Bgmap().mu,prior=Bgmap(),norm_approx=True):
             E[E<0] = 1e-12
             sigma = V.dot(np.diag(E).dot(V.T))
         
-        return Bgmap( mu=ML, sigma=sigma )
+        P = Bgmap( mu=ML, sigma=sigma )
+
+    if full_output:
+        return P, nfev, warnflag
+    else:
+        return P
+
+def _coarse_to_fine(M, N, mu0, prior, norm_approx, nstart, growth, tol,
+                    chunksize, full_output):
+    """ Coarse-to-fine MAP fitting on progressively larger nested random
+    subsets of the ties. See MAP.
+    """
+    nties = len(M)
+    M = np.asarray(M)
+    if N is not None:
+        N = np.asarray(N)
+    ix = np.random.permutation(nties)
+
+    sizes = _subset_sizes(nties, nstart, growth)
+    mu = mu0
+    nfev = 0
+    for k, m in enumerate(sizes[:-1]):
+        if N is None:
+            # Columnar tie array: read the subset into memory in one go
+            sub = np.sort(ix[:m])
+            P, n, warnflag = MAP(M[sub], None, mu0=mu, prior=prior,
+                                 norm_approx=True, full_output=True)
+        else:
+            P, n, warnflag = MAP(M[ix[:m]], N[ix[:m]], mu0=mu, prior=prior,
+                                 norm_approx=True, full_output=True)
+        nfev += n
+
+        # Skip to the full set once the parameters move by less than tol
+        #  times their Laplace uncertainties at this stage.
+        shift = np.abs(P.mu - mu) / np.sqrt(np.diag(P.sigma))
+        mu = P.mu
+        if k > 0 and np.all(shift < tol):
+            break
+
+    output = MAP(M, N, mu0=mu, prior=prior, norm_approx=norm_approx,
+                 chunksize=chunksize, full_output=full_output)
+    if full_output:
+        return output[0], nfev + output[1], output[2]
+    return output
 
 def MCMC(M,N,mu0=Bgmap().mu,prior=Bgmap(),nsamp=1000,nwalkers=20):
     """ Performs MCMC computation of likelihood distribution for the 
     background mapping between two frames.
     """
     import emcee
+    from pyBA.classes import _transform
+
+    muM, sigM = _unpack(M)
+    muN, sigN = _unpack(N)
 
     def lnprob(P,M=M,N=N,prior=prior):
         """ Returns the log probability (\propto -0.5*chi^2) of the
         mapping parameter set P for mapping between two sets of objects
         M and N.
         """
-        llik = -0.5 * np.sum( distance(M[i],N[i].transform(P))
-                          for i in range(len(M)) )
+        llik = -0.5 * np.sum( _distances(muM, sigM, *_transform(muN, sigN, P)) )
 
-        if np.all(np.isinf(np.diag(prior.sigma))):
-            # De-facto uniform prior; don't bother computing prior llik.
-            return llik
-        else:
-            return llik + prior.llik(P)
+        return llik + prior.llik(P)
 
     ndim = 7
     p0 = [mu0+np.random.randn(ndim) for i in range(nwalkers)]
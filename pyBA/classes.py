@@ -17,9 +17,225 @@ class ShapeException(Exception):
     pass
 
 
+# Vectorised routines for arrays of bivariate gaussians
+def _params(P):
+    """ Splits a Bgmap object, a 7-vector of parameters or a k x 7 array of
+    them into translation, rotation, centre of rotation and scalings.
+    """
+    if P.__class__.__name__ == 'Bgmap':
+        P = P.mu
+    elif P.__class__.__name__ != 'ndarray':
+        raise TypeError('Argument to background mapping transform should be a Bgmap object or a 7-vector of parameters.')
+
+    return P[...,0:2], P[...,2], P[...,3:5], P[...,5:7]
+
+def _eigh2(sigma):
+    """ Closed-form eigendecomposition of an array (... x 2 x 2) of symmetric
+    2x2 matrices. Eigenvalues are returned in ascending order, with the
+    eigenvectors as columns, as for numpy.linalg.eigh.
+    """
+    a = sigma[...,0,0]
+    b = sigma[...,0,1]
+    c = sigma[...,1,1]
+
+    m = 0.5 * (a + c)
+    r = np.hypot(0.5 * (a - c), b)
+    E = np.stack([m - r, m + r], axis=-1)
+
+    # Angle of major axis. For isotropic matrices any basis will do; choose
+    #  the one eigh gives, with the first eigenvector along x.
+    phi = 0.5 * np.arctan2(2 * b, a - c)
+    phi = np.where((b == 0) & (a == c), 0.5 * np.pi, phi)
+    cphi = np.cos(phi)
+    sphi = np.sin(phi)
+
+    V = np.empty(np.shape(sigma))
+    V[...,0,0] = -sphi
+    V[...,1,0] = cphi
+    V[...,0,1] = cphi
+    V[...,1,1] = sphi
+
+    return E, V
+
+def _rotation(theta):
+    """ Rotation matrices (... x 2 x 2) for an array of angles. """
+    c, s = np.cos(theta), np.sin(theta)
+
+    return np.stack([ np.stack([c,-s], axis=-1), np.stack([s, c], axis=-1) ], axis=-2)
+
+def _inv2(sigma):
+    """ Inverses of an array (... x 2 x 2) of 2x2 matrices. """
+    det = sigma[...,0,0]*sigma[...,1,1] - sigma[...,0,1]*sigma[...,1,0]
+    W = np.empty(sigma.shape)
+    W[...,0,0] = sigma[...,1,1] / det
+    W[...,1,1] = sigma[...,0,0] / det
+    W[...,0,1] = -sigma[...,0,1] / det
+    W[...,1,0] = -sigma[...,1,0] / det
+    return W
+
+def _transform(mu, sigma, P):
+    """ Maps arrays of centres (n x 2) and covariance matrices (n x 2 x 2)
+    through a background mapping, exactly as Bivarg.transform does for a
+    single object. If sigma is None, only the centres are mapped.
+
+    P may also be a k x 7 array of parameter vectors, in which case the
+    outputs gain a leading axis of length k.
+    """
+    dmu, theta, d0, L = _params(P)
+
+    U = _rotation(theta)
+    L = L[...,None,:]
+    mu = np.einsum('...ij,...nj->...ni', U, mu * L + (dmu - d0)[...,None,:]) + d0[...,None,:]
+
+    if sigma is None:
+        return mu, None
+
+    # Scale the eigenvalues of each covariance and rotate its eigenvectors
+    E, V = _eigh2(sigma)
+    V = np.einsum('...ij,njk->...nik', U, V)
+    sigma = np.einsum('...nik,...nk,...njk->...nij', V, E * L, V)
+
+    return mu, sigma
+
+def transform(mu, sigma, P, objects=False):
+    """ Maps arrays of centres (n x 2) and covariance matrices (n x 2 x 2)
+    of bivariate gaussians through a background mapping (Bgmap object or
+    7-vector of parameters), as Bivarg.transform does for a single object.
+
+    P may also be a k x 7 array of parameter vectors, mapping the objects
+    through each in turn; the outputs are then k x n x 2 and k x n x 2 x 2.
+    If sigma is None, only the centres are mapped.
+
+    If objects is True, returns an array (n, or k x n) of LittleBivargs
+    instead of the arrays of centres and covariance matrices.
+    """
+    mu = np.atleast_2d(np.asarray(mu, dtype=float))
+    if sigma is not None:
+        sigma = np.asarray(sigma, dtype=float).reshape( (-1,2,2) )
+        if len(sigma) != len(mu):
+            raise ShapeException('Centres and covariance matrices should be n x 2 and n x 2 x 2 arrays')
+    if P.__class__.__name__ == 'ndarray' and P.shape[-1] != 7:
+        raise ShapeException('Background mapping parameters should be a 7-vector or a k x 7 array')
+
+    mu, sigma = _transform(mu, sigma, P)
+
+    if not objects:
+        return mu, sigma
+
+    if sigma is None:
+        sigma = np.zeros(mu.shape + (2,))
+
+    O = np.empty(mu.shape[:-1], dtype=object)
+    for ix in np.ndindex(O.shape):
+        O[ix] = LittleBivarg(mu[ix], sigma[ix])
+
+    return O
+
+def _untransform(mu, P):
+    """ Inverts the background mapping of an array of centres (n x 2) in
+    closed form, so that _untransform(_transform(mu, None, P)[0], P) = mu.
+    """
+    dmu, theta, d0, L = _params(P)
+
+    U = np.array([ [np.cos(theta),-np.sin(theta)],
+                   [np.sin(theta), np.cos(theta)] ])
+
+    return ((mu - d0).dot(U) + d0 - dmu) / L
+
+def _affine(p):
+    """ Matrices M (... x 2 x 2) and offsets c (... x 2) of background
+    mappings with parameters p (... x 7), as affine transformations
+    x -> M x + c.
+    """
+    U = _rotation(p[...,2])
+    c = np.einsum('...ij,...j->...i', U, p[...,0:2] - p[...,3:5]) + p[...,3:5]
+
+    return U * p[...,None,5:7], c
+
+def _from_affine(M, c, d0):
+    """ Parameters (... x 7) of the background mappings nearest to the
+    affine transformations x -> M x + c, with centres of rotation d0.
+
+    M is matched exactly if it is a rotation of a diagonal scaling, and
+    otherwise in the least-squares sense; c is always matched exactly.
+    """
+    # Rotation maximising the squared diagonal of U^T M
+    A = M[...,0,0]**2 - M[...,1,0]**2 + M[...,1,1]**2 - M[...,0,1]**2
+    B = M[...,0,0]*M[...,1,0] - M[...,1,1]*M[...,0,1]
+    theta = 0.5 * np.arctan2(2*B, A)
+
+    # Of the two solutions theta, theta + pi, keep that with positive scalings
+    U = _rotation(theta)
+    L = np.einsum('...ji,...ji->...i', U, M)
+    flip = L.sum(axis=-1) < 0
+    theta = np.where(flip, theta - np.where(theta > 0, np.pi, -np.pi), theta)
+    U = np.where(flip[...,None,None], -U, U)
+    L = np.where(flip[...,None], -L, L)
+
+    dmu = np.einsum('...ji,...j->...i', U, c - d0) + d0
+
+    return np.concatenate([ dmu, theta[...,None], d0, L ], axis=-1)
+
+def _propagate(f, mu, sigma):
+    """ Maps parameters mu through the function f, and their covariance
+    sigma through its Jacobian (by central differences). f should accept
+    an array (... x len(mu)) of parameter vectors.
+
+    Parameters of infinite variance (e.g. unconstrained by a prior) leave
+    the outputs depending on them with infinite variance, uncorrelated
+    with the others; the rest of sigma is propagated as usual.
+    """
+    # Evaluate at the centre and all perturbations at once
+    h = 1e-6 * np.maximum(1., np.abs(mu))
+    dp = np.diag(h)
+    out = f(np.vstack([ mu, mu + dp, mu - dp ]))
+
+    k = len(mu)
+    J = ((out[1:k+1] - out[k+1:]) / (2*h[:,None])).T
+
+    bad = ~np.isfinite(sigma).all(axis=0)
+    if not bad.any():
+        return out[0], J.dot(sigma).dot(J.T)
+
+    S = np.where(bad[:,None] | bad[None,:], 0., sigma)
+    S = J.dot(S).dot(J.T)
+
+    # Outputs that depend on the bad parameters, beyond rounding error
+    tol = 1e-8 * np.maximum(1., np.abs(out[0]))
+    inf = (np.abs(J[:,bad]) > tol[:,None]).any(axis=1)
+    S[inf,:] = 0.
+    S[:,inf] = 0.
+    S[inf,inf] = np.inf
+
+    return out[0], S
+
+def _jacobian(mu, P):
+    """ Derivatives (n x 2 x 7) of the background mapping of points at
+    centres mu (n x 2) with respect to the mapping parameters.
+    """
+    dmu, theta, d0, L = _params(P)
+
+    c, s = np.cos(theta), np.sin(theta)
+    U = np.array([ [c,-s], [s, c] ])
+    dU = np.array([ [-s,-c], [c,-s] ])
+
+    J = np.empty( (len(mu), 2, 7) )
+    J[:,:,0:2] = U
+    J[:,:,2] = (mu * L + dmu - d0).dot(dU.T)
+    J[:,:,3:5] = np.eye(2) - U
+    J[:,:,5] = mu[:,0:1] * U[:,0]
+    J[:,:,6] = mu[:,1:2] * U[:,1]
+
+    return J
+
 # Main pyBA classes
-class Bgmap:
+class Bgmap(object):
     """ Background mapping structure.
+
+    The precision matrix of the distribution, with parameters of infinite
+    variance masked out, is computed once and cached for llik. So that it
+    cannot go stale, mu and sigma are kept as read-only copies; to change
+    them, assign new arrays.
     """
 
     __author__ = "Berian James"
@@ -46,31 +262,125 @@ class Bgmap:
         else:
             self.sigma = sigma
 
+        return
+
+    @property
+    def mu(self):
+        return self._mu
+
+    @mu.setter
+    def mu(self, mu):
+        self._mu = np.array(mu, dtype=float)
+        self._mu.flags.writeable = False
+
         # Define parameter handles for convenience
-        self.dx = self.mu[0:2]
-        self.theta = self.mu[2]
-        self.d0 = self.mu[3:5]
-        self.L = self.mu[5:7]
+        self.dx = self._mu[0:2]
+        self.theta = self._mu[2]
+        self.d0 = self._mu[3:5]
+        self.L = self._mu[5:7]
+
+    @property
+    def sigma(self):
+        return self._sigma
+
+    @sigma.setter
+    def sigma(self, sigma):
+        self._sigma = np.array(sigma, dtype=float)
+        self._sigma.flags.writeable = False
+        self._invalidate()
+
+    def _invalidate(self):
+        """ Discards the cached precision matrix. """
+        self._prec = None
+
+    def __setstate__(self, state):
+        # Also accepts the instance dictionaries pickled by earlier versions
+        state = dict(state)
+        mu = state.pop('mu', None)
+        sigma = state.pop('sigma', None)
+        self.__dict__.update(state)
+        if mu is not None:
+            self.mu = mu
+        if sigma is not None:
+            self.sigma = sigma
 
-        return
+    def _precision(self):
+        """ Inverse of the covariance matrix, with zero rows and columns for
+        parameters of infinite variance (which contribute nothing to the
+        chi^2). None if every variance is infinite.
+        """
+        if self._prec is None:
+            I = np.nonzero(np.isfinite(np.diag(self.sigma)))[0]
+            if len(I) == 0:
+                self._prec = False
+            else:
+                prec = np.zeros( self.sigma.shape )
+                prec[np.ix_(I,I)] = np.linalg.inv(self.sigma[np.ix_(I,I)])
+                self._prec = prec
+
+        if self._prec is False:
+            return None
+        return self._prec
 
     def llik(self,P=np.array( [0., 0., 0., 0., 0., 1., 1.] ) ):
         """ Compute log-likelihood of parameter set P within 
         likelihood distribution bgmap object.
+
+        P may also be a k x 7 array of parameter sets, giving k values.
         """
+        prec = self._precision()
+
+        # Uniform distribution: nothing to compute
+        if prec is None:
+            return np.zeros(np.shape(P)[:-1]) if np.ndim(P) > 1 else 0.
 
         delta = self.mu - P
-        sigma = self.sigma.copy()
 
-        # Interpret infs in covariance matrix as contributing
-        #  zero to the chi^2 (set delta[i] = 0).
-        I = np.nonzero(np.isinf(np.diag(sigma)))[0]
-        delta[I] = 0
-        sigma[I,:] = 0
-        sigma[:,I] = 0
-        sigma[I,I] = 1
+        return -0.5 * np.einsum('...i,ij,...j->...', delta, prec, delta)
+
+    def compose(self, other):
+        """ Returns the background mapping (Bgmap object) that applies this
+        mapping followed by other, e.g. for frames A -> B and B -> C, the
+        mapping A -> C. The covariance is propagated through the Jacobian
+        of the composition, treating the two mappings as independent.
+
+        The composition of two mappings is again a mapping of this form if
+        their scalings are isotropic or the first has no rotation; otherwise
+        the nearest such mapping is returned.
+        """
+        def f(p):
+            M1, c1 = _affine(p[...,0:7])
+            M2, c2 = _affine(p[...,7:14])
+            return _from_affine(np.matmul(M2, M1),
+                                np.einsum('...ij,...j->...i', M2, c1) + c2, p[...,3:5])
+
+        mu = np.concatenate([ self.mu, other.mu ])
+        sigma = np.zeros( (14,14) )
+        sigma[0:7,0:7] = self.sigma
+        sigma[7:14,7:14] = other.sigma
+
+        mu, sigma = _propagate(f, mu, sigma)
+
+        return Bgmap(mu=mu, sigma=sigma)
+
+    def inverse(self):
+        """ Returns the inverse of the background mapping (Bgmap object),
+        e.g. for frames A -> B, the mapping B -> A. The covariance is
+        propagated through the Jacobian of the inversion.
+
+        The inverse is again a mapping of this form if the scalings are
+        isotropic or there is no rotation; otherwise the nearest such
+        mapping is returned.
+        """
+        def f(p):
+            M, c = _affine(p)
+            Minv = np.linalg.inv(M)
+            return _from_affine(Minv, -np.einsum('...ij,...j->...i', Minv, c),
+                                p[...,3:5] - p[...,0:2])
 
-        return -0.5 * delta.dot( solve( sigma, delta ) )
+        mu, sigma = _propagate(f, self.mu, self.sigma)
+
+        return Bgmap(mu=mu, sigma=sigma)
 
     def sample(self,n=1):
         """ Returns n samples from a Bgmap distribution.
@@ -93,8 +403,6 @@ class Bgmap:
         Input: xy, an array of n bivargs, at whose centres the uncertainty contribution will be calculated
         Output: S_P, an array of n 2x2 covariance matrices, one for each input location. 
         """
-        from pyBA.distortion import astrometry_mean as mu_transform
-
         # Sample background mapping distribution
         N = 10000 # Free parameter: how many samples to draw when evaluating covariance?
         #P = self.sample(n=N)
@@ -113,17 +421,21 @@ class Bgmap:
         # If rotation parameter is very close to zero, the centre of rotation will be unconstrained. Numerically,
         #  it is better to set the centre of rotation to zero in this case.
         if theta_dep < tol:
-            self.mu[3:4] = 0
+            mu, sigma = self.mu.copy(), self.sigma.copy()
+            mu[3:4] = 0
             for i in (3,4):
-                self.sigma[i,:] = 0
-                self.sigma[:,i] = 0
-                self.sigma[i,i] = self.sigma[2,2]
+                sigma[i,:] = 0
+                sigma[:,i] = 0
+                sigma[i,i] = sigma[2,2]
+            self.mu, self.sigma = mu, sigma
+
+        mu = np.array([o.mu for o in xy], dtype=float)
 
         if theta_dep < tol and L1_dep < tol and L2_dep < tol:
             # Variance from background mapping is approximately independent of location.
                 
             # Compute covariance contribution for a single object
-            s_P = np.cov([xy[0].transform(p).mu for p in self.sample(N)], rowvar=0)
+            s_P = np.cov(_transform(mu[0:1], None, self.sample(N))[0][:,0], rowvar=0)
 
             # And stack that result for all the input object locations
             S_P = np.array([s_P for i in range(len(xy))])
@@ -131,77 +443,136 @@ class Bgmap:
         else:
             # Otherwise, for each input object location, compute the variance of
             #  the transformed centres across all sampled transformations.
-            S_P = np.array([np.cov([o.transform(p).mu for p in self.sample(N)], rowvar=0) for o in xy])
-            #S_P = np.array([np.cov([mu_transform(o.mu,p) for p in self.sample(N)], rowvar=0) for o in xy])
-
-        #S_P = np.array([np.cov([o.transform(p).mu for p in self.sample(N)], rowvar=0) for o in xy])
+            #  Locations are taken in blocks to bound the memory used.
+            samples = self.sample(N)
+            S_P = np.empty( (len(mu), 2, 2) )
+            step = max(1, 2**22 // (2*N))
+            for i in range(0, len(mu), step):
+                d = _transform(mu[i:i+step], None, samples)[0]
+                d -= d.mean(axis=0)
+                S_P[i:i+step] = np.einsum('kni,knj->nij', d, d) / (N - 1)
 
         return S_P
         
         
             
-class Bivarg:
+class Bivarg(object):
     """ Implements bivariate gaussian structure and routines to modify it.
+
+    Only the centre and covariance matrix are stored. The eigen-
+    decomposition (E, V), determinant, trace, Cholesky factor and angle of
+    the principal axes are found from closed-form 2x2 formulae when first
+    needed, so that Bivargs used only for their centres and covariances
+    (e.g. the output of Amap.regression) are cheap to create.
     """
 
     __author__ = "Berian James"
     __version__ = "0.3"
     __email__ = "berian@berkeley.edu"
 
+    __slots__ = ('mu', 'sigma', 'point', '_E', '_V')
+
     def __init__(self,mu=np.array([0.,0.]),sigma=np.array([ [1.,0.],[0.,1.] ]),theta=0):
 
         # Set central location
         self.mu = np.squeeze(np.array(mu))
 
         # Parse input variance values
-        if np.size(sigma) == 1:
-            sigma = np.array([ [sigma, 0], [0, sigma] ])
-        elif np.size(sigma) == 2:
-            sigma = np.array([ [sigma[0],0], [0,sigma[1]] ])
-        elif np.size(sigma) == 3:
+        sigma = np.array(sigma, dtype=float)
+        if sigma.size == 1:
+            sigma = np.array([ [sigma.flat[0], 0.], [0., sigma.flat[0]] ])
+        elif sigma.size == 2:
+            sigma = np.array([ [sigma[0],0.], [0.,sigma[1]] ])
+        elif sigma.size == 3:
             sigma = np.array([ [sigma[0], sigma[2]], [sigma[2], sigma[1]] ])
-        elif np.shape(sigma) != (2,2):
+        elif sigma.shape != (2,2):
             raise ShapeException('Covariance matrix should be specified as a 1-, 2- or 3-vector, or a 2x2 array')
 
         # Catch negative variances
-        if sigma[0,0] < 0 or sigma[1,1] < 0:
+        sxx, syy = sigma[0,0], sigma[1,1]
+        if sxx < 0 or syy < 0:
             raise ZeroException('One or more specfied variances are less than zero.')
 
+        self._E = None
+        self._V = None
+
         # Handle points with zero uncertainty
-        if sigma[0,0] + sigma[1,1] == 0:
+        if sxx + syy == 0:
             # Bivarg is actually a point. Note this and do not
             #  compute further distribution properties
             self.point = True
             self.sigma = np.array([[0,0],[0,0]])
-            self.det = 0 
         
         else:
             # Bivarg is a distribution, not a point. 
             self.point = False
-
-            self.E,self.V = eigh(np.array(sigma))
-        
-            self.E = np.diag(np.real(self.E))
+            self.sigma = sigma
 
             if theta!=0:
+                # Rotate the principal axes, keeping this choice of
+                #  eigenvectors (it matters if sigma is isotropic)
                 U = np.array([ [np.cos(theta),-np.sin(theta)],
                                [np.sin(theta), np.cos(theta)] ])
-                self.V = np.dot(U,self.V)
-
-            self.sigma = np.dot( self.V, np.dot(self.E,self.V.T) )
-
-            sigma = self.sigma
-            self.det = sigma[0,0]*sigma[1,1] - sigma[0,1]*sigma[1,0]
-            self.trace = sigma[0,0] + sigma[1,1]
-
-            self.chol = np.array([ [np.sqrt(sigma[0,0]),0.],
-                                   [sigma[0,1]/np.sqrt(sigma[0,0]), 
-                                    np.sqrt( sigma[1,1]-sigma[1,0]*sigma[0,1]/sigma[0,0] ) ] ])
-
-            self.theta = np.math.degrees(np.math.atan2(self.V[0,1],self.V[0,0]))
+                self._V = np.dot(U,self.V)
+                self.sigma = np.dot( self._V, np.dot(self.E,self._V.T) )
 
         return
 
+    def __getstate__(self):
+        return {'mu': self.mu, 'sigma': self.sigma, 'point': self.point,
+                'E': self._E, 'V': self._V}
+
+    def __setstate__(self, state):
+        # Also accepts the instance dictionaries pickled by earlier versions
+        self.mu = state['mu']
+        self.sigma = state['sigma']
+        self.point = state.get('point', False)
+        self._E = state.get('E')
+        self._V = state.get('V')
+
+    def _eigen(self):
+        """ Computes the eigendecomposition of the covariance matrix. """
+        E, V = _eigh2(np.asarray(self.sigma, dtype=float))
+        if self._E is None:
+            self._E = np.diag(E)
+        if self._V is None:
+            self._V = V
+
+    @property
+    def E(self):
+        """ Eigenvalues of the covariance matrix, as a diagonal matrix. """
+        if self._E is None:
+            self._eigen()
+        return self._E
+
+    @property
+    def V(self):
+        """ Eigenvectors of the covariance matrix, as columns. """
+        if self._V is None:
+            self._eigen()
+        return self._V
+
+    @property
+    def det(self):
+        sigma = self.sigma
+        return sigma[0,0]*sigma[1,1] - sigma[0,1]*sigma[1,0]
+
+    @property
+    def trace(self):
+        return self.sigma[0,0] + self.sigma[1,1]
+
+    @property
+    def chol(self):
+        sigma = self.sigma
+        return np.array([ [np.sqrt(sigma[0,0]),0.],
+                          [sigma[0,1]/np.sqrt(sigma[0,0]), 
+                           np.sqrt( sigma[1,1]-sigma[1,0]*sigma[0,1]/sigma[0,0] ) ] ])
+
+    @property
+    def theta(self):
+        """ Angle (degrees) of the principal axes. """
+        return np.degrees(np.arctan2(self.V[0,1],self.V[0,0]))
+
     def __sub__(self,other):
         return Bivarg( mu=self.mu-other.mu, sigma=self.sigma+other.sigma )
 
@@ -289,10 +660,14 @@ class LittleBivarg(Bivarg):
     transformed Bivargs that are going to be thrown away later, but might
     be used for likelihood computations.
     """
+    __slots__ = ()
+
     def __init__(self,mu=np.array([0.,0.]),sigma=np.array([ [1.,0.],[0.,1.] ])):
         self.mu = mu
         self.sigma = sigma
-        self.det = sigma[0,0]*sigma[1,1] - sigma[1,0]*sigma[0,1]
+        self.point = False
+        self._E = None
+        self._V = None
         
         return
 
@@ -312,9 +687,12 @@ class Amap:
     __version__ = "0.3"
     __email__ = "berian@berkeley.edu"
 
-    def __init__(self,P,A,B,scale=100.0,amp=100.0*np.eye(2)):
+    def __init__(self,P,A,B,scale=100.0,amp=100.0*np.eye(2),dist2=None):
         """ Create instance of astrometric map from a background mapping
         (Bgmap object P) and objects in each frame (Bivarg arrays A and B).
+
+        The matrix of squared distances between the objects in A may be
+        given as dist2 if it is already known (see Fiducials).
         """
         from pyBA.distortion import astrometry_cov, d2
 
@@ -329,7 +707,10 @@ class Amap:
 
         # Gather locations of inputs and build distance matrix
         self.xyarr = np.array([o.mu for o in self.A])
-        self.d2 = d2(self.xyarr,self.xyarr)
+        if dist2 is None:
+            self.d2 = d2(self.xyarr,self.xyarr)
+        else:
+            self.d2 = dist2
 
         # Use measurement uncertainties of displacement as 'nugget'
         self.V = np.array([a.sigma for a in A]) + np.array([b.sigma for b in B])
@@ -339,14 +720,32 @@ class Amap:
 
         # Don't compute cholesky decomposition of C until needed
         self.chol = None
+        self.alpha = None
 
         return 
 
+    def _objects(self, distances=False):
+        """ Rebuilds the tie objects and nugget (and, if distances is True,
+        the squared distance matrix) of a map opened by parse.read_map,
+        which keeps only the tie array.
+        """
+        from pyBA.distortion import d2
+
+        if self.A is None:
+            from pyBA.parse import objects_from_ties
+            self.A, self.B = objects_from_ties(np.asarray(self.ties))
+            self.xyarr = np.array([o.mu for o in self.A])
+            self.V = np.array([a.sigma for a in self.A]) + np.array([b.sigma for b in self.B])
+
+        if distances and self.d2 is None:
+            self.d2 = d2(self.xyarr,self.xyarr)
+
     def draw_background(self, res=30):
         """ Method to draw maximum likelihood background mapping 
         on grid of given resolution."""
 
         from pyBA.plotting import draw_MAP_background
+        self._objects()
         draw_MAP_background(self.A, self.B, self.P, res = res )
         return
 
@@ -355,6 +754,7 @@ class Amap:
         plot it on grid of given resolution."""
 
         from pyBA.plotting import draw_realisation
+        self._objects()
 
         # If GP is not conditioned (as checked by self.chol not yet computed),
         #  draw realisation without using input data
@@ -374,13 +774,15 @@ class Amap:
         from background mapping."""
 
         from pyBA.plotting import draw_MAP_residuals
+        self._objects()
         draw_MAP_residuals(self.A, self.B, self.P, scaled=scaled)
         return
 
     def build_covariance(self,scale=None,amp=None):
 
         from pyBA.distortion import astrometry_cov
-        
+
+        self._objects(distances=True)
         if scale is not None:
             self.scale = scale
             self.hyperparams['scale'] = scale
@@ -399,18 +801,59 @@ class Amap:
         # Compute cholesky decomposition of C with optimised parameters
         from scipy.linalg import cho_factor
         self.chol = cho_factor(self.C)
+        self.alpha = None
 
-    def condition(self):
+    def condition(self, nstart=None, growth=4., rtol=0.05, full_output=False):
         """ Conditions hyper-parameters of gaussian process.
+
+        If nstart is given, the hyperparameters are first conditioned on a
+        random subset of nstart ties, then warm-started on nested subsets
+        growing by a factor growth up to the full set. Intermediate stages
+        are skipped once the hyperparameters change by less than rtol
+        (fractionally) between stages; the last stage always conditions on
+        the full set, warm-started from the subset hyperparameters.
+
+        Returns the output of distortion.optimise_HP; with full_output, the
+        evaluation count there covers all stages.
         """
 
         from pyBA.distortion import optimise_HP
+        from pyBA.background import _subset_sizes
 
+        self._objects(distances=True)
         HP0 = [self.scale, self.amp[0,0], self.amp[0,1]]
         #HP0 = [self.scale, self.amp[0,0]]
 
-        # Optimise hyperparameters
-        ML_output = optimise_HP(self.A, self.B, self.P, HP0)
+        # Coarse-to-fine conditioning on subsets of the ties
+        nfev = 0
+        nties = len(self.A)
+        if nstart is not None and nstart < nties:
+            A = np.asarray(self.A)
+            B = np.asarray(self.B)
+            ix = np.random.permutation(nties)
+
+            for k, m in enumerate(_subset_sizes(nties, nstart, growth)[:-1]):
+                sub = ix[:m]
+                output = optimise_HP(A[sub], B[sub], self.P, HP0,
+                                     full_output=full_output,
+                                     d2_obs=self.d2[np.ix_(sub,sub)])
+                if full_output:
+                    nfev += output[3]
+                HP = [output[0], output[1][0,0], output[1][0,1]]
+                change = np.abs(np.array(HP) - HP0) / np.maximum(np.abs(HP), 1e-12)
+                HP0 = HP
+                if k > 0 and np.all(change < rtol):
+                    break
+
+        # Optimise hyperparameters on the full set of ties
+        ML_output = optimise_HP(self.A, self.B, self.P, HP0,
+                                full_output=full_output, d2_obs=self.d2)
+        if full_output:
+            nfev += ML_output[3]
+
+        if full_output:
+            ML_output = ML_output[:3] + (nfev,) + ML_output[4:]
+
         scale_conditioned = ML_output[0]
         amp_conditioned = ML_output[1]
         #ML_lnprob = ML_output[2]
@@ -423,8 +866,6 @@ class Amap:
     def regression(self, xy):
         """Performs regression on a mapping object at some locations, 
         which can be points or distributions."""
-        from scipy.linalg import cho_solve
-        from pyBA.distortion import d2, astrometry_cov, compute_residual
 
         # Convert list of inputs to array if needed
         if type(xy) == list:
@@ -456,51 +897,420 @@ class Amap:
             raise TypeError('Regression input should be an nx2 array of coordinates, or an array of Bivarg distributions')
         
         ## Gaussian process regression
-        # Old grid coordinates
-        xyobs = np.array([o.mu for o in self.A])
-
         # New grid coordinates
         xynew = np.array([o.mu for o in XY])
 
-        # Get regression data (resdiual to background)
-        dx, dy = compute_residual(self.A, self.B, self.P)
-        dxy = np.array([dx, dy]).T.flatten()
-
-        # Build cross covariance between old and new locations
-        d2_grid = d2(xynew,xyobs)
-        Cs = astrometry_cov(d2_grid, self.scale, self.amp)
-
-        # Build covariance for new locations
-        d2_grid = d2(xynew, xynew)
-        Vnew = np.array([o.sigma for o in XY])
-        # Don't need to add variances for input points here, they will be propagated
-        #  through the background transformation.
-        #Css = astrometry_cov(d2_grid, self.scale, self.amp, var=Vnew)
-        Css = astrometry_cov(d2_grid, self.scale, self.amp)
-
-        # Regression: mean function evaluated at new locations
-        vxy = Cs.dot(cho_solve(self.chol, dxy)).reshape( (len(XY),2) )
-        
-        # Regression: uncertainties at new locations
-        S = Css - Cs.dot(cho_solve(self.chol, Cs.T))
+        # Regression: residual to mean function and uncertainties at new locations
+        vxy, S_gp = self._gp(xynew)
 
         ## Package output
         # Background (mean function) mapping
-        R = np.array([o.transform(self.P) for o in XY])        
+        muR, sigR = _transform(xynew, np.array([o.sigma for o in XY], dtype=float), self.P)
 
         # Add regression residuals to mean function
-        munew = np.array([o.mu for o in R]) + vxy
+        munew = muR + vxy
 
         # Get regression uncertainty from background mapping
         S_P = self.P.uncertainty(XY)
 
-        # Get regression uncertainty from gaussian process
-        S_gp = np.array([S[i:i+2,i:i+2] for i in range(0,len(S),2)])
-
         # Combine uncertainties into single covariance matrix
-        sigmanew = np.array([o.sigma for o in R]) + S_gp + S_P
+        sigmanew = sigR + S_gp + S_P
 
         # Construct output array of Bivargs
-        O = np.array([ Bivarg(mu=munew[i], sigma=sigmanew[i]) for i in range(len(R)) ])
+        O = np.array([ Bivarg(mu=munew[i], sigma=sigmanew[i]) for i in range(len(XY)) ])
 
         return O, S_gp, S_P
+
+    def query(self, xy, sigma=None):
+        """ Maps locations xy (n x 2), with optional covariance matrices
+        sigma (n x 2 x 2), through the astrometric map, as regression does
+        but on arrays rather than Bivargs.
+
+        The uncertainty contributed by the background mapping is found by
+        linear propagation of its covariance, as in Surrogate.query.
+
+        Output: mu (n x 2) and sigma (n x 2 x 2) of mapped locations
+        """
+        xy = np.atleast_2d(np.asarray(xy, dtype=float))
+        if sigma is None:
+            sigma = np.zeros( (len(xy), 2, 2) )
+
+        vxy, S_gp = self._gp(xy)
+
+        # Background mapping and its uncertainty
+        mu, sigma = _transform(xy, sigma, self.P)
+        J = _jacobian(xy, self.P)
+        S_P = np.einsum('nik,kl,njl->nij', J, self.P.sigma, J)
+
+        return mu + vxy, sigma + S_gp + S_P
+
+    def to_surrogate(self, res=30, bounds=None, dtype=np.float32, ncheck=100,
+                     uncertainty=True, rtol=0.1, seed=None):
+        """ Tabulates the conditioned map on a regular grid, for fast
+        evaluation anywhere within it (see Surrogate).
+
+        Input: res - grid resolution (scalar, or pair for x and y)
+               bounds - (xmin, xmax, ymin, ymax) of region to tabulate;
+                        defaults to the range of the tie objects
+               dtype - precision in which tables are stored
+               ncheck - number of random locations at which to compare
+                        the surrogate with exact regression; a warning is
+                        given if the interpolation error there exceeds
+                        rtol times the standard deviation of the map
+               uncertainty - if False, tabulate only the mapping, not its
+                             covariance; the surrogate then answers mean
+                             but not query
+               seed - seed (or numpy RandomState) of the random check
+                      locations
+        Output: Surrogate object
+        """
+        from pyBA.distortion import _regression_grid, astrometry_mean
+
+        self._objects()
+        if self.chol is None:
+            self.build_covariance()
+
+        if bounds is None:
+            bounds = (self.xyarr[:,0].min(), self.xyarr[:,0].max(),
+                      self.xyarr[:,1].min(), self.xyarr[:,1].max())
+        nx, ny = np.broadcast_to(res, (2,))
+
+        # Tabulate on a grid padded beyond the bounds, so that spline
+        #  edge effects fall outside the region to be queried
+        pad = Surrogate.pad
+        hx = (bounds[1] - bounds[0]) / (nx - 1.)
+        hy = (bounds[3] - bounds[2]) / (ny - 1.)
+        xs = bounds[0] + hx * np.arange(-pad, nx + pad)
+        ys = bounds[2] + hy * np.arange(-pad, ny + pad)
+
+        v, S = _regression_grid(self.A, self.B, xs, ys, self.P,
+                                self.scale, self.amp, self.chol,
+                                uncertainty=uncertainty)
+
+        # Keep only the gaussian process residual to the background
+        x, y = np.meshgrid(xs, ys)
+        xy = np.array([x.flatten(), y.flatten()]).T
+        v -= astrometry_mean(xy, self.P).reshape(v.shape)
+
+        tables = [ v[:,:,0], v[:,:,1] ]
+        if uncertainty:
+            tables += [ S[:,:,0,0], S[:,:,1,1], S[:,:,0,1] ]
+        D = Surrogate(self.P, bounds, np.array(tables), dtype=dtype)
+
+        # Compare with exact regression at random locations
+        if ncheck > 0:
+            lo = np.array([bounds[0], bounds[2]])
+            hi = np.array([bounds[1], bounds[3]])
+            rng = seed if isinstance(seed, np.random.RandomState) else \
+                  np.random.RandomState(seed)
+            xy = lo + (hi - lo) * rng.rand(ncheck, 2)
+            vxy, S_gp = self._gp(xy)
+            r, S_r = D._interpolate(xy, cov=uncertainty)
+            D.errors = {'mu': np.abs(r - vxy).max(),
+                        'sigma': np.abs(S_r - S_gp).max() if uncertainty else np.nan}
+
+            # Interpolation error relative to the uncertainty of the map
+            sd = np.sqrt(np.maximum(np.diagonal(S_gp, axis1=1, axis2=2), 0.))
+            ratio = np.max(np.abs(r - vxy) / np.maximum(sd, 1e-300))
+            if ratio > rtol:
+                import warnings
+                warnings.warn('Surrogate interpolation error is up to %.2g times the '
+                              'standard deviation of the map; consider a finer grid '
+                              '(res)' % ratio)
+
+        return D
+
+    def save(self, path):
+        """ Writes the conditioned map to a directory (see parse.write_map). """
+        from pyBA.parse import write_map
+        write_map(path, self)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """ Opens a map written by Amap.save (see parse.read_map). """
+        from pyBA.parse import read_map
+        return read_map(path, mmap_mode=mmap_mode)
+
+    def _gp(self, xynew):
+        """ Gaussian process regression of the residuals to the background
+        mapping at new locations (n x 2 array). Returns the regressed
+        residuals (n x 2) and their covariance matrices (n x 2 x 2).
+        """
+        from scipy.linalg import cho_solve
+        from pyBA.distortion import d2, astrometry_cov
+
+        # Old grid coordinates
+        xyobs = self.xyarr
+
+        # Build cross covariance between old and new locations
+        d2_grid = d2(xynew,xyobs)
+        Cs = astrometry_cov(d2_grid, self.scale, self.amp)
+
+        # Regression: mean function evaluated at new locations
+        vxy = Cs.dot(self._weights()).reshape( (len(xynew),2) )
+        
+        # Regression: uncertainties at new locations. Only the 2x2 blocks
+        #  on the diagonal of the covariance for new locations are needed.
+        #  Input point variances are not added here; they are propagated
+        #  through the background transformation.
+        X = cho_solve(self.chol, Cs.T).T.reshape( (len(xynew),2,-1) )
+        Cs = Cs.reshape( (len(xynew),2,-1) )
+        S_gp = self.amp - np.einsum('ick,idk->icd', Cs, X)
+
+        return vxy, S_gp
+
+    def _weights(self):
+        """ Residuals to the background mapping at the tie objects,
+        weighted by the inverse data covariance. Computed once per
+        factorisation of the covariance matrix.
+        """
+        from scipy.linalg import cho_solve
+        from pyBA.distortion import compute_residual
+
+        if self.chol is None:
+            self.build_covariance()
+
+        if self.alpha is None:
+            self._objects()
+            dx, dy = compute_residual(self.A, self.B, self.P)
+            dxy = np.array([dx, dy]).T.flatten()
+            self.alpha = cho_solve(self.chol, dxy)
+
+        return self.alpha
+
+    def _residual(self, xynew, gradient=False, chunk=2**22):
+        """ Regressed residuals (n x 2) to the background mapping at new
+        locations (n x 2 array), without uncertainties. If gradient is
+        True, also returns their derivatives (n x 2 x 2) with respect to
+        the location, [i,c,d] being d(residual c)/d(coordinate d).
+
+        The cross-correlations are formed for blocks of locations, so that
+        no more than about chunk numbers are held at once.
+        """
+        from pyBA.distortion import d2
+
+        xyobs = self.xyarr
+        beta = self._weights().reshape( (-1,2) ).dot(self.amp.T)
+
+        # The gradient of the squared exponential kernel brings down the
+        #  separation from each tie object
+        if gradient:
+            beta = np.hstack([ beta, xyobs[:,0:1] * beta, xyobs[:,1:2] * beta ])
+
+        out = np.empty( (len(xynew), beta.shape[1]) )
+        step = max(1, int(chunk // len(xyobs)))
+        for i in range(0, len(xynew), step):
+            K = np.exp( -d2(xynew[i:i+step], xyobs) / self.scale )
+            out[i:i+step] = K.dot(beta)
+
+        r = out[:,0:2]
+        if not gradient:
+            return r
+
+        G = np.empty( (len(xynew), 2, 2) )
+        for d in range(2):
+            G[:,:,d] = -2. / self.scale * (xynew[:,d:d+1] * r - out[:,2+2*d:4+2*d])
+
+        return r, G
+
+
+class Fiducials:
+    """ Shared geometry for tie objects drawn from a common catalogue.
+
+    When several image frames are each mapped onto the same set of
+    fiducial objects (e.g. a master catalogue), the squared distances
+    between the fiducial locations are the same for every frame. This
+    computes them once for the union of fiducial objects, keyed by object
+    ID, and slices out the submatrix for each frame's ties.
+    """
+
+    __author__ = "Berian James"
+    __version__ = "0.3"
+    __email__ = "berian@berkeley.edu"
+
+    def __init__(self, ids, xy):
+        """ Create shared geometry from the IDs (n-vector) and locations
+        (n x 2 array) of the fiducial objects.
+        """
+        self.ids = np.asarray(ids)
+        self.xy = np.asarray(xy, dtype=float)
+
+        if len(np.unique(self.ids)) != len(self.ids):
+            raise ValueError('Fiducial object IDs should be unique')
+
+        # Sort order for looking up IDs
+        self.order = np.argsort(self.ids)
+
+        # Don't compute distance matrix until needed
+        self._d2 = None
+
+        return
+
+    def index(self, ids):
+        """ Returns the positions of the given object IDs in the fiducial list.
+        """
+        ids = np.asarray(ids)
+        pos = np.searchsorted(self.ids, ids, sorter=self.order)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        ix = self.order[pos]
+
+        if np.any(self.ids[ix] != ids):
+            raise KeyError('Object IDs not among fiducial objects')
+
+        return ix
+
+    def distances(self, ids=None):
+        """ Returns the matrix of squared distances between the given
+        objects (by default, all fiducial objects). The matrix for all
+        objects is computed on first use and shared thereafter.
+        """
+        from pyBA.distortion import d2
+
+        if self._d2 is None:
+            self._d2 = d2(self.xy, self.xy)
+
+        if ids is None:
+            return self._d2
+
+        ix = self.index(ids)
+        return self._d2[np.ix_(ix, ix)]
+
+    def amap(self, P, A, B, ids, **kwargs):
+        """ Creates an astrometric map (see Amap) whose tie objects A are
+        the fiducial objects with the given IDs, reusing the shared
+        distance matrix.
+        """
+        return Amap(P, A, B, dist2=self.distances(ids), **kwargs)
+
+
+class Surrogate:
+    """ Lookup table for a conditioned astrometric map (see Amap.to_surrogate).
+
+    Stores the gaussian process residual to the background mapping, and
+    its 2x2 covariance, tabulated on a regular grid as cubic spline
+    coefficients. Queries are answered by spline interpolation plus the
+    (exact) background mapping, at constant cost per location and without
+    the tie objects or the factorised covariance matrix of the Amap.
+    """
+
+    __author__ = "Berian James"
+    __version__ = "0.3"
+    __email__ = "berian@berkeley.edu"
+
+    # Number of grid cells tabulated beyond each edge of the bounds
+    pad = 4
+
+    def __init__(self, P, bounds, tables, dtype=np.float32, prefiltered=False,
+                 errors=None):
+        """ Create surrogate from a background mapping (Bgmap object P),
+        the bounds (xmin, xmax, ymin, ymax) of the tabulated region, and
+        tables (5 x ny x nx; including padding) of the residual x and y
+        displacements and the xx, yy and xy covariance components. With
+        only the two tables of displacements, the surrogate maps locations
+        (mean) but cannot give their uncertainties (query).
+        """
+        from scipy.ndimage import spline_filter
+
+        self.P = Bgmap(mu=np.array(P.mu, dtype=float), sigma=np.array(P.sigma, dtype=float))
+        self.bounds = tuple(float(b) for b in bounds)
+
+        if prefiltered:
+            self.tables = np.asarray(tables, dtype=dtype)
+        else:
+            self.tables = np.array([ spline_filter(np.asarray(t, dtype=float), order=3,
+                                                   mode='mirror')
+                                     for t in tables ], dtype=dtype)
+
+        ny, nx = self.tables.shape[1:]
+        self.hx = (self.bounds[1] - self.bounds[0]) / (nx - 2*self.pad - 1.)
+        self.hy = (self.bounds[3] - self.bounds[2]) / (ny - 2*self.pad - 1.)
+
+        # Maximum interpolation errors, if known (see Amap.to_surrogate)
+        self.errors = errors
+
+        return
+
+    def _interpolate(self, xy, cov=True):
+        """ Interpolates the residual displacements (n x 2) and, if cov is
+        True, their covariances (n x 2 x 2) at locations xy (n x 2).
+        """
+        from scipy.ndimage import map_coordinates
+
+        if cov and len(self.tables) < 5:
+            raise ValueError('Surrogate was tabulated without uncertainties')
+
+        # Allow for round-off at the edges
+        xy = np.atleast_2d(xy)
+        ex = 1e-9 * self.hx
+        ey = 1e-9 * self.hy
+        if np.any( (xy[:,0] < self.bounds[0] - ex) | (xy[:,0] > self.bounds[1] + ex) |
+                   (xy[:,1] < self.bounds[2] - ey) | (xy[:,1] > self.bounds[3] + ey) ):
+            raise ValueError('Locations lie outside the bounds of the surrogate')
+
+        # Fractional grid indices
+        coords = np.array([ (xy[:,1] - self.bounds[2]) / self.hy + self.pad,
+                            (xy[:,0] - self.bounds[0]) / self.hx + self.pad ])
+
+        tables = self.tables if cov else self.tables[:2]
+        t = [ map_coordinates(table, coords, order=3, mode='mirror', prefilter=False)
+              for table in tables ]
+
+        r = np.array([ t[0], t[1] ]).T
+        if not cov:
+            return r, None
+
+        S = np.array([ [t[2], t[4]], [t[4], t[3]] ]).transpose( (2,0,1) )
+
+        return r, S
+
+    def mean(self, xy):
+        """ Maps locations xy (n x 2) through the astrometric map, without
+        computing uncertainties.
+        """
+        xy = np.atleast_2d(np.asarray(xy, dtype=float))
+        r, _ = self._interpolate(xy, cov=False)
+        mu, _ = _transform(xy, None, self.P)
+
+        return mu + r
+
+    def query(self, xy, sigma=None):
+        """ Maps locations xy (n x 2), with optional covariance matrices
+        sigma (n x 2 x 2), through the astrometric map.
+
+        The uncertainty contributed by the background mapping is found by
+        linear propagation of its covariance, rather than by sampling as in
+        Amap.regression.
+
+        Output: mu (n x 2) and sigma (n x 2 x 2) of mapped locations
+        """
+        xy = np.atleast_2d(np.asarray(xy, dtype=float))
+        if sigma is None:
+            sigma = np.zeros( (len(xy), 2, 2) )
+
+        r, S_gp = self._interpolate(xy)
+
+        # Background mapping and its uncertainty
+        mu, sigma = _transform(xy, sigma, self.P)
+        J = _jacobian(xy, self.P)
+        S_P = np.einsum('nik,kl,njl->nij', J, self.P.sigma, J)
+
+        return mu + r, sigma + S_gp + S_P
+
+    def save(self, fname):
+        """ Writes surrogate to a .npz file. """
+        np.savez(fname, mu=self.P.mu, sigma=self.P.sigma,
+                 bounds=np.array(self.bounds), tables=self.tables,
+                 errors=np.array([self.errors['mu'], self.errors['sigma']])
+                        if self.errors is not None else np.array([]))
+
+    @classmethod
+    def load(cls, fname):
+        """ Reads surrogate written by Surrogate.save. """
+        with np.load(fname) as f:
+            errors = None
+            if f['errors'].size == 2:
+                errors = {'mu': f['errors'][0], 'sigma': f['errors'][1]}
+            tables = f['tables']
+
+            return cls(Bgmap(mu=f['mu'], sigma=f['sigma']), f['bounds'], tables,
+                       dtype=tables.dtype, prefiltered=True, errors=errors)
@@ -0,0 +1,378 @@
+"""Provides the pybast command-line tool: batch fitting of astrometric
+maps to match files, queries of fitted maps, and summaries of them.
+
+    pybast fit matches/ -o maps/ -j 4
+    pybast query maps/run4198.map -xy 10.0 20.0
+    pybast summarise maps/
+
+Fits are spread over a pool of processes, each limited to a number of
+BLAS threads, and written in the compact map format (see parse.write_map).
+A job manifest in the output directory records the content hash of each
+input fitted, so an interrupted run can be repeated to fit only the
+inputs not yet done, or changed since.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+# Environment variables limiting the threads of common BLAS libraries
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def _sha1(fname):
+    """ SHA-1 digest of the content of a file. """
+    import hashlib
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+def _inputs(paths, pattern):
+    """ Input files: files given, and files in directories given that match
+    pattern, in order.
+    """
+    import fnmatch
+
+    found = []
+    for p in paths:
+        if os.path.isdir(p):
+            found += sorted( os.path.join(p, f) for f in os.listdir(p)
+                             if fnmatch.fnmatch(f, pattern) and
+                             os.path.isfile(os.path.join(p, f)) )
+        else:
+            found.append(p)
+
+    return found
+
+def _output(fname, outdir):
+    """ Path of the map fitted to an input file. """
+    base = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(outdir, base + '.map')
+
+def _limit_threads(nthreads):
+    """ Limits BLAS threads in this process (and those it starts). Setting
+    the environment only takes effect in processes that load BLAS
+    afterwards; threadpoolctl, if installed, also limits this one.
+    """
+    for v in THREAD_VARIABLES:
+        os.environ[v] = str(nthreads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(nthreads)
+    except ImportError:
+        pass
+
+def _pool(nproc, nthreads):
+    """ Pool of nproc worker processes, each with nthreads BLAS threads.
+    Workers are started afresh (not forked) where possible, so that they
+    load BLAS with the limit in place.
+    """
+    import multiprocessing
+
+    _limit_threads(nthreads)
+    try:
+        ctx = multiprocessing.get_context('spawn')
+    except AttributeError:
+        ctx = multiprocessing
+    return ctx.Pool(nproc, initializer=_limit_threads, initargs=(nthreads,))
+
+def fit_file(fname, output, subsample=None, seed=None):
+    """ Fits the astrometric map of a match file (see parse.read_match):
+    a starting point from background.suggest_mapping, the background
+    mapping by background.MAP, then the distortion map conditioned by
+    Amap.condition. The map is written to the directory output.
+
+    Input: subsample - number of ties to use, chosen at random (default: all)
+           seed - seed of the random choice
+    Output: dictionary of the number of ties used and hyperparameters
+    """
+    from pyBA.classes import Amap, Bgmap
+    from pyBA.background import suggest_mapping, MAP
+    from pyBA.parse import read_match, ties_from_match, objects_from_ties
+
+    T = ties_from_match(read_match(fname)[1])
+    if subsample is not None and subsample < len(T):
+        ix = np.random.RandomState(seed).permutation(len(T))[:subsample]
+        T = T[np.sort(ix)]
+    A, B = objects_from_ties(T)
+
+    S = suggest_mapping(A, B)
+    P = MAP(A, B, mu0=S.mu, prior=Bgmap(), norm_approx=True)
+    D = Amap(P, A, B)
+    D.condition()
+
+    D.save(output)
+
+    return {'nties': len(T), 'scale': float(D.scale), 'amp': np.asarray(D.amp).tolist()}
+
+def _fit_task(task):
+    """ Runs fit_file in a worker, reporting failures rather than raising. """
+    fname, output, subsample, seed = task
+    start = time.time()
+    try:
+        result = fit_file(fname, output, subsample=subsample, seed=seed)
+        result['status'] = 'done'
+    except Exception as e:
+        result = {'status': 'failed', 'error': '%s: %s' % (e.__class__.__name__, e)}
+    result['elapsed'] = time.time() - start
+
+    return fname, result
+
+class Manifest(object):
+    """ Record of the jobs of a batch fit, kept as JSON in the output
+    directory: for each input, its content hash, the options used, the
+    output (relative to the manifest) and the outcome.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.root = os.path.dirname(os.path.abspath(fname))
+        self.jobs = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION:
+                raise ValueError('Unsupported manifest version %s' % manifest.get('version'))
+            self.jobs = manifest['jobs']
+
+    def write(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'jobs': self.jobs}, f, indent=1)
+        os.rename(self.fname + '.tmp', self.fname)
+
+    def done(self, fname, digest, options):
+        """ Whether an input with this content was fitted with these
+        options, and its output is still there.
+        """
+        job = self.jobs.get(os.path.abspath(fname))
+        return (job is not None and job['status'] == 'done' and job['sha1'] == digest and
+                job['options'] == options and os.path.exists(self.output(job)))
+
+    def output(self, job):
+        """ Path of the output of a job. """
+        return os.path.join(self.root, job['output'])
+
+    def record(self, fname, digest, options, output, result):
+        output = os.path.relpath(os.path.abspath(output), self.root)
+        job = {'sha1': digest, 'options': options, 'output': output}
+        job.update(result)
+        self.jobs[os.path.abspath(fname)] = job
+        self.write()
+
+def _open_map(path):
+    """ Opens a map written by write_map, or pickled by earlier versions. """
+    from pyBA.parse import read_map
+
+    if os.path.isdir(path):
+        return read_map(path)
+
+    import pickle
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def fit(args):
+    """ The fit subcommand. """
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    manifest = Manifest(os.path.join(args.output, 'manifest.json'))
+    options = {'subsample': args.subsample, 'seed': args.seed}
+
+    inputs, seen = [], set()
+    for fname in _inputs(args.inputs, args.pattern):
+        if not os.path.exists(fname):
+            print('ERROR: Data file %s was not found!' % fname, file=sys.stderr)
+            continue
+        if os.path.abspath(fname) not in seen:
+            seen.add(os.path.abspath(fname))
+            inputs.append(fname)
+
+    # Inputs of the same base name would overwrite each other's maps
+    outputs = {}
+    for fname in inputs:
+        outputs.setdefault(_output(fname, args.output), []).append(fname)
+    clashes = [ names for names in outputs.values() if len(names) > 1 ]
+    if clashes:
+        for names in clashes:
+            print('ERROR: Inputs %s would all be fitted to %s!' %
+                  (', '.join(names), _output(names[0], args.output)), file=sys.stderr)
+        return 1
+
+    todo = []
+    for fname in inputs:
+        digest = _sha1(fname)
+        if not args.force and manifest.done(fname, digest, options):
+            print('skipping %s (done)' % fname)
+            continue
+        todo.append( (fname, digest) )
+
+    tasks = [ (fname, _output(fname, args.output), args.subsample, args.seed)
+              for fname, digest in todo ]
+    digests = dict(todo)
+    nfailed = 0
+
+    if args.nproc > 1 and len(tasks) > 1:
+        pool = _pool(args.nproc, args.threads)
+        try:
+            results = pool.imap_unordered(_fit_task, tasks)
+            for fname, result in results:
+                nfailed += _report(manifest, fname, digests[fname], options, args.output, result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _limit_threads(args.threads)
+        for task in tasks:
+            fname, result = _fit_task(task)
+            nfailed += _report(manifest, fname, digests[fname], options, args.output, result)
+
+    return 1 if nfailed else 0
+
+def _report(manifest, fname, digest, options, outdir, result):
+    """ Records and prints the outcome of a fit; 1 if it failed. """
+    manifest.record(fname, digest, options, _output(fname, outdir), result)
+    if result['status'] == 'done':
+        print('fitted %s: %i ties, scale %.3g (%.1f s)' %
+              (fname, result['nties'], result['scale'], result['elapsed']))
+        return 0
+    print('FAILED %s: %s' % (fname, result['error']), file=sys.stderr)
+    return 1
+
+def query(args):
+    """ The query subcommand. """
+    D = _open_map(args.map)
+
+    if args.xy is not None:
+        xy = np.array([ args.xy ])
+    elif args.grid is not None:
+        # Grid over the range of the tie objects, as plotting.make_grid
+        lo, hi = np.min(D.xyarr, axis=0), np.max(D.xyarr, axis=0)
+        x, y = np.meshgrid(np.linspace(lo[0], hi[0], args.grid),
+                           np.linspace(lo[1], hi[1], args.grid))
+        xy = np.column_stack([ np.ravel(x), np.ravel(y) ])
+    elif args.batchfile is not None:
+        xy = np.atleast_2d(np.loadtxt(args.batchfile))
+        if xy.shape[1] != 2:
+            print('ERROR: Data in %s not in coordinate pairs x y?' % args.batchfile, file=sys.stderr)
+            return 1
+    else:
+        print('ERROR: No coordinates requested!', file=sys.stderr)
+        return 1
+
+    mu, sigma = D.query(xy)
+    out = np.column_stack([ xy, mu, sigma[:,0,0], sigma[:,1,1], sigma[:,0,1] ])
+    np.savetxt(args.output or sys.stdout, out, fmt='%.6f',
+               header='x y x_mapped y_mapped sxx syy sxy')
+
+    return 0
+
+def _summary(path, D):
+    """ Prints a summary of a map. """
+    P = D.P
+    nties = len(D.A) if getattr(D, 'A', None) is not None else len(D.ties)
+    print()
+    print(path)
+    print('{0} {1}'.format('Number of tie objects:', nties))
+    print()
+    print('Maximum a posteriori background mapping')
+    print('{0:>20} {1:>6.3f} {2:<6.3f}'.format('Translation (x,y):', P.mu[0], P.mu[1]))
+    print('{0:>20} {1:>6.3f}'.format('Rotation:', P.mu[2]))
+    print('{0:>20} {1:>6.3f} {2:<6.3f}'.format('Centre (x,y):', P.mu[3], P.mu[4]))
+    print('{0:>20} {1:>6.3f} {2:<6.3f}'.format('Scaling (x,y):', P.mu[5], P.mu[6]))
+    print()
+    print('Covariance matrix for background mapping parameters')
+    print(P.sigma)
+    print()
+    print('{0:>15} {1}'.format('GP amplitude:', np.asarray(D.amp).ravel()))
+    print('{0:>15} {1:>6.3f}'.format('GP scale:', float(D.scale)))
+
+def summarise(args):
+    """ The summarise subcommand. """
+    np.set_printoptions(precision=3, linewidth=100, suppress=True)
+
+    status = 0
+    for path in args.maps:
+        manifest = os.path.join(path, 'manifest.json')
+        if os.path.isdir(path) and os.path.exists(manifest):
+            # An output directory of fit: every map fitted, and any failures
+            jobs = Manifest(manifest)
+            for fname, job in sorted(jobs.jobs.items()):
+                if job['status'] == 'done':
+                    _summary(jobs.output(job), _open_map(jobs.output(job)))
+                else:
+                    print()
+                    print('%s: FAILED (%s)' % (fname, job.get('error')))
+            continue
+        if not os.path.exists(path):
+            print('ERROR: Map %s was not found!' % path, file=sys.stderr)
+            status = 1
+            continue
+        D = _open_map(path)
+        _summary(path, D)
+        if args.plot:
+            from pyBA.parse import objects_from_ties
+            from pyBA.plotting import draw_MAP_residuals
+            A, B = objects_from_ties(D.ties)
+            draw_MAP_residuals(A, B, D.P)
+
+    return status
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='pybast',
+                                     description='Perform probabilistic astrometry with pyBA.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('fit', help='fit astrometric maps to match files',
+                              description='Fit astrometric maps to match files, in parallel.')
+    p.add_argument('inputs', nargs='+', help='match files, or directories of them')
+    p.add_argument('-o', '--output', default='pybast_maps', help='output directory of maps')
+    p.add_argument('-p', '--pattern', default='*.dat',
+                   help='pattern of match files in input directories (default: *.dat)')
+    p.add_argument('-j', '--nproc', type=int, default=1, help='number of worker processes')
+    p.add_argument('-t', '--threads', type=int, default=1, help='BLAS threads per worker')
+    p.add_argument('-s', '--subsample', type=int, metavar='N',
+                   help='use only N random ties from each file')
+    p.add_argument('--seed', type=int, default=0, help='seed of the random subsample')
+    p.add_argument('-f', '--force', action='store_true',
+                   help='refit inputs already fitted (ignoring the manifest)')
+    p.set_defaults(func=fit)
+
+    p = subparsers.add_parser('query', help='map locations through a fitted map',
+                              description='Map locations through a fitted map.')
+    p.add_argument('map', help='path to astrometric map')
+    p.add_argument('-xy', nargs=2, metavar=('x', 'y'), type=float, help='map coordinate pair (x,y)')
+    p.add_argument('-g', '--grid', metavar='res', type=int, help='map a grid of res x res locations')
+    p.add_argument('-o', '--output', help='output file (default: standard output)')
+    p.add_argument('batchfile', nargs='?', help='file of coordinate pairs')
+    p.set_defaults(func=query)
+
+    p = subparsers.add_parser('summarise', help='summarise fitted maps',
+                              description='Summarise fitted maps, or the maps fitted to an output directory.')
+    p.add_argument('maps', nargs='+', help='paths to maps, or output directories of fit')
+    p.add_argument('-p', '--plot', action='store_true', help='plot residuals of the background mapping')
+    p.set_defaults(func=summarise)
+
+    return parser
+
+def main(argv=None):
+    """ Entry point of the pybast command. """
+    args = _parser().parse_args(argv)
+    if getattr(args, 'func', None) is None:
+        _parser().print_help()
+        return 2
+
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
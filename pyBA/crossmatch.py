@@ -0,0 +1,300 @@
+"""Provides catalogue cross-matching for pyBA: construction of tie lists
+from two catalogues of objects.
+
+Catalogues are held as columnar (n x 5) arrays, one row per object, laid
+out as either half of a row of a tie array (see pyBA.parse):
+
+    x y sxx syy sxy
+
+Lists (or nparrays) of Bivargs are also accepted.
+"""
+
+import numpy as np
+from pyBA.classes import Bgmap, _params, _transform
+from pyBA.background import _distances, _unpack
+
+NCOLS = 5
+
+
+def _catalogue(C):
+    """ Centres (n x 2) and covariance matrices (n x 2 x 2) of the objects
+    in a catalogue.
+    """
+    if C.__class__.__name__ in ('ndarray', 'memmap') and C.dtype != object:
+        if C.ndim != 2 or C.shape[1] != NCOLS:
+            raise ValueError('Catalogue array should have shape (n, %d)' % NCOLS)
+        C = np.asarray(C, dtype=float)
+        sigma = np.empty((len(C), 2, 2))
+        sigma[:,0,0] = C[:,2]
+        sigma[:,1,1] = C[:,3]
+        sigma[:,0,1] = C[:,4]
+        sigma[:,1,0] = C[:,4]
+        return C[:,0:2], sigma
+
+    return _unpack(C)
+
+def _columns(mu, sigma):
+    """ Packs centres and covariance matrices into catalogue columns. """
+    return np.column_stack([ mu, sigma[:,0,0], sigma[:,1,1], sigma[:,0,1] ])
+
+def _candidates(tree, muA, sigA, muB, sigB, P, radius, k, gate, offset):
+    """ Candidate pairs between the objects of frame A (in tree) and a
+    block of objects of frame B, mapped through P: up to k neighbours
+    within radius of each, with Bhattacharyya distance below gate.
+
+    Output: indices into A and B, and distances, of candidate pairs
+    """
+    mu, sigma = _transform(muB, sigB, P)
+
+    _, ix = tree.query(mu, k=np.arange(1, k+1), distance_upper_bound=radius)
+    iB, j = np.nonzero(ix < len(muA))
+    iA = ix[iB, j]
+
+    d = _distances(muA[iA], sigA[iA], mu[iB], sigma[iB])
+    ok = d < gate
+
+    return iA[ok], iB[ok] + offset, d[ok]
+
+def _assign(iA, iB, d):
+    """ Picks one-to-one pairs from candidate pairs, in order of increasing
+    distance: each round accepts the pairs that are the best remaining
+    candidate for both of their objects.
+    """
+    order = np.argsort(d, kind='stable')
+    iA, iB = iA[order], iB[order]
+
+    accepted = []
+    while len(iA):
+        # Pairs that are the best remaining candidate of both their objects
+        #  (the first candidate of each, in order of distance)
+        _, firstB = np.unique(iB, return_index=True)
+        _, firstA = np.unique(iA, return_index=True)
+        pick = np.intersect1d(firstA, firstB)
+        accepted.append( (iA[pick], iB[pick]) )
+
+        usedA = np.zeros(iA.max() + 1, dtype=bool)
+        usedB = np.zeros(iB.max() + 1, dtype=bool)
+        usedA[iA[pick]] = True
+        usedB[iB[pick]] = True
+
+        # Remove all candidates involving objects now used
+        keep = ~(usedA[iA] | usedB[iB])
+        iA, iB = iA[keep], iB[keep]
+
+    if not accepted:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    iA = np.concatenate([ a for a, b in accepted ])
+    iB = np.concatenate([ b for a, b in accepted ])
+    order = np.argsort(iB)
+
+    return iA[order], iB[order]
+
+def match(catA, catB, P=Bgmap(), radius=None, k=4, gate=4., nproc=1,
+          chunksize=100000, return_index=False):
+    """ Builds a tie list between two catalogues.
+
+    The objects of catalogue B are mapped into frame A through an initial
+    background mapping P, and their nearest neighbours in catalogue A
+    within radius found with a KD-tree. Candidate pairs are kept if their
+    Bhattacharyya distance (see background.distance) is below gate, and
+    one-to-one ties chosen from these in order of increasing distance.
+    (Two objects of equal covariance separated by n sigma are at distance
+    n^2/4.) Objects should have non-zero covariances.
+
+    Catalogue B is processed in blocks of chunksize objects, spread over
+    nproc threads.
+
+    Input: catA, catB - (n x 5) catalogue arrays or lists of Bivargs
+           P - Bgmap object (or 7-vector) mapping frame B onto frame A
+           radius - search radius in frame A; if None, five times the
+                    largest positional uncertainty of a pair
+           k - maximum number of candidates per object
+           gate - largest Bhattacharyya distance of a tie
+    Output: (n x 10) tie array (see pyBA.parse), ordered as catalogue B,
+            and, if return_index is True, the indices of the tied objects
+            in each catalogue
+    """
+    from scipy.spatial import cKDTree
+
+    muA, sigA = _catalogue(catA)
+    muB, sigB = _catalogue(catB)
+
+    if radius is None:
+        # Mapping scales the variances by at most the largest scaling
+        L = _params(P)[3]
+        trA = np.max(sigA[:,0,0] + sigA[:,1,1], initial=0.)
+        trB = np.max(sigB[:,0,0] + sigB[:,1,1], initial=0.) * np.max(L)
+        radius = 5. * np.sqrt(trA + trB)
+
+    tree = cKDTree(muA)
+
+    blocks = [ (i, min(i + chunksize, len(muB))) for i in range(0, len(muB), chunksize) ]
+    def work(block):
+        i, j = block
+        return _candidates(tree, muA, sigA, muB[i:j], sigB[i:j], P, radius, k, gate, i)
+
+    if nproc > 1 and len(blocks) > 1:
+        # The KD-tree query and array arithmetic release the GIL
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(nproc)
+        try:
+            found = pool.map(work, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        found = [ work(block) for block in blocks ]
+
+    if found:
+        iA, iB, d = [ np.concatenate(x) for x in zip(*found) ]
+        iA, iB = _assign(iA, iB, d)
+    else:
+        iA = iB = np.array([], dtype=int)
+
+    T = np.hstack([ _columns(muA[iA], sigA[iA]), _columns(muB[iB], sigB[iB]) ])
+
+    if return_index:
+        return T, iA, iB
+    return T
+
+def _brightest(mu, sigma, rank, n):
+    """ Indices of the n brightest objects: those first in rank (e.g.
+    magnitudes) if given, otherwise those of smallest positional variance.
+    """
+    if rank is None:
+        rank = sigma[:,0,0] + sigma[:,1,1]
+
+    return np.argsort(rank, kind='stable')[:n]
+
+def _triangles(mu, nneighbours):
+    """ Triangles formed by each object and pairs of its nearest
+    neighbours, as rows of vertex indices ordered by decreasing length of
+    the opposite side, with their invariants under translation, rotation
+    and scaling (ratios of the shorter sides to the longest) and their
+    orientation.
+    """
+    from scipy.spatial import cKDTree
+
+    k = min(nneighbours + 1, len(mu))
+    _, nn = cKDTree(mu).query(mu, k=np.arange(1, k+1))
+    j, l = np.triu_indices(k - 1, 1)
+    tri = np.column_stack([ np.repeat(nn[:,0], len(j)),
+                            nn[:,1:][:,j].ravel(), nn[:,1:][:,l].ravel() ])
+    tri = np.unique(np.sort(tri, axis=1), axis=0)
+
+    # Order vertices by decreasing length of the opposite side
+    p = mu[tri]
+    sides = np.column_stack([ np.hypot(*(p[:,1] - p[:,2]).T),
+                              np.hypot(*(p[:,0] - p[:,2]).T),
+                              np.hypot(*(p[:,0] - p[:,1]).T) ])
+    order = np.argsort(-sides, axis=1)
+    tri = np.take_along_axis(tri, order, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+
+    invariants = sides[:,1:] / sides[:,0:1]
+
+    p = mu[tri]
+    e1 = p[:,1] - p[:,0]
+    e2 = p[:,2] - p[:,0]
+    orientation = np.sign(e1[:,0]*e2[:,1] - e1[:,1]*e2[:,0])
+
+    return tri, invariants, orientation
+
+def register(catA, catB, nbright=50, nneighbours=6, eps=0.005, tol=0.01,
+             radius=None, rankA=None, rankB=None, ntry=10, **kwargs):
+    """ Blind registration of two catalogues of unknown relative
+    translation, rotation and scale, by matching triangles of bright
+    objects.
+
+    Triangles are formed from each of the nbright brightest objects in
+    each catalogue and pairs of its nneighbours nearest neighbours, and
+    matched by their shape (ratios of their sides, to within eps) with a
+    KD-tree. Each pair of matched triangles implies a rotation and scale
+    mapping frame B onto frame A; these vote, to within tol (radians and
+    in log scale), and the most popular are checked by counting the bright
+    objects they bring within radius of one another. The best is refined
+    on these pairs by a Procrustes fit (see background.suggest_mapping),
+    and used to cross-match the full catalogues (see match; further
+    keyword arguments are passed to it).
+
+    Input: catA, catB - (n x 5) catalogue arrays or lists of Bivargs
+           rankA, rankB - brightness ranking of each catalogue (e.g.
+                          magnitudes; smallest first); if None, objects
+                          with the smallest positional variance are used
+           radius - tolerance (in frame A) for checking the registration;
+                    if None, a quarter of the median distance between
+                    bright objects in frame A
+    Output: Bgmap object (with infinite variance; a start point for MAP),
+            and (n x 10) tie array
+    """
+    from scipy.spatial import cKDTree
+    from pyBA.background import _similarity, _from_similarity
+
+    muA, sigA = _catalogue(catA)
+    muB, sigB = _catalogue(catB)
+    bA = muA[_brightest(muA, sigA, rankA, nbright)]
+    bB = muB[_brightest(muB, sigB, rankB, nbright)]
+    if len(bA) < 3 or len(bB) < 3:
+        raise ValueError('At least three objects are needed in each catalogue')
+
+    treeA = cKDTree(bA)
+    if radius is None:
+        radius = 0.25 * np.median(treeA.query(bA, k=[2])[0])
+
+    # Match triangles of the same shape and orientation (the mapping is a
+    #  proper rotation)
+    triA, invA, orA = _triangles(bA, nneighbours)
+    triB, invB, orB = _triangles(bB, nneighbours)
+    pairs = cKDTree(invA).sparse_distance_matrix(cKDTree(invB), eps, output_type='ndarray')
+    iA, iB = pairs['i'], pairs['j']
+    same = orA[iA] == orB[iB]
+    iA, iB = iA[same], iB[same]
+    if len(iA) == 0:
+        raise ValueError('No matching triangles found')
+
+    # Similarity transformation implied by each pair of triangles, as
+    #  zA = a zB + t in complex coordinates
+    zA = bA[triA[iA]].dot([1., 1j])
+    zB = bB[triB[iB]].dot([1., 1j])
+    cA = zA.mean(axis=1)
+    cB = zB.mean(axis=1)
+    a = (np.sum((zA - cA[:,None]) * np.conj(zB - cB[:,None]), axis=1) /
+         np.sum(np.abs(zB - cB[:,None])**2, axis=1))
+    t = cA - a * cB
+
+    # Vote in rotation and log scale
+    votes = np.column_stack([ a.real / np.abs(a), a.imag / np.abs(a), np.log(np.abs(a)) ]) / tol
+    vtree = cKDTree(votes)
+    counts = vtree.query_ball_point(votes, 1., return_length=True)
+
+    # Check the most popular hypotheses against the bright objects
+    best = (0, None)
+    tried = np.zeros(len(votes), dtype=bool)
+    for i in np.argsort(-counts, kind='stable'):
+        if tried[i]:
+            continue
+        if ntry == 0:
+            break
+        ntry -= 1
+
+        agree = np.array(vtree.query_ball_point(votes[i], 1.))
+        tried[agree] = True
+        ai = np.median(a[agree].real) + 1j * np.median(a[agree].imag)
+        ti = np.median(t[agree].real) + 1j * np.median(t[agree].imag)
+
+        z = ai * bB.dot([1., 1j]) + ti
+        d, ix = treeA.query(np.column_stack([ z.real, z.imag ]), distance_upper_bound=radius)
+        ok = np.isfinite(d)
+        if ok.sum() > best[0]:
+            best = (ok.sum(), (ix[ok], np.nonzero(ok)[0]))
+
+    if best[0] < 3:
+        raise ValueError('No consistent registration found')
+
+    # Refine on the bright objects brought together
+    jA, jB = best[1]
+    theta, L, t = _similarity(bA[jA], bB[jB], np.ones(len(jA)))
+    P = _from_similarity(theta, L, t)
+
+    return P, match(catA, catB, P, **kwargs)
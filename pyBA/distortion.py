@@ -62,6 +62,93 @@ def astrometry_mean(xy, P=Bgmap()):
 
     return xy - p
 
+def astrometry_inverse(xy, D, sigma=None, tol=1e-8, maxiter=50):
+    """ Maps locations xy (n x 2) in frame B back to frame A, inverting
+    the forward mapping of Amap.regression (background mapping plus
+    regressed residual).
+
+    The background mapping is inverted in closed form, and the residual
+    then removed by fixed-point iteration, x <- P^-1(y - r(x)), over all
+    locations at once; each location is iterated until its position
+    changes by less than tol. Uncertainties (input covariances sigma,
+    n x 2 x 2, if given, plus those of the mapping) are propagated back
+    through the inverse of the Jacobian of the mapping at the solution.
+    For a Surrogate, iterates are kept within its bounds.
+
+    Input: xy - n x 2 array of locations in frame B
+           D - Amap, Surrogate, or Bgmap (background mapping only)
+           sigma - n x 2 x 2 array of covariance matrices of locations
+    Output: mu (n x 2) and sigma (n x 2 x 2) of locations in frame A
+    """
+    from pyBA.classes import _untransform, _jacobian
+
+    xy = np.atleast_2d(np.asarray(xy, dtype=float))
+
+    cls = D.__class__.__name__
+    if cls == 'Bgmap':
+        P = D
+    elif cls in ('Amap', 'Surrogate'):
+        P = D.P
+    else:
+        raise TypeError('Mapping should be an Amap, Surrogate or Bgmap object')
+
+    clip = lambda x: x
+    if cls == 'Amap':
+        residual = D._residual
+    elif cls == 'Surrogate':
+        lo = np.array([ D.bounds[0], D.bounds[2] ])
+        hi = np.array([ D.bounds[1], D.bounds[3] ])
+        clip = lambda x: np.clip(x, lo, hi)
+        residual = lambda x: D._interpolate(x, cov=False)[0]
+
+    # Closed-form inverse of the background mapping
+    mu = clip(_untransform(xy, P))
+
+    # Iterate only on locations that have not yet converged
+    if cls != 'Bgmap':
+        todo = np.arange(len(xy))
+        for i in range(maxiter):
+            new = clip(_untransform(xy[todo] - residual(mu[todo]), P))
+            step = np.max(np.abs(new - mu[todo]), axis=1)
+            mu[todo] = new
+            todo = todo[step >= tol]
+            if len(todo) == 0:
+                break
+        else:
+            import warnings
+            warnings.warn('%d locations did not converge in inverse mapping' % len(todo))
+
+    # Jacobian of the forward mapping at the solution
+    theta, L = P.mu[2], P.mu[5:7]
+    U = np.array([ [np.cos(theta),-np.sin(theta)],
+                   [np.sin(theta), np.cos(theta)] ])
+    F = np.tile(U * L, (len(xy), 1, 1))
+
+    # Uncertainty of the mapping at the solution
+    J = _jacobian(mu, P)
+    S = np.einsum('nik,kl,njl->nij', J, P.sigma, J)
+    if cls == 'Amap':
+        _, G = D._residual(mu, gradient=True)
+        S += D._gp(mu)[1]
+        F += G
+    elif cls == 'Surrogate':
+        S += D._interpolate(mu)[1]
+
+        # Spline gradient, by central differences (one-sided at the bounds)
+        for d, h in enumerate( (D.hx, D.hy) ):
+            up, down = mu.copy(), mu.copy()
+            up[:,d] = np.minimum(mu[:,d] + 1e-3 * h, hi[d])
+            down[:,d] = np.maximum(mu[:,d] - 1e-3 * h, lo[d])
+            F[:,:,d] += (residual(up) - residual(down)) / (up[:,d] - down[:,d])[:,None]
+
+    if sigma is not None:
+        S += sigma
+
+    Finv = np.linalg.inv(F)
+    S = np.einsum('nik,nkl,njl->nij', Finv, S, Finv)
+
+    return mu, S
+
 def compute_displacements(objectsA = np.array([ Bivarg() ]),
                           objectsB = np.array([ Bivarg() ])):
     """From arrays of tie objects, return the locations of the centres
@@ -147,9 +234,182 @@ def regression(objectsA, objectsB, xyarr, P, scale, amp, chol):
     
     return vx, vy, sx, sy
 
-def optimise_HP(A, B, P, HP0):
+def _grid_axes(xs, ys):
+    """Checks that grid axes are one-dimensional and returns them, along
+    with the points of the grid as an (nx*ny) x 2 array ordered as for
+    plotting.make_grid."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if xs.ndim != 1 or ys.ndim != 1:
+        raise ValueError('Grid axes should be one-dimensional arrays')
+
+    x, y = np.meshgrid(xs, ys)
+    return xs, ys, np.array([x.flatten(), y.flatten()]).T
+
+def _sqrtm(K):
+    """Square root factor R (with R R^T = K) of a symmetric positive
+    semi-definite matrix, clipping any small negative eigenvalues from
+    round-off. Unlike the Cholesky root, this exists for the (numerically
+    singular) squared-exponential kernel on a fine grid."""
+    E, V = eigh(K)
+    E[E<0] = 0
+    return V * np.sqrt(E)
+
+def _circulant_eigenvalues(n, h, scale, maxpad=64):
+    """Eigenvalues of the smallest circulant embedding (of size at least
+    2(n-1)) of the squared-exponential correlation on a regular
+    one-dimensional grid of n points with spacing h, that is positive
+    semi-definite up to round-off. Negative values are clipped."""
+    m = max(2*(n-1), 1)
+    while True:
+        j = np.arange(m)
+        c = np.exp( -(h*np.minimum(j, m-j))**2 / scale )
+        lam = np.fft.fft(c).real
+        if lam.min() >= -1e-10 * lam.max() or m >= maxpad*max(n, 2):
+            break
+        m *= 2
+
+    if lam.min() < -1e-10 * lam.max():
+        import warnings
+        warnings.warn('Circulant embedding is not positive definite; '
+                      'realisation is approximate.')
+
+    lam[lam<0] = 0
+    return lam
+
+def realise_grid(xs, ys, P, scale, amp, method='kron'):
+    """Evaluate GP realisation on the regular grid with axes xs and ys
+    (e.g. as made by plotting.make_grid), without forming the covariance
+    matrix for the whole grid. 
+
+    The squared-exponential kernel on the grid factorises as Ky x Kx x amp
+    (Kronecker products), so that the realisation can be drawn either from
+    the square roots of the per-axis kernels (method='kron'; memory grows
+    as nx^2 + ny^2) or, for evenly spaced axes, by circulant embedding and
+    FFTs (method='fft'; memory grows as nx*ny).
+
+    Returns vx, vy as ny x nx arrays."""
+    from numpy.random import randn
+
+    xs, ys, xyarr = _grid_axes(xs, ys)
+    nx, ny = len(xs), len(ys)
+
+    # Mean function on grid
+    v = astrometry_mean(xyarr, P).reshape( (ny, nx, 2) )
+
+    if method == 'kron':
+        # Square roots of the per-axis kernels
+        Rx = _sqrtm( np.exp( -d2(xs[:,None], xs[:,None]) / scale ) )
+        Ry = _sqrtm( np.exp( -d2(ys[:,None], ys[:,None]) / scale ) )
+
+        # (Ry x Rx) z, one axis at a time
+        z = randn(ny, nx, 2)
+        z = np.tensordot(Ry, z, axes=(1,0))
+        z = np.einsum('ij,kjl->kil', Rx, z)
+
+    elif method == 'fft':
+        hx = xs[1] - xs[0] if nx > 1 else 1.
+        hy = ys[1] - ys[0] if ny > 1 else 1.
+        if not (np.allclose(np.diff(xs), hx) and np.allclose(np.diff(ys), hy)):
+            raise ValueError('FFT realisation requires evenly spaced grid axes')
+
+        lamx = _circulant_eigenvalues(nx, hx, scale)
+        lamy = _circulant_eigenvalues(ny, hy, scale)
+        lam = np.outer(lamy, lamx)
+
+        # The real and imaginary parts are independent fields with the
+        #  required correlation; one for each coordinate.
+        w = np.sqrt(lam / lam.size) * (randn(*lam.shape) + 1j*randn(*lam.shape))
+        w = np.fft.fft2(w)[:ny,:nx]
+        z = np.dstack([w.real, w.imag])
+
+    else:
+        raise ValueError("Realisation method should be 'kron' or 'fft'")
+
+    # Correlate the coordinates through the amplitude matrix
+    v += z.dot(_sqrtm(amp).T)
+
+    return v[:,:,0], v[:,:,1]
+
+def regression_grid(objectsA, objectsB, xs, ys, P, scale, amp, chol,
+                    uncertainty=True, chunk=2**22):
+    """ Perform regression on the gaussian processes for the distortion
+    map onto the regular grid with axes xs and ys, as for regression but
+    without forming covariance matrices for the whole grid.
+
+    The cross-covariance between the grid and the data factorises along
+    the grid axes, so the regression means cost O(nx*ny*n) for n tie
+    objects. Uncertainties still cost O(nx*ny*n^2); they are computed in
+    blocks of grid points so that no more than about chunk numbers are
+    held at once, and can be skipped by setting uncertainty=False.
+
+    Returns vx, vy, sx, sy as ny x nx arrays (sx, sy are None if
+    uncertainty is False)."""
+
+    v, S = _regression_grid(objectsA, objectsB, xs, ys, P, scale, amp, chol,
+                            uncertainty=uncertainty, chunk=chunk)
+
+    if uncertainty:
+        return v[:,:,0], v[:,:,1], S[:,:,0,0], S[:,:,1,1]
+    else:
+        return v[:,:,0], v[:,:,1], None, None
+
+def _regression_grid(objectsA, objectsB, xs, ys, P, scale, amp, chol,
+                     uncertainty=True, chunk=2**22):
+    """ Grid regression as for regression_grid, returning the regressed
+    displacements (ny x nx x 2) and their full 2x2 covariance matrices
+    (ny x nx x 2 x 2, or None if uncertainty is False)."""
+    from scipy.linalg import cho_solve, solve_triangular
+
+    xs, ys, xyarr = _grid_axes(xs, ys)
+    nx, ny = len(xs), len(ys)
+
+    # Residuals to mean function at data points, weighted by inverse covariance
+    xobs, yobs, _, _, _, _ = compute_displacements(objectsA, objectsB)
+    dx, dy = compute_residual(objectsA, objectsB, P)
+    dxy = np.array([dx, dy]).T.flatten()
+    alpha = cho_solve(chol, dxy).reshape( (len(xobs), 2) ).dot(amp.T)
+
+    # Per-axis cross-correlations between grid and data
+    Kx = np.exp( -(xs[:,None] - xobs[None,:])**2 / scale )
+    Ky = np.exp( -(ys[:,None] - yobs[None,:])**2 / scale )
+
+    v = astrometry_mean(xyarr, P).reshape( (ny, nx, 2) )
+    S = np.tile(amp, (ny, nx, 1, 1)) if uncertainty else None
+
+    # Process blocks of grid rows
+    c, lower = chol
+    nrows = max(1, int(chunk // (nx * 2 * len(xobs))))
+    for i in range(0, ny, nrows):
+        # Cross-correlations for this block of grid points
+        W = (Ky[i:i+nrows,None,:] * Kx[None,:,:]).reshape( (-1, len(xobs)) )
+        v[i:i+nrows] += W.dot(alpha).reshape( (-1, nx, 2) )
+
+        if uncertainty:
+            # Covariance reduction, via the triangular factor of the data covariance
+            X = [ solve_triangular(c, (W[:,:,None] * amp[k]).reshape( (len(W), -1) ).T,
+                                   lower=lower, trans=0 if lower else 1)
+                  for k in range(2) ]
+            for k in range(2):
+                for l in range(k, 2):
+                    Skl = np.sum(X[k]*X[l], axis=0).reshape( (-1, nx) )
+                    S[i:i+nrows,:,k,l] -= Skl
+                    if l != k:
+                        S[i:i+nrows,:,l,k] -= Skl
+
+    return v, S
+
+def optimise_HP(A, B, P, HP0, full_output=False, d2_obs=None):
     """ Condition hyperparameters of gaussian process associated 
     with astrometric mapping, based on observed data.
+
+    Returns the conditioned scale and amplitude matrix and the value of
+    the objective there. If full_output is True, also returns the number
+    of objective evaluations and the warning flag of the fitter (as for
+    scipy.optimize.fmin).
+
+    The squared distance matrix between the objects in A may be passed
+    as d2_obs if it is already known.
     """
 
     from scipy.optimize import fmin, fmin_bfgs
@@ -168,7 +428,8 @@ def optimise_HP(A, B, P, HP0):
     dxy = np.array([dx, dy]).T.flatten()
     
     # Pre-compute distance matrix and grab nugget components
-    d2_obs = d2(xyobs, xyobs)
+    if d2_obs is None:
+        d2_obs = d2(xyobs, xyobs)
     V = np.array([a.sigma for a in A]) + np.array([b.sigma for b in B])
 
     # Define loglikelihood function for gaussian process given data
@@ -244,10 +505,13 @@ def optimise_HP(A, B, P, HP0):
         return llik
 
     # Perform optimisation
-    ML_HP = fmin(lnprob_HP,HP0, xtol=1.0e-2, ftol=1.0e-6, disp=False, 
-                 maxiter=15000)
+    ML_HP, _, _, nfev, warnflag = fmin(lnprob_HP,HP0, xtol=1.0e-2, ftol=1.0e-6, disp=False, 
+                                       maxiter=15000, full_output=True)
     #ML_HP = fmin_bfgs(lnprob_HP,HP0, disp=False, maxiter=150)
 
     scale_pos, ampM_pos = make_pos(*ML_HP)
-    return scale_pos, ampM_pos, lnprob_HP(ML_HP)
+    if full_output:
+        return scale_pos, ampM_pos, lnprob_HP(ML_HP), nfev, warnflag
+    else:
+        return scale_pos, ampM_pos, lnprob_HP(ML_HP)
     
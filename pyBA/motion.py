@@ -0,0 +1,107 @@
+"""Provides proper motion fitting for pyBA: linear fits of position
+against time to the mapped positions of objects over many epochs.
+"""
+
+import numpy as np
+from pyBA.classes import _inv2
+
+
+def _fit(tau, xy, W, use):
+    """ Weighted least-squares fits of xy = x0 + v tau for each object,
+    over the epochs in use.
+
+    Output: parameters (K x 4; x0, y0, vx, vy), their covariance matrices
+            (K x 4 x 4) and the chi^2 of each epoch (K x N)
+    """
+    K, N = use.shape
+    W = W * use[:,:,None,None]
+
+    # Normal equations, from the design matrix [I, tau I] of each epoch
+    Wsum = W.sum(axis=1)
+    Wt = np.einsum('n,knij->kij', tau, W)
+    Wtt = np.einsum('n,knij->kij', tau**2, W)
+    Wx = np.einsum('knij,knj->ki', W, xy)
+    Wtx = np.einsum('n,knij,knj->ki', tau, W, xy)
+
+    F = np.empty( (K, 4, 4) )
+    F[:,0:2,0:2] = Wsum
+    F[:,0:2,2:4] = Wt
+    F[:,2:4,0:2] = Wt
+    F[:,2:4,2:4] = Wtt
+    b = np.concatenate([ Wx, Wtx ], axis=1)
+
+    # Objects without two distinct epochs are left undetermined
+    p = np.zeros( (K, 4) ) + np.nan
+    cov = np.zeros( (K, 4, 4) ) + np.nan
+    nt = use.sum(axis=1)
+    tmean = np.where(nt > 0, use.dot(tau) / np.maximum(nt, 1), 0.)
+    spread = (use * (tau - tmean[:,None])**2).sum(axis=1)
+    ok = (nt >= 2) & (spread > 0)
+    if np.any(ok):
+        cov[ok] = np.linalg.inv(F[ok])
+        p[ok] = np.einsum('kij,kj->ki', cov[ok], b[ok])
+
+    r = xy - p[:,None,0:2] - tau[None,:,None] * p[:,None,2:4]
+    chi2 = np.einsum('kni,knij,knj->kn', r, W, r)
+
+    return p, cov, chi2
+
+def proper_motion(t, xy, sigma, t0=None, nsigma=5., maxreject=3):
+    """ Fits positions linearly in time, x(t) = x0 + v (t - t0), for K
+    objects observed at N epochs, using the full 2x2 covariance of each
+    position. The fits for all objects are solved at once.
+
+    Epochs whose residual exceeds nsigma (in chi^2 with two degrees of
+    freedom, nsigma^2) are flagged as outliers and the fit repeated
+    without them, rejecting at most one epoch per object per iteration,
+    and at most maxreject in all.
+
+    Input: t - N observation times
+           xy - K x N x 2 positions (NaN where an object is not measured),
+                e.g. from store.Mapstore.regress
+           sigma - K x N x 2 x 2 covariance matrices of positions
+           t0 - reference time (default: mean of t)
+    Output: x0 (K x 2) position at t0, v (K x 2) proper motion (per unit
+            of t), cov (K x 4 x 4) covariance of (x0, y0, vx, vy), chi2 (K)
+            over epochs used, ndof (K) degrees of freedom, and outlier
+            flags (K x N). Objects without two epochs give NaN (with
+            ndof 0).
+    """
+    t = np.asarray(t, dtype=float)
+    xy = np.asarray(xy, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    if xy.shape[1:] != (len(t), 2) or sigma.shape != xy.shape + (2,):
+        raise ValueError('Positions and covariances should be K x N x 2 and K x N x 2 x 2')
+
+    if t0 is None:
+        t0 = np.mean(t)
+    tau = t - t0
+
+    # Epochs at which each object is measured
+    valid = np.all(np.isfinite(xy), axis=2) & np.all(np.isfinite(sigma), axis=(2,3))
+    xy = np.where(valid[:,:,None], xy, 0.)
+    sigma = np.where(valid[:,:,None,None], sigma, np.eye(2))
+    W = _inv2(sigma)
+
+    flags = np.zeros(valid.shape, dtype=bool)
+    for i in range(maxreject + 1):
+        use = valid & ~flags
+        p, cov, chi2 = _fit(tau, xy, W, use)
+        if i == maxreject:
+            break
+
+        # Flag the worst epoch of each object, if it is an outlier (and
+        #  enough epochs would remain to fit)
+        worst = np.argmax(np.where(use, chi2, -1.), axis=1)
+        k = np.arange(len(xy))
+        bad = (chi2[k,worst] > nsigma**2) & (use.sum(axis=1) > 2)
+        if not np.any(bad):
+            break
+        flags[k[bad],worst[bad]] = True
+
+    use = valid & ~flags
+    n = use.sum(axis=1)
+    ndof = np.where(n >= 2, 2*n - 4, 0)
+    chi2 = np.where(n >= 2, np.sum(np.where(use, chi2, 0.), axis=1), np.nan)
+
+    return p[:,0:2], p[:,2:4], cov, chi2, ndof, flags
@@ -0,0 +1,393 @@
+"""Provides catalogue input and output for pyBA.
+
+Tie lists are held as columnar (n x 10) arrays, one row per tie, laid out
+as in the example astrom_match_stats file:
+
+    xA yA sxxA syyA sxyA xB yB sxxB syyB sxyB
+
+i.e. the centre and (variance, variance, covariance) of the object in
+each frame. These can be written once to disk and memory-mapped back, so
+that background.MAP can stream over tie lists that do not fit in memory.
+"""
+
+import numpy as np
+from pyBA.classes import Bivarg
+
+NCOLS = 10
+TIE_COLUMNS = ('xA', 'yA', 'sxxA', 'syyA', 'sxyA', 'xB', 'yB', 'sxxB', 'syyB', 'sxyB')
+
+# On-disk format of conditioned astrometric maps (see write_map)
+MAP_FORMAT = 'pyBA-amap'
+MAP_VERSION = 1
+
+# Layout of the binary sidecar caches of parsed match files (see read_match)
+MATCH_CACHE_VERSION = 2
+
+
+def ties_from_objects(A, B):
+    """ Packs two lists (or nparrays) of Bivargs, of equal length, into a
+    columnar tie array.
+    """
+    T = np.empty((len(A), NCOLS))
+    for cols, objects in ((slice(0, 5), A), (slice(5, 10), B)):
+        mu = np.array([o.mu for o in objects], dtype=float)
+        sigma = np.array([o.sigma for o in objects], dtype=float)
+        T[:,cols] = np.column_stack([ mu, sigma[:,0,0], sigma[:,1,1], sigma[:,0,1] ])
+
+    return T
+
+def objects_from_ties(T):
+    """ Unpacks a columnar tie array into two nparrays of Bivargs.
+    """
+    A = np.array([ Bivarg(mu=t[0:2], sigma=t[2:5]) for t in T ])
+    B = np.array([ Bivarg(mu=t[5:7], sigma=t[7:10]) for t in T ])
+
+    return A, B
+
+def tie_arrays(T):
+    """ Unpacks a columnar tie array into arrays of centres (n x 2) and
+    covariance matrices (n x 2 x 2) for the objects in each frame.
+
+    Output: muA, sigmaA, muB, sigmaB
+    """
+    T = np.asarray(T, dtype=float)
+    if T.ndim != 2 or T.shape[1] != NCOLS:
+        raise ValueError('Tie array should have shape (n, %d)' % NCOLS)
+
+    out = []
+    for c in (0, 5):
+        mu = T[:,c:c+2]
+        sigma = np.empty((len(T), 2, 2))
+        sigma[:,0,0] = T[:,c+2]
+        sigma[:,1,1] = T[:,c+3]
+        sigma[:,0,1] = T[:,c+4]
+        sigma[:,1,0] = T[:,c+4]
+        out += [mu, sigma]
+
+    return tuple(out)
+
+def _header_value(v):
+    """ Interprets a header value as an integer, a float, a tuple of
+    floats (if comma-separated) or otherwise a string.
+    """
+    v = v.strip()
+    for convert in (int, float):
+        try:
+            return convert(v)
+        except ValueError:
+            pass
+    if ',' in v:
+        try:
+            return tuple(float(x) for x in v.split(','))
+        except ValueError:
+            pass
+    return v
+
+def _parse_match(lines):
+    """ Parses the lines of a match file into a header dictionary and a
+    record array (see read_match).
+    """
+    header = {}
+    i = 0
+    while i < len(lines) and (lines[i].startswith('#') or not lines[i].strip()):
+        h = lines[i][1:]
+        if ':' in h:
+            key, value = h.split(':', 1)
+            header[key.strip()] = _header_value(value)
+        i += 1
+
+    # Column names, if given on the first line after the header
+    first = lines[i] if i < len(lines) else ''
+    delimiter = ',' if ',' in first else None
+    tokens = first.strip().split(delimiter)
+    try:
+        [ float(x) for x in tokens ]
+        names = None
+    except ValueError:
+        names = [ x.strip() for x in tokens ]
+        i += 1
+        tokens = lines[i].strip().split(delimiter) if i < len(lines) else []
+
+    if names is None:
+        ncols = len(tokens)
+        names = list(TIE_COLUMNS) if ncols == NCOLS else [ 'c%d' % j for j in range(ncols) ]
+
+    # Integer columns (e.g. object IDs, which need all 64 bits) are those
+    #  written without a decimal point or exponent in every row. Columns
+    #  that look so in the first row are read as text and checked.
+    dtype = []
+    for j, name in enumerate(names):
+        isint = j < len(tokens) and tokens[j].strip().lstrip('+-').isdigit()
+        dtype.append( (name, 'U64' if isint else np.float64) )
+
+    data = np.loadtxt(lines[i:], dtype=dtype, delimiter=delimiter, comments='#', ndmin=1)
+
+    columns = []
+    for name, t in dtype:
+        col = data[name]
+        if t != np.float64:
+            col = np.char.strip(col)
+            try:
+                col = col.astype(np.int64)
+            except ValueError:
+                col = col.astype(np.float64)
+        columns.append(col)
+
+    return header, np.rec.fromarrays(columns, names=names)
+
+def _source_id(fname):
+    """ Size, modification time and SHA-1 digest of a file. """
+    import os, hashlib
+
+    st = os.stat(fname)
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return st.st_size, st.st_mtime, h.hexdigest()
+
+def _load_match(f):
+    """ Header dictionary and record array of a match file in binary
+    (.npz) form, as written by write_match or kept as a cache.
+    """
+    import json
+
+    header = dict( (k, tuple(v) if isinstance(v, list) else v)
+                   for k, v in json.loads(str(f['header'])).items() )
+
+    return header, f['data'].view(np.recarray)
+
+def _write_cache(cname, header, data, source):
+    """ Keeps a parsed match file in a binary sidecar cache. """
+    import json
+
+    source = dict(source, version=MATCH_CACHE_VERSION)
+    try:
+        with open(cname, 'wb') as f:
+            np.savez(f, data=np.asarray(data), header=np.array(json.dumps(header)),
+                     source=np.array(json.dumps(source)))
+    except (IOError, OSError):
+        # Caching is an optimisation only, e.g. for read-only directories
+        pass
+
+def read_match(fname, cache=True):
+    """ Reads a match file, i.e. a text catalogue of tie objects with '#'
+    header lines of 'key: value' metadata, an optional line of comma-
+    separated column names, and one row per tie (comma- or whitespace-
+    separated). Files without column names and with ten columns (e.g. the
+    example astrom_match_stats file) take their names from TIE_COLUMNS.
+
+    If cache is True, the parsed file is kept in a binary sidecar file
+    (fname + '.cache.npz'), which is used instead of parsing the text
+    again for as long as the file's size and modification time, or
+    otherwise its content, are unchanged. Caches written by other
+    versions of the cache layout (MATCH_CACHE_VERSION) are replaced.
+
+    Match files written in binary form by write_match are read directly.
+
+    Input: fname - path to match file, or file-like object (not cached)
+    Output: header dictionary and record array of columns
+    """
+    import os, json
+
+    if hasattr(fname, 'read'):
+        return _parse_match(fname.read().splitlines())
+
+    with open(fname, 'rb') as f:
+        binary = f.read(4) == b'PK\x03\x04'
+    if binary:
+        with np.load(fname) as f:
+            return _load_match(f)
+
+    cname = fname + '.cache.npz'
+    st = os.stat(fname)
+    if cache and os.path.exists(cname):
+        touched = None
+        with np.load(cname) as f:
+            source = json.loads(str(f['source']))
+            if source.get('version') == MATCH_CACHE_VERSION and source['size'] == st.st_size:
+                if source['mtime'] == st.st_mtime:
+                    return _load_match(f)
+                size, mtime, digest = _source_id(fname)
+                if source['sha1'] == digest:
+                    touched = _load_match(f)
+        if touched is not None:
+            # Same content with a new modification time: record the new
+            #  time, so that the content need not be hashed next time
+            _write_cache(cname, touched[0], touched[1],
+                         {'size': size, 'mtime': mtime, 'sha1': digest})
+            return touched
+
+    with open(fname) as f:
+        header, data = _parse_match(f.read().splitlines())
+
+    if cache:
+        size, mtime, digest = _source_id(fname)
+        _write_cache(cname, header, data, {'size': size, 'mtime': mtime, 'sha1': digest})
+
+    return header, data
+
+def _format_value(v):
+    """ Formats a header value as read back by _header_value. """
+    if isinstance(v, tuple):
+        return ', '.join('%f' % x for x in v)
+    if isinstance(v, (int, np.integer)):
+        return '%i' % v
+    if isinstance(v, (float, np.floating)):
+        return '%f' % v
+    return str(v)
+
+def _json_value(v):
+    """ Converts numpy scalars for JSON encoding. """
+    return int(v) if isinstance(v, np.integer) else float(v)
+
+def write_match(fname, header, data, binary=False):
+    """ Writes a match file that can be read with read_match.
+
+    The header is written as '#' lines of 'key: value', in order, with
+    comment lines for keys whose value is None, followed by the column
+    names and one comma-separated row per tie (integer columns in full,
+    others with %f). If binary is True, the file is instead written as an
+    .npz archive of the columns and header, which read_match reads without
+    parsing. The file is written beside fname and then moved into place,
+    so that a match file that exists is complete.
+
+    Input: fname - path of match file
+           header - sequence of (key, value) pairs (or dictionary); values
+                    are numbers, tuples of floats or strings
+           data - record (or structured) array of columns
+    """
+    import os, json
+
+    if isinstance(header, dict):
+        header = sorted(header.items())
+    data = np.asarray(data)
+
+    if binary:
+        meta = dict( (k, v) for k, v in header if v is not None )
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, data=data, header=np.array(json.dumps(meta, default=_json_value)))
+        os.rename(fname + '.tmp', fname)
+        return
+
+    lines = [ '# %s' % k if v is None else '# %s: %s' % (k, _format_value(v))
+              for k, v in header ]
+    names = data.dtype.names
+    fmt = [ '%i' if data.dtype[n].kind in 'iu' else '%f' for n in names ]
+
+    with open(fname + '.tmp', 'w') as f:
+        f.write(''.join(l + '\n' for l in lines))
+        np.savetxt(f, data, fmt=fmt, delimiter=',', header=','.join(names), comments='')
+    os.rename(fname + '.tmp', fname)
+
+def ties_from_match(data):
+    """ Gathers the columns of a match file (see read_match) into a
+    columnar tie array. Files of SDSS matches (master_dra, master_ddec,
+    master_raerr, ..., dra, ddec, raerr, ...) give ties between the master
+    catalogue (frame A) and the epoch (frame B).
+    """
+    names = data.dtype.names
+    if 'master_dra' in names:
+        cols = []
+        for pre in ('master_', ''):
+            cols += [ data[pre + 'dra'], data[pre + 'ddec'], data[pre + 'raerr'],
+                      data[pre + 'decerr'] ]
+            cols.append( data[pre + 'radeccov'] if pre + 'radeccov' in names
+                         else np.zeros(len(data)) )
+    elif all(c in names for c in TIE_COLUMNS):
+        cols = [ data[c] for c in TIE_COLUMNS ]
+    else:
+        raise ValueError('Match file columns are not recognised as ties')
+
+    return np.column_stack(cols).astype(float)
+
+def write_ties(fname, T):
+    """ Writes a columnar tie array to a .npy file that can later be
+    memory-mapped with read_ties.
+    """
+    T = np.asarray(T, dtype=float)
+    if T.ndim != 2 or T.shape[1] != NCOLS:
+        raise ValueError('Tie array should have shape (n, %d)' % NCOLS)
+
+    np.save(fname, T)
+
+def read_ties(fname, mmap_mode='r'):
+    """ Opens a tie array written by write_ties. By default the file is
+    memory-mapped rather than read into memory.
+    """
+    return np.load(fname, mmap_mode=mmap_mode)
+
+def write_map(path, D):
+    """ Writes a conditioned astrometric map (Amap object) to a directory
+    of raw arrays, which read_map can memory-map back.
+
+    Only what regression needs is stored: the tie array, the weighted
+    residuals (alpha) and triangular factor of the data covariance (with
+    the unused triangle zeroed), the hyperparameters and the background
+    mapping. The directory holds a
+    header (header.json) and one .npy file per array. It is written
+    beside path and then moved into place, replacing any map there.
+    """
+    import os, json, shutil
+
+    alpha = D._weights()
+    c, lower = D.chol
+
+    path = os.path.normpath(path)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    T = D.ties if D.A is None else ties_from_objects(D.A, D.B)
+    np.save(os.path.join(tmp, 'ties.npy'), T)
+    np.save(os.path.join(tmp, 'alpha.npy'), alpha)
+    np.save(os.path.join(tmp, 'chol.npy'), np.tril(c) if lower else np.triu(c))
+    np.save(os.path.join(tmp, 'P_mu.npy'), D.P.mu)
+    np.save(os.path.join(tmp, 'P_sigma.npy'), D.P.sigma)
+
+    header = {'format': MAP_FORMAT, 'version': MAP_VERSION,
+              'nties': len(alpha) // 2, 'lower': bool(lower),
+              'scale': float(D.scale), 'amp': np.asarray(D.amp, dtype=float).tolist()}
+    with open(os.path.join(tmp, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def read_map(path, mmap_mode='r'):
+    """ Opens an astrometric map written by write_map, as an Amap object.
+    By default the arrays are memory-mapped, so that opening a map is
+    quick and a query reads only the arrays it needs.
+
+    The tie objects are not rebuilt on opening (A and B are None; the tie
+    array is kept as D.ties); methods that need them (e.g. condition,
+    to_surrogate and the draw_ methods) rebuild them when first called.
+    """
+    import os, json
+    from pyBA.classes import Amap, Bgmap
+
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != MAP_FORMAT:
+        raise ValueError('%s is not a pyBA map' % path)
+    if header.get('version') != MAP_VERSION:
+        raise ValueError('Unsupported pyBA map version %s' % header.get('version'))
+
+    load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    D = Amap.__new__(Amap)
+    D.P = Bgmap(mu=np.array(load('P_mu')), sigma=np.array(load('P_sigma')))
+    D.A = D.B = None
+    D.ties = load('ties')
+    D.xyarr = D.ties[:,0:2]
+    D.scale = header['scale']
+    D.amp = np.array(header['amp'])
+    D.hyperparams = {'scale': D.scale, 'amp': D.amp}
+    D.d2 = D.C = D.V = None
+    D.chol = (load('chol'), header['lower'])
+    D.alpha = load('alpha')
+
+    return D
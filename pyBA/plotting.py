@@ -159,22 +159,21 @@ def draw_realisation(objectsA, objectsB, P, scale, amp, chol, res = 30):
 
     # Grid for regression
     x,y = make_grid(objectsA,res=res)
-    xyarr = np.array([x.flatten(),y.flatten()]).T
 
     # If no cholesky matrix A provided, assume that we are
     #  drawing realisation on grid without using observed data
-    if chol == None:
+    if chol is None:
         
-        from pyBA.distortion import realise
-        vx, vy = realise(xyarr, P, scale, amp)
+        from pyBA.distortion import realise_grid
+        vx, vy = realise_grid(x[0], y[:,0], P, scale, amp)
         sx, sy = None, None
 
     # Otherwise, use cholesky data to perform regression
     else:
 
-        from pyBA.distortion import regression
-        vx, vy, sx, sy = regression(objectsA, objectsB, xyarr, P, 
-                                    scale, amp, chol)
+        from pyBA.distortion import regression_grid
+        vx, vy, sx, sy = regression_grid(objectsA, objectsB, x[0], y[:,0], P, 
+                                         scale, amp, chol)
 
     # Get xy coordinates of base of vectors
     from pyBA.distortion import compute_displacements
@@ -0,0 +1,172 @@
+"""Provides sky projections for pyBA: mappings between celestial
+coordinates (ra, dec) and the tangent plane of an image.
+
+Positions on the sky are in degrees. Tangent-plane coordinates (xi, eta)
+are offsets from the tangent point in units of 1/units degrees (by
+default, arcseconds), with xi increasing with ra and eta with dec.
+
+Covariances on the sky are of local offsets (ra cos(dec), dec), in the
+same units as the tangent plane, as catalogue uncertainties usually are.
+"""
+
+import numpy as np
+from pyBA.classes import _inv2
+
+def _forward(ra, dec, ra0, dec0, jacobian=False):
+    """ Gnomonic projection of positions (radians) about (ra0, dec0).
+
+    Output: xi, eta (radians) and, if jacobian is True, the derivatives
+            (n x 2 x 2) of (xi, eta) with respect to (ra cos(dec), dec)
+    """
+    dra = ra - ra0
+    sdra, cdra = np.sin(dra), np.cos(dra)
+    sd, cd = np.sin(dec), np.cos(dec)
+    sd0, cd0 = np.sin(dec0), np.cos(dec0)
+
+    D = sd0*sd + cd0*cd*cdra
+    Nxi = cd*sdra
+    Neta = cd0*sd - sd0*cd*cdra
+    xi = Nxi / D
+    eta = Neta / D
+    if not jacobian:
+        return xi, eta
+
+    # Derivatives of numerators and denominator by ra and dec
+    dD_ra = -cd0*cd*sdra
+    dD_dec = sd0*cd - cd0*sd*cdra
+    J = np.empty(ra.shape + (2, 2))
+    J[...,0,0] = (cd*cdra*D - Nxi*dD_ra) / (D*D*cd)
+    J[...,0,1] = (-sd*sdra*D - Nxi*dD_dec) / (D*D)
+    J[...,1,0] = (sd0*cd*sdra*D - Neta*dD_ra) / (D*D*cd)
+    J[...,1,1] = ((cd0*cd + sd0*sd*cdra)*D - Neta*dD_dec) / (D*D)
+
+    return xi, eta, J
+
+def _inverse(xi, eta, ra0, dec0):
+    """ Inverse gnomonic projection of tangent-plane positions (radians)
+    about (ra0, dec0).
+
+    Output: ra, dec (radians)
+    """
+    sd0, cd0 = np.sin(dec0), np.cos(dec0)
+    x = cd0 - eta*sd0
+    ra = ra0 + np.arctan2(xi, x)
+    dec = np.arctan2(sd0 + eta*cd0, np.hypot(xi, x))
+
+    return ra, dec
+
+def _congruence(J, S):
+    """ Products J S J^T of arrays (... x 2 x 2) of 2x2 matrices, for
+    symmetric S.
+    """
+    a, b, c, d = J[...,0,0], J[...,0,1], J[...,1,0], J[...,1,1]
+    s00, s01, s11 = S[...,0,0], S[...,0,1], S[...,1,1]
+    out = np.empty(S.shape)
+    out[...,0,0] = a*a*s00 + 2.*a*b*s01 + b*b*s11
+    out[...,1,1] = c*c*s00 + 2.*c*d*s01 + d*d*s11
+    out[...,0,1] = a*c*s00 + (a*d + b*c)*s01 + b*d*s11
+    out[...,1,0] = out[...,0,1]
+    return out
+
+def _chunks(n, chunk):
+    """ Slices of at most chunk rows covering n rows. """
+    return [ slice(i, min(i + chunk, n)) for i in range(0, n, chunk) ]
+
+def _columns(a, b, sigma):
+    """ Checks and flattens pairs of coordinate columns (and covariances). """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if a.shape != b.shape:
+        raise ValueError('Coordinate arrays should have the same shape')
+    if sigma is not None:
+        sigma = np.asarray(sigma, dtype=float)
+        if sigma.shape != a.shape + (2, 2):
+            raise ValueError('Covariances should have shape %s' % (a.shape + (2, 2),))
+        sigma = sigma.reshape(-1, 2, 2)
+
+    return a.ravel(), b.ravel(), sigma
+
+def jacobian(ra, dec, centre):
+    """ Derivatives of tangent-plane coordinates (xi, eta) with respect to
+    local offsets on the sky (ra cos(dec), dec), for the gnomonic
+    projection about centre. These are dimensionless, and the identity
+    at the tangent point.
+
+    Input: ra, dec - positions (degrees)
+           centre - tangent point (ra0, dec0) (degrees)
+    Output: array (... x 2 x 2) of Jacobian matrices
+    """
+    shape = np.shape(ra)
+    ra, dec, _ = _columns(ra, dec, None)
+    J = _forward(np.radians(ra), np.radians(dec), np.radians(centre[0]),
+                 np.radians(centre[1]), jacobian=True)[2]
+
+    return J.reshape(shape + (2, 2))
+
+def gnomonic(ra, dec, centre, sigma=None, units=3600., chunk=2**20):
+    """ Projects positions on the sky onto the tangent plane about centre,
+    exactly (the gnomonic or TAN projection), and maps their covariances
+    through the Jacobian of the projection.
+
+    Arrays are processed in blocks of chunk rows, to bound the size of
+    temporary arrays.
+
+    Input: ra, dec - positions (degrees); arrays of the same shape
+           centre - tangent point (ra0, dec0) (degrees)
+           sigma - covariances (... x 2 x 2) of local offsets on the sky
+                   (see module docstring), optional
+           units - tangent-plane units per degree (default, arcsec)
+    Output: xi, eta and, if sigma is given, their covariances
+    """
+    shape = np.shape(ra)
+    ra, dec, sigma = _columns(ra, dec, sigma)
+    ra0, dec0 = np.radians(centre[0]), np.radians(centre[1])
+    scale = np.degrees(1.) * units
+
+    xi = np.empty(len(ra))
+    eta = np.empty(len(ra))
+    S = None if sigma is None else np.empty(sigma.shape)
+    for s in _chunks(len(ra), chunk):
+        out = _forward(np.radians(ra[s]), np.radians(dec[s]), ra0, dec0,
+                       jacobian=sigma is not None)
+        xi[s] = out[0] * scale
+        eta[s] = out[1] * scale
+        if sigma is not None:
+            J = out[2]
+            S[s] = _congruence(J, sigma[s])
+
+    if sigma is None:
+        return xi.reshape(shape), eta.reshape(shape)
+    return xi.reshape(shape), eta.reshape(shape), S.reshape(shape + (2, 2))
+
+def gnomonic_inverse(xi, eta, centre, sigma=None, units=3600., chunk=2**20):
+    """ Maps tangent-plane positions about centre back onto the sky: the
+    inverse of gnomonic. Covariances are mapped through the inverse of its
+    Jacobian.
+
+    Input: xi, eta - tangent-plane positions (1/units degrees)
+           centre - tangent point (ra0, dec0) (degrees)
+           sigma - covariances (... x 2 x 2) of (xi, eta), optional
+           units - tangent-plane units per degree (default, arcsec)
+    Output: ra, dec (degrees; ra in [0, 360)) and, if sigma is given,
+            covariances of local offsets on the sky
+    """
+    shape = np.shape(xi)
+    xi, eta, sigma = _columns(xi, eta, sigma)
+    ra0, dec0 = np.radians(centre[0]), np.radians(centre[1])
+    scale = np.degrees(1.) * units
+
+    ra = np.empty(len(xi))
+    dec = np.empty(len(xi))
+    S = None if sigma is None else np.empty(sigma.shape)
+    for s in _chunks(len(xi), chunk):
+        a, d = _inverse(xi[s] / scale, eta[s] / scale, ra0, dec0)
+        ra[s] = np.degrees(a) % 360.
+        dec[s] = np.degrees(d)
+        if sigma is not None:
+            K = _inv2(_forward(a, d, ra0, dec0, jacobian=True)[2])
+            S[s] = _congruence(K, sigma[s])
+
+    if sigma is None:
+        return ra.reshape(shape), dec.reshape(shape)
+    return ra.reshape(shape), dec.reshape(shape), S.reshape(shape + (2, 2))
@@ -0,0 +1,166 @@
+"""Provides image registration for pyBA: resampling of images between
+image frames through an astrometric mapping.
+
+Pixel (row, col) of an image is taken to lie at (x, y) = (x0 + s*col,
+y0 + s*row) in the coordinates of the tie objects used to fit the
+mapping, for a frame given as the triple (x0, y0, s).
+"""
+
+import numpy as np
+from pyBA.classes import Surrogate, _transform
+
+
+# Mapping and resampling parameters, set per worker process
+_state = {}
+
+def _init(mapping, frameA, frameB, order, cval):
+    """ Sets the mapping and resampling parameters for a worker. """
+    _state.update(mapping=mapping, frameA=frameA, frameB=frameB,
+                  order=order, cval=cval)
+
+def _map(mapping, xy):
+    """ Maps locations xy (n x 2) from frame B to frame A through a
+    Surrogate or (background only) a Bgmap.
+    """
+    if isinstance(mapping, Surrogate):
+        return mapping.mean(xy)
+    else:
+        return _transform(xy, None, mapping)[0]
+
+def _window(box, shape):
+    """ Bounding box (r0, r1, c0, c1), in pixels of the image in frame A,
+    of the source pixels needed to resample the output pixels in box.
+    """
+    mapping = _state['mapping']
+    x0, y0, s = _state['frameB']
+    xA0, yA0, sA = _state['frameA']
+
+    # The background mapping is affine, so the corners of the box bound
+    #  its image; widen this by the largest residual displacement (the
+    #  spline coefficients bound the interpolated values) and the
+    #  footprint of the interpolation kernel.
+    r0, r1, c0, c1 = box
+    corners = np.array([ [x0 + s*c, y0 + s*r] for r in (r0, r1-1) for c in (c0, c1-1) ])
+    if isinstance(mapping, Surrogate):
+        xy = _transform(corners, None, mapping.P)[0]
+        margin = np.abs(mapping.tables[:2]).max() / sA
+    else:
+        xy = _transform(corners, None, mapping)[0]
+        margin = 0.
+    margin += _state['order'] + 2
+
+    cols = (xy[:,0] - xA0) / sA
+    rows = (xy[:,1] - yA0) / sA
+    w = [ int(np.floor(rows.min() - margin)), int(np.ceil(rows.max() + margin)) + 1,
+          int(np.floor(cols.min() - margin)), int(np.ceil(cols.max() + margin)) + 1 ]
+
+    return ( min(max(w[0], 0), shape[0]), min(max(w[1], 0), shape[0]),
+             min(max(w[2], 0), shape[1]), min(max(w[3], 0), shape[1]) )
+
+def _warp_tile(window, wbox, box):
+    """ Resamples the source pixels window (which lie at wbox in the
+    image in frame A) onto the output pixels box.
+    """
+    from scipy.ndimage import map_coordinates
+
+    x0, y0, s = _state['frameB']
+    xA0, yA0, sA = _state['frameA']
+
+    r0, r1, c0, c1 = box
+    if window.size == 0:
+        return np.zeros( (r1 - r0, c1 - c0) ) + _state['cval']
+
+    rows, cols = np.mgrid[r0:r1, c0:c1]
+    xy = np.array([ x0 + s*cols.ravel(), y0 + s*rows.ravel() ]).T
+    xy = _map(_state['mapping'], xy)
+
+    coords = np.array([ (xy[:,1] - yA0) / sA - wbox[0],
+                        (xy[:,0] - xA0) / sA - wbox[2] ])
+    vals = map_coordinates(window, coords, order=_state['order'],
+                           mode='constant', cval=_state['cval'])
+
+    return vals.reshape( (r1 - r0, c1 - c0) )
+
+def _tiles(shape, tile):
+    """ Iterates over boxes (r0, r1, c0, c1) tiling an array of given shape. """
+    for r in range(0, shape[0], tile):
+        for c in range(0, shape[1], tile):
+            yield (r, min(r + tile, shape[0]), c, min(c + tile, shape[1]))
+
+def warp(image, D, shape=None, out=None, frameA=(0., 0., 1.), frameB=(0., 0., 1.),
+         control=32, tile=512, order=1, cval=np.nan, nproc=1):
+    """ Resamples an image in frame A onto the pixels of frame B, through
+    an astrometric mapping from frame B to frame A.
+
+    The mapping is tabulated on a coarse control grid spanning the output
+    image, interpolated to every output pixel, and the image resampled
+    tile by tile; only the part of the input image needed for a tile is
+    read at once, so memory-mapped inputs and outputs may be larger than
+    memory.
+
+    Input: image - 2-d array (or np.memmap) in frame A
+           D - Amap (conditioned), Surrogate covering the output frame, or
+               Bgmap (background mapping only)
+           shape - shape of output image (default: that of input)
+           out - array (or np.memmap) for output; created if not given
+           frameA, frameB - (x0, y0, pixel scale) of the image frames
+           control - resolution of control grid used for an Amap
+           tile - side of square output tiles, in pixels
+           order - order of spline interpolation of image
+           cval - value for output pixels mapping outside the input image
+           nproc - number of worker processes over which to spread tiles
+    Output: resampled image
+    """
+    if shape is None:
+        shape = image.shape if out is None else out.shape
+    if out is None:
+        out = np.empty(shape)
+    elif out.shape != tuple(shape):
+        raise ValueError('Output array does not have the requested shape')
+
+    # Tabulate an Amap (its mapping only) on a control grid spanning the
+    #  output image
+    if D.__class__.__name__ == 'Amap':
+        x0, y0, s = frameB
+        bounds = (x0, x0 + s*(shape[1] - 1), y0, y0 + s*(shape[0] - 1))
+        D = D.to_surrogate(res=control, bounds=bounds, ncheck=0, uncertainty=False)
+    elif D.__class__.__name__ not in ('Surrogate', 'Bgmap'):
+        raise TypeError('Mapping should be an Amap, Surrogate or Bgmap object')
+
+    args = (D, tuple(frameA), tuple(frameB), order, cval)
+    _init(*args)
+
+    if nproc == 1:
+        for box in _tiles(shape, tile):
+            wbox = _window(box, image.shape)
+            window = np.asarray(image[wbox[0]:wbox[1], wbox[2]:wbox[3]], dtype=float)
+            out[box[0]:box[1], box[2]:box[3]] = _warp_tile(window, wbox, box)
+
+    else:
+        from multiprocessing import Pool
+        from collections import deque
+
+        pool = Pool(nproc, initializer=_init, initargs=args)
+        try:
+            # Keep a bounded number of tiles in flight
+            pending = deque()
+            for box in _tiles(shape, tile):
+                wbox = _window(box, image.shape)
+                window = np.asarray(image[wbox[0]:wbox[1], wbox[2]:wbox[3]], dtype=float)
+                pending.append( (box, pool.apply_async(_warp_tile, (window, wbox, box))) )
+
+                while len(pending) >= 2*nproc:
+                    b, result = pending.popleft()
+                    out[b[0]:b[1], b[2]:b[3]] = result.get()
+
+            while pending:
+                b, result = pending.popleft()
+                out[b[0]:b[1], b[2]:b[3]] = result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    if hasattr(out, 'flush'):
+        out.flush()
+
+    return out
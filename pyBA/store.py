@@ -0,0 +1,432 @@
+"""Provides storage for pyBA: collections of conditioned astrometric maps
+for many epochs of observation of a field.
+"""
+
+import os
+import json
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def _regress_epoch(D, xy, sigma):
+    """ Maps locations xy (n x 2) with covariances sigma (n x 2 x 2)
+    through the map D. Locations that are not finite give NaN output.
+    """
+    mu = np.zeros( (len(xy), 2) ) + np.nan
+    S = np.zeros( (len(xy), 2, 2) ) + np.nan
+
+    ok = np.all(np.isfinite(xy), axis=1) & np.all(np.isfinite(sigma), axis=(1,2))
+    if np.any(ok):
+        mu[ok], S[ok] = D.query(xy[ok], sigma[ok])
+
+    return mu, S
+
+# Maps opened by this (worker) process, by path
+_worker_maps = {}
+
+def _regress_task(task):
+    """ Runs _regress_epoch in a worker process, opening each map once. """
+    from pyBA.parse import read_map
+
+    path, xy, sigma = task
+    if path not in _worker_maps:
+        _worker_maps[path] = read_map(path)
+
+    return _regress_epoch(_worker_maps[path], xy, sigma)
+
+class Mapstore(object):
+    """ A directory of conditioned astrometric maps (see parse.write_map),
+    one per epoch, indexed by run ID and observation time.
+
+    The index is kept in index.json in the directory, with any further
+    information about each epoch given when it was added.
+    """
+
+    def __init__(self, root):
+        """ Opens the store in directory root, creating it if needed. """
+        self.root = root
+        self._maps = {}
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        fname = os.path.join(root, 'index.json')
+        if os.path.exists(fname):
+            with open(fname) as f:
+                index = json.load(f)
+            if index.get('version') != STORE_VERSION:
+                raise ValueError('Unsupported map store version %s' % index.get('version'))
+            self.epochs = index['epochs']
+        else:
+            self.epochs = []
+
+        return
+
+    def _write_index(self):
+        fname = os.path.join(self.root, 'index.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump({'version': STORE_VERSION, 'epochs': self.epochs}, f, indent=1)
+        os.rename(fname + '.tmp', fname)
+
+    def _entry(self, runid):
+        for e in self.epochs:
+            if e['runid'] == runid:
+                return e
+        raise KeyError('Run %s is not in the map store' % (runid,))
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __contains__(self, runid):
+        return any(e['runid'] == runid for e in self.epochs)
+
+    def __getitem__(self, runid):
+        """ The map (Amap object, memory-mapped) for a run. """
+        if runid not in self._maps:
+            from pyBA.parse import read_map
+            self._maps[runid] = read_map(self.path(runid))
+        return self._maps[runid]
+
+    def add(self, runid, time, D, **info):
+        """ Adds (or replaces) the map D (a conditioned Amap object) for
+        the run runid, observed at the given time. Further keyword
+        arguments are kept in the index, and must be serialisable as JSON.
+        """
+        if runid in self:
+            self.remove(runid)
+
+        path = 'run%s' % (runid,)
+        D.save(os.path.join(self.root, path))
+
+        self.epochs.append({'runid': runid, 'time': float(time), 'path': path, 'info': info})
+        self.epochs.sort(key=lambda e: e['time'])
+        self._write_index()
+
+    def remove(self, runid):
+        """ Removes the map for a run. """
+        import shutil
+
+        e = self._entry(runid)
+        self.epochs.remove(e)
+        self._maps.pop(runid, None)
+        self._write_index()
+        shutil.rmtree(os.path.join(self.root, e['path']), ignore_errors=True)
+
+    def update(self, runid, **info):
+        """ Adds to (or replaces items of) the further information kept
+        for a run.
+        """
+        self._entry(runid)['info'].update(info)
+        self._write_index()
+
+    def path(self, runid):
+        """ Directory holding the map for a run. """
+        return os.path.join(self.root, self._entry(runid)['path'])
+
+    def info(self, runid):
+        """ Further information given when the map for a run was added. """
+        return self._entry(runid)['info']
+
+    @property
+    def runids(self):
+        """ Run IDs, in order of observation time. """
+        return [ e['runid'] for e in self.epochs ]
+
+    @property
+    def times(self):
+        """ Observation times, in order. """
+        return np.array([ e['time'] for e in self.epochs ])
+
+    def regress(self, xy, sigma=None, runids=None, nproc=1):
+        """ Maps K sources through the maps of N epochs in one batch (see
+        Amap.query).
+
+        Input: xy - K x 2 array of locations, the same in every epoch, or
+                    K x N x 2 array of locations in each epoch (NaN where
+                    a source is not measured)
+               sigma - covariance matrices of the locations, K x 2 x 2 or
+                       K x N x 2 x 2
+               runids - epochs to use (default: all, in time order)
+               nproc - number of processes over which to spread epochs
+        Output: mu (K x N x 2) and sigma (K x N x 2 x 2) of the mapped
+                locations
+        """
+        if runids is None:
+            runids = self.runids
+        N = len(runids)
+
+        xy = np.asarray(xy, dtype=float)
+        if xy.ndim == 2:
+            xy = np.repeat(xy[:,None,:], N, axis=1)
+        K = len(xy)
+
+        if sigma is None:
+            sigma = np.zeros( (K, N, 2, 2) )
+        else:
+            sigma = np.asarray(sigma, dtype=float)
+            if sigma.ndim == 3:
+                sigma = np.repeat(sigma[:,None], N, axis=1)
+
+        if xy.shape != (K, N, 2) or sigma.shape != (K, N, 2, 2):
+            raise ValueError('Locations and covariances do not match the number of epochs')
+
+        if nproc > 1 and N > 1:
+            from multiprocessing import Pool
+            tasks = [ (self.path(r), xy[:,j], sigma[:,j]) for j, r in enumerate(runids) ]
+            pool = Pool(nproc)
+            try:
+                out = pool.map(_regress_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            # Maps already opened by the store are reused
+            out = [ _regress_epoch(self[r], xy[:,j], sigma[:,j]) for j, r in enumerate(runids) ]
+
+        mu = np.stack([ o[0] for o in out ], axis=1) if N else np.zeros( (K, 0, 2) )
+        S = np.stack([ o[1] for o in out ], axis=1) if N else np.zeros( (K, 0, 2, 2) )
+
+        return mu, S
+
+CATALOGUE_VERSION = 1
+
+def _cell_name(i, j):
+    return 'cell_%d_%d.npy' % (i, j)
+
+def _dedupe(data, key):
+    """ Rows of data with distinct values of the key columns, keeping the
+    first of each.
+    """
+    order = np.lexsort([ data[k] for k in reversed(key) ])
+    s = data[order]
+    new = np.ones(len(s), dtype=bool)
+    if len(s) > 1:
+        same = np.ones(len(s) - 1, dtype=bool)
+        for k in key:
+            same &= s[k][1:] == s[k][:-1]
+        new[1:] = ~same
+
+    return data[np.sort(order[new])]
+
+def _covered(rect, regions):
+    """ Whether the rectangle (ramin, ramax, decmin, decmax) lies within
+    the union of the given rectangles. The rectangle is split at every
+    edge of the regions, and each piece checked.
+    """
+    ramin, ramax, decmin, decmax = rect
+    xs = sorted(set([ramin, ramax] + [ x for r in regions for x in r[0:2] if ramin < x < ramax ]))
+    ys = sorted(set([decmin, decmax] + [ y for r in regions for y in r[2:4] if decmin < y < decmax ]))
+    for x0, x1 in zip(xs[:-1], xs[1:]):
+        for y0, y1 in zip(ys[:-1], ys[1:]):
+            x, y = 0.5*(x0 + x1), 0.5*(y0 + y1)
+            if not any(r[0] <= x <= r[1] and r[2] <= y <= r[3] for r in regions):
+                return False
+
+    return True
+
+def _unwrap(region):
+    """ A region (ramin, ramax, decmin, decmax) as rectangles within
+    0 <= ra <= 360 (two, if it lies across ra = 0).
+    """
+    ramin, ramax, decmin, decmax = map(float, region)
+    if ramax - ramin >= 360.:
+        return [ (0., 360., decmin, decmax) ]
+    ramin, ramax = ramin % 360., ramax % 360.
+    if ramin <= ramax:
+        return [ (ramin, ramax, decmin, decmax) ]
+    return [ (ramin, 360., decmin, decmax), (0., ramax, decmin, decmax) ]
+
+class Catstore(object):
+    """ A local catalogue of objects on the sky, held as columnar arrays
+    in a directory, for answering rectangle and cone selections without
+    querying a remote server.
+
+    Rows are partitioned into cells of a grid in (ra, dec) of cellsize
+    degrees, one .npy file (memory-mapped when read) per cell, sorted by
+    dec within each cell. The index, index.json, records the columns,
+    the cells, and the regions of sky whose objects have been added
+    (optionally tagged, e.g. by the selection used), so that callers can
+    tell whether a selection can be answered locally.
+    """
+
+    def __init__(self, root, ra='ra', dec='dec', key=None, cellsize=0.25, meta=None):
+        """ Opens the store in directory root, creating it if needed.
+
+        Input: ra, dec - names of the position columns (degrees) used to
+                         place and select rows
+               key - names of columns identifying a row; rows added again
+                     (e.g. from overlapping regions) are kept once
+               cellsize - size of the grid cells (degrees)
+               meta - further information kept with a new store
+        Settings of an existing store are read from its index.
+        """
+        self.root = root
+        self._cells = {}
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        fname = os.path.join(root, 'index.json')
+        if os.path.exists(fname):
+            with open(fname) as f:
+                index = json.load(f)
+            if index.get('version') != CATALOGUE_VERSION:
+                raise ValueError('Unsupported catalogue store version %s' % index.get('version'))
+        else:
+            index = {'ra': ra, 'dec': dec, 'key': key, 'cellsize': cellsize,
+                     'meta': meta or {}, 'dtype': None, 'cells': {}, 'regions': []}
+
+        self.ra = index['ra']
+        self.dec = index['dec']
+        self.key = index['key']
+        self.cellsize = index['cellsize']
+        self.meta = index['meta']
+        self.dtype = None if index['dtype'] is None else \
+                     np.dtype([ tuple(d) for d in index['dtype'] ])
+        self.cells = index['cells']
+        self.regions = index['regions']
+
+        return
+
+    def _write_index(self):
+        fname = os.path.join(self.root, 'index.json')
+        dtype = None if self.dtype is None else \
+                [ (n, self.dtype[n].str) for n in self.dtype.names ]
+        with open(fname + '.tmp', 'w') as f:
+            json.dump({'version': CATALOGUE_VERSION, 'ra': self.ra, 'dec': self.dec,
+                       'key': self.key, 'cellsize': self.cellsize, 'meta': self.meta,
+                       'dtype': dtype, 'cells': self.cells, 'regions': self.regions}, f, indent=1)
+        os.rename(fname + '.tmp', fname)
+
+    def _cell_index(self, ra, dec):
+        """ Grid cell (i in ra, j in dec) of positions. """
+        i = np.floor(np.mod(ra, 360.) / self.cellsize).astype(int)
+        j = np.floor((np.asarray(dec) + 90.) / self.cellsize).astype(int)
+        return i, j
+
+    def _cell(self, name):
+        """ The rows of a cell, memory-mapped. """
+        if name not in self._cells:
+            self._cells[name] = np.load(os.path.join(self.root, name), mmap_mode='r')
+        return self._cells[name]
+
+    def __len__(self):
+        return sum(self.cells.values())
+
+    def add(self, data, region=None, tag=None):
+        """ Adds rows (a record or structured array with the columns of the
+        store) to the store, recording that they are all the objects of
+        the given region (ramin, ramax, decmin, decmax) in degrees, if
+        known, with an optional tag (e.g. a description of the selection).
+        """
+        data = np.asarray(data)
+        if len(data) == 0:
+            # Nothing to store, but the region is known to be empty; the
+            #  columns of the store are not taken from an empty add, whose
+            #  types may not be those of the catalogue
+            if region is not None:
+                self.regions += [ list(r) + [tag] for r in _unwrap(region) ]
+                self._write_index()
+            return
+
+        if self.dtype is None:
+            self.dtype = data.dtype
+        elif data.dtype != self.dtype:
+            if data.dtype.names != self.dtype.names:
+                raise ValueError('Columns %s do not match those of the store, %s'
+                                 % (data.dtype.names, self.dtype.names))
+            lossy = [ n for n in self.dtype.names
+                      if not np.can_cast(data.dtype[n], self.dtype[n], casting='safe') ]
+            if lossy:
+                raise ValueError('Columns %s cannot be stored without loss as %s'
+                                 % (lossy, [ self.dtype[n].str for n in lossy ]))
+            data = data.astype(self.dtype)
+
+        i, j = self._cell_index(data[self.ra], data[self.dec])
+        order = np.lexsort([ j, i ])
+        i, j, data = i[order], j[order], data[order]
+        first = np.nonzero(np.r_[True, (i[1:] != i[:-1]) | (j[1:] != j[:-1])])[0]
+        last = np.r_[first[1:], len(data)]
+
+        for a, b in zip(first, last):
+            name = _cell_name(i[a], j[a])
+            rows = data[a:b]
+            path = os.path.join(self.root, name)
+            if name in self.cells:
+                rows = np.concatenate([ np.load(path), rows ])
+                if self.key:
+                    rows = _dedupe(rows, self.key)
+            rows = rows[np.argsort(rows[self.dec], kind='mergesort')]
+
+            self._cells.pop(name, None)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, rows)
+            os.rename(path + '.tmp', path)
+            self.cells[name] = len(rows)
+
+        if region is not None:
+            self.regions += [ list(r) + [tag] for r in _unwrap(region) ]
+        self._write_index()
+
+    def covers(self, region, tag=None):
+        """ Whether the objects of a region (ramin, ramax, decmin, decmax)
+        have all been added to the store, by regions with the given tag.
+        """
+        regions = [ r[0:4] for r in self.regions if r[4] == tag ]
+        return all(_covered(r, regions) for r in _unwrap(region))
+
+    def _rect(self, ramin, ramax, decmin, decmax):
+        """ Rows within a rectangle, for 0 <= ramin <= ramax <= 360. """
+        i0, j0 = self._cell_index(ramin, decmin)
+        i1, j1 = self._cell_index(ramax, decmax)
+        if ramax >= 360.:
+            i1 = int(np.floor(360. / self.cellsize))
+
+        out = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                name = _cell_name(i, j)
+                if name not in self.cells:
+                    continue
+                rows = self._cell(name)
+                dec = rows[self.dec]
+                rows = rows[np.searchsorted(dec, decmin, side='left'):
+                            np.searchsorted(dec, decmax, side='right')]
+                ra = rows[self.ra] % 360.
+                out.append(np.array(rows[(ra >= ramin) & (ra <= ramax)]))
+
+        return out
+
+    def rect(self, ramin, ramax, decmin, decmax):
+        """ Rows within a rectangle in (ra, dec) (degrees; for a rectangle
+        across ra = 0, ramin > ramax), as a record array.
+        """
+        if self.dtype is None:
+            return np.zeros(0).view(np.recarray)
+
+        out = []
+        for r in _unwrap((ramin, ramax, decmin, decmax)):
+            out += self._rect(*r)
+
+        if not out:
+            return np.zeros(0, dtype=self.dtype).view(np.recarray)
+        return np.concatenate(out).view(np.recarray)
+
+    def cone(self, ra, dec, radius):
+        """ Rows within radius (degrees) of (ra, dec), as a record array. """
+        decmin, decmax = max(dec - radius, -90.), min(dec + radius, 90.)
+        if decmin == -90. or decmax == 90. or radius >= 90.:
+            dra = 180.
+        else:
+            # Widest extent in ra of the cone
+            dra = np.degrees(np.arcsin(min(np.sin(np.radians(radius)) /
+                                           np.cos(np.radians(dec)), 1.)))
+        rows = self.rect(ra - dra, ra + dra, decmin, decmax)
+
+        r1, d1 = np.radians(rows[self.ra]), np.radians(rows[self.dec])
+        r0, d0 = np.radians(ra), np.radians(dec)
+        x = np.sin(0.5*(d1 - d0))**2 + np.cos(d0)*np.cos(d1)*np.sin(0.5*(r1 - r0))**2
+        d = np.degrees(2.*np.arcsin(np.sqrt(np.minimum(x, 1.))))
+
+        return rows[d <= radius]
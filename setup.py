@@ -1,4 +1,7 @@
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 setup(
     name='pyBA',
@@ -7,6 +10,9 @@ setup(
     author_email='berian@berkeley.edu',
     packages=['pyBA'],
     scripts=[],
+    entry_points={
+        'console_scripts': ['pybast = pyBA.cli:main'],
+    },
     url='http://pypi.python.org/pypi/pyBA/',
     license='LICENSE.txt',
     description='Python implementation of Bayesian Astrometry framework.',
@@ -0,0 +1,26 @@
+import numpy as np
+
+from pyBA.background import MAP
+
+
+def _ties(n, rng, sd=0.05):
+    T = np.zeros((n, 10))
+    T[:,5:7] = rng.uniform(-500., 500., (n, 2))
+    c, s = np.cos(0.01), np.sin(0.01)
+    T[:,0:2] = 1.001 * T[:,5:7].dot([[c, s], [-s, c]]) + [3., -2.]
+    T[:,0:2] += rng.normal(0., sd, (n, 2))
+    T[:,[2,3,7,8]] = sd**2
+    return T
+
+def test_coarse_to_fine_finishes_on_full_set():
+    T = _ties(20000, np.random.RandomState(2))
+    np.random.seed(3)
+    ctf = MAP(T, None, nstart=500)
+    full = MAP(T, None, mu0=ctf.mu)
+
+    # Scales, with the Laplace uncertainties of the full set
+    #  rather than of a subset
+    i = [5, 6]
+    sd = np.sqrt(np.diag(full.sigma))[i]
+    assert np.allclose(np.sqrt(np.diag(ctf.sigma))[i], sd, rtol=0.05)
+    assert np.all(np.abs(ctf.mu[i] - full.mu[i]) < 0.1 * sd)
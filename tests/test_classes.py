@@ -0,0 +1,117 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from pyBA.classes import Amap, Bgmap, Surrogate, _transform
+from pyBA.parse import objects_from_ties
+
+
+def _map(n=40, seed=0):
+    """ Map of ties with a smooth distortion. """
+    rng = np.random.RandomState(seed)
+    T = np.zeros((n, 10))
+    T[:,0:2] = rng.uniform(0., 100., (n, 2))
+    T[:,5] = T[:,0] + 1. + 0.3 * np.sin(T[:,1] / 20.)
+    T[:,6] = T[:,1] - 1. + 0.3 * np.cos(T[:,0] / 20.)
+    T[:,[2,3,7,8]] = 1e-4
+    A, B = objects_from_ties(T)
+
+    P = Bgmap(mu=np.array([1., -1., 0., 0., 0., 1., 1.]), sigma=1e-8 * np.eye(7))
+    D = Amap(P, A, B)
+    D.build_covariance(scale=500., amp=0.1)
+    return D
+
+def test_surrogate_without_uncertainty():
+    D = _map()
+    full = D.to_surrogate(res=25, ncheck=0)
+    mean = D.to_surrogate(res=25, ncheck=20, uncertainty=False)
+    assert len(mean.tables) == 2
+
+    xy = np.random.RandomState(1).uniform(0., 100., (50, 2))
+    xy = np.clip(xy, [full.bounds[0], full.bounds[2]], [full.bounds[1], full.bounds[3]])
+    assert np.allclose(mean.mean(xy), full.mean(xy))
+    assert mean.errors['mu'] < 1e-3
+    with pytest.raises(ValueError):
+        mean.query(xy)
+
+def test_surrogate_warns_of_coarse_grid():
+    D = _map()
+    with pytest.warns(UserWarning, match='interpolation error'):
+        D.to_surrogate(res=5, seed=2)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        D.to_surrogate(res=40, seed=2)
+    assert not [ w for w in caught if 'interpolation error' in str(w.message) ]
+
+def test_surrogate_checks_are_seeded_and_saved(tmpdir):
+    D = _map()
+    S = D.to_surrogate(res=25, seed=3)
+    assert D.to_surrogate(res=25, seed=np.random.RandomState(3)).errors == S.errors
+
+    fname = str(tmpdir.join('surrogate.npz'))
+    S.save(fname)
+    T = Surrogate.load(fname)
+    assert T.errors == S.errors
+    xy = np.random.RandomState(1).uniform(10., 90., (20, 2))
+    for a, b in zip(S.query(xy), T.query(xy)):
+        assert np.allclose(a, b)
+
+def _mapped(P, xy):
+    return _transform(xy, None, P)[0]
+
+def test_compose_applies_both_mappings():
+    P = Bgmap(mu=np.array([2., -1., 0.1, 5., 5., 1.01, 1.01]), sigma=1e-6 * np.eye(7))
+    Q = Bgmap(mu=np.array([-3., 4., -0.2, 0., 10., 0.98, 0.98]), sigma=1e-6 * np.eye(7))
+    xy = np.random.RandomState(3).uniform(-100., 100., (20, 2))
+
+    PQ = P.compose(Q)
+    assert np.allclose(_mapped(PQ, xy), _mapped(Q, _mapped(P, xy)))
+    assert np.all(np.linalg.eigvalsh(PQ.sigma) > -1e-12)
+
+def test_bgmap_arrays_are_read_only():
+    sigma = np.eye(7)
+    P = Bgmap(mu=np.zeros(7), sigma=sigma)
+    p = np.ones(7)
+    assert P.llik(p) == -3.5
+
+    sigma[0,0] = 0.5
+    assert P.llik(p) == -3.5
+    with pytest.raises(ValueError):
+        P.sigma[0,0] = 0.5
+    with pytest.raises(ValueError):
+        P.mu[0] = 1.
+
+    P.sigma = sigma
+    assert P.llik(p) == -4.
+
+def test_compose_keeps_finite_covariance_of_unconstrained_mappings():
+    P = Bgmap(mu=np.array([2., -1., 0.1, 5., 5., 1.01, 1.01]), sigma=1e-6 * np.eye(7))
+    sigma = 1e-6 * np.eye(7)
+    sigma[2,2] = np.inf
+    Q = Bgmap(mu=np.array([-3., 4., -0.2, 0., 10., 0.98, 0.98]), sigma=sigma)
+
+    S = P.compose(Q).sigma
+    assert not np.any(np.isnan(S))
+    assert S[2,2] == np.inf and np.all(S[2,[0,1,3,4,5,6]] == 0.)
+
+    # The scalings do not depend on the rotation of Q
+    sigma[2,2] = 0.
+    expected = P.compose(Bgmap(mu=Q.mu, sigma=sigma)).sigma
+    assert np.all(np.isfinite(S[5:7,5:7]))
+    assert np.allclose(S[5:7,5:7], expected[5:7,5:7])
+
+@pytest.mark.parametrize('theta, L', [ (0.1, [1.01, 1.01]), (0., [1.01, 0.97]) ])
+def test_inverse_undoes_mapping(theta, L):
+    # Isotropic scaling, or no rotation: the inverse is exact
+    P = Bgmap(mu=np.array([2., -1., theta, 5., 5.] + L), sigma=1e-6 * np.eye(7))
+    xy = np.random.RandomState(4).uniform(-100., 100., (20, 2))
+
+    Pinv = P.inverse()
+    assert np.allclose(_mapped(Pinv, _mapped(P, xy)), xy)
+    assert np.allclose(_mapped(Pinv.inverse(), xy), _mapped(P, xy))
+
+    # The composition with the inverse is the identity
+    I = P.compose(Pinv)
+    assert np.allclose(_mapped(I, xy), xy)
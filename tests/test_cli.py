@@ -0,0 +1,53 @@
+import os
+import json
+
+import numpy as np
+
+from pyBA import cli
+from pyBA.parse import TIE_COLUMNS, write_match
+
+
+def _match_file(fname, n=40, seed=0):
+    rng = np.random.RandomState(seed)
+    data = np.zeros(n, dtype=[ (c, float) for c in TIE_COLUMNS ])
+    for c in ('xB', 'yB'):
+        data[c] = rng.uniform(-100., 100., n)
+    data['xA'] = data['xB'] + 1. + rng.normal(0., 0.1, n)
+    data['yA'] = data['yB'] - 2. + rng.normal(0., 0.1, n)
+    for c in ('sxxA', 'syyA', 'sxxB', 'syyB'):
+        data[c] = 0.01
+    write_match(fname, [], data)
+
+def test_fit_resumes_from_manifest(tmpdir, capsys):
+    _match_file(str(tmpdir.join('a.dat')), seed=1)
+    _match_file(str(tmpdir.join('b.dat')), seed=2)
+    out = str(tmpdir.join('maps'))
+
+    with tmpdir.as_cwd():
+        assert cli.main(['fit', '.', '-o', 'maps']) == 0
+    with open(os.path.join(out, 'manifest.json')) as f:
+        jobs = json.load(f)['jobs']
+    assert sorted(os.path.basename(k) for k in jobs) == ['a.dat', 'b.dat']
+    assert all(job['status'] == 'done' for job in jobs.values())
+    capsys.readouterr()
+
+    # From another directory: done inputs are skipped, changed ones refitted
+    _match_file(str(tmpdir.join('b.dat')), seed=3)
+    assert cli.main(['fit', str(tmpdir), '-o', out]) == 0
+    printed = capsys.readouterr().out
+    assert 'skipping %s' % tmpdir.join('a.dat') in printed
+    assert 'fitted %s' % tmpdir.join('b.dat') in printed
+    assert printed.count('fitted') == 1
+
+    assert cli.main(['summarise', out]) == 0
+    assert capsys.readouterr().out.count(out) == 2
+
+def test_fit_rejects_clashing_outputs(tmpdir, capsys):
+    _match_file(str(tmpdir.mkdir('d1').join('x.dat')))
+    _match_file(str(tmpdir.mkdir('d2').join('x.dat')))
+    out = str(tmpdir.join('maps'))
+
+    assert cli.main(['fit', str(tmpdir.join('d1')), str(tmpdir.join('d2')),
+                     '-o', out]) == 1
+    assert 'x.map' in capsys.readouterr().err
+    assert not os.path.exists(os.path.join(out, 'manifest.json'))
@@ -0,0 +1,68 @@
+import numpy as np
+
+from pyBA.classes import Bgmap, _transform
+from pyBA.crossmatch import _assign, match, register
+
+
+def _catalogue(n, rng, sd=0.01):
+    C = np.zeros((n, 5))
+    C[:,0:2] = rng.uniform(0., 100., (n, 2))
+    C[:,2] = C[:,3] = sd**2
+    return C
+
+def test_assign_takes_mutual_best_pairs():
+    # a0-b0 is taken first; a1-b1 is then the best remaining pair
+    iA, iB = _assign(np.array([0, 0, 1, 1]), np.array([0, 1, 1, 2]),
+                     np.array([.1, .2, .3, .4]))
+    assert list(zip(iA, iB)) == [(0, 0), (1, 1)]
+
+def test_assign_matches_greedy():
+    rng = np.random.RandomState(1)
+    iA = rng.randint(0, 20, 200)
+    iB = rng.randint(0, 20, 200)
+    d = rng.uniform(size=200)
+
+    usedA, usedB, greedy = set(), set(), []
+    for k in np.argsort(d, kind='stable'):
+        if iA[k] not in usedA and iB[k] not in usedB:
+            usedA.add(iA[k])
+            usedB.add(iB[k])
+            greedy.append((iA[k], iB[k]))
+
+    assert sorted(zip(*_assign(iA, iB, d))) == sorted(greedy)
+
+def test_match_recovers_shuffled_catalogue():
+    rng = np.random.RandomState(2)
+    A = _catalogue(2000, rng)
+    order = rng.permutation(len(A))
+    B = A[order].copy()
+    B[:,0:2] += rng.normal(0., 0.01, (len(B), 2)) + [1., -2.]
+
+    P = Bgmap(mu=np.array([-1., 2., 0., 0., 0., 1., 1.]))
+    T, iA, iB = match(A, B, P, nproc=2, chunksize=500, return_index=True)
+
+    assert len(T) > 0.99 * len(A)
+    assert np.all(iA == order[iB])
+    assert np.allclose(T[:,0:5], A[iA]) and np.allclose(T[:,5:10], B[iB])
+
+def test_register_recovers_rotation_and_scale():
+    rng = np.random.RandomState(0)
+    A = _catalogue(500, rng)
+    A[:,0:2] *= 10.
+    mag = rng.uniform(15., 22., len(A))
+
+    # B is A rotated, scaled, shifted and shuffled, with noisy magnitudes
+    theta, scale = 0.3, 1.05
+    U = np.array([ [np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)] ])
+    order = rng.permutation(len(A))
+    B = A[order].copy()
+    B[:,0:2] = scale * B[:,0:2].dot(U.T) + [50., -20.] + rng.normal(0., 0.01, (len(A), 2))
+
+    P, T = register(A, B, rankA=mag, rankB=mag[order] + rng.normal(0., 0.1, len(A)))
+    assert np.isclose(P.mu[2], -theta, atol=1e-4)
+    assert np.allclose(P.mu[5:7], 1. / scale, rtol=1e-4)
+
+    # Every object tied, to its counterpart
+    assert len(T) == len(A)
+    mapped, _ = _transform(T[:,5:7], None, P)
+    assert np.abs(mapped - T[:,0:2]).max() < 0.1
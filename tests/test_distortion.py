@@ -0,0 +1,45 @@
+import numpy as np
+
+from pyBA.classes import Amap, Bgmap, _transform
+from pyBA.distortion import astrometry_inverse
+from pyBA.parse import objects_from_ties
+
+
+def _map(n=60, seed=0):
+    """ Conditioned map of ties with a smooth distortion. """
+    rng = np.random.RandomState(seed)
+    T = np.zeros((n, 10))
+    T[:,0:2] = rng.uniform(0., 100., (n, 2))
+    T[:,5] = T[:,0] + 2. + 0.5 * np.sin(T[:,1] / 30.)
+    T[:,6] = T[:,1] - 1. + 0.5 * np.cos(T[:,0] / 30.)
+    T[:,[2,3,7,8]] = 1e-4
+    A, B = objects_from_ties(T)
+
+    P = Bgmap(mu=np.array([2., -1., 0., 0., 0., 1., 1.]), sigma=1e-8 * np.eye(7))
+    D = Amap(P, A, B)
+    D.build_covariance(scale=1000., amp=0.25)
+    return D
+
+def test_inverse_of_background_mapping():
+    P = Bgmap(mu=np.array([2., -1., 0.1, 50., 50., 1.01, 0.99]))
+    xy = np.random.RandomState(1).uniform(0., 100., (20, 2))
+    mu, _ = _transform(xy, None, P)
+    back, _ = astrometry_inverse(mu, P)
+    assert np.allclose(back, xy)
+
+def test_inverse_of_amap():
+    D = _map()
+    xy = np.random.RandomState(2).uniform(10., 90., (20, 2))
+    back, S = astrometry_inverse(D.query(xy)[0], D)
+    assert np.allclose(back, xy, atol=1e-6)
+    assert np.all(np.linalg.eigvalsh(S) > 0)
+
+def test_inverse_of_surrogate_at_corners():
+    D = _map()
+    Sg = D.to_surrogate(res=20, ncheck=0)
+    x0, x1, y0, y1 = Sg.bounds
+    xy = np.array([ [x0, y0], [x0, y1], [x1, y0], [x1, y1], [50., 50.] ])
+
+    back, S = astrometry_inverse(Sg.mean(xy), Sg)
+    assert np.allclose(back, xy, atol=1e-5)
+    assert np.all(np.isfinite(S))
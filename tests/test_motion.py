@@ -0,0 +1,42 @@
+import numpy as np
+
+from pyBA.motion import proper_motion
+
+
+def _tracks(K, t, rng, sd=0.01):
+    x0 = rng.uniform(-100., 100., (K, 2))
+    v = rng.normal(0., 1e-3, (K, 2))
+    xy = x0[:,None,:] + v[:,None,:] * (t - t.mean())[None,:,None]
+    xy += rng.normal(0., sd, xy.shape)
+    sigma = np.tile(sd**2 * np.eye(2), (K, len(t), 1, 1))
+    return x0, v, xy, sigma
+
+def test_proper_motion_recovers_tracks():
+    rng = np.random.RandomState(0)
+    t = np.sort(rng.uniform(0., 3000., 12))
+    x0, v, xy, sigma = _tracks(200, t, rng)
+
+    x, vfit, cov, chi2, ndof, flags = proper_motion(t, xy, sigma)
+    assert np.all(ndof == 20) and not np.any(flags)
+    sd_v = np.sqrt(np.diagonal(cov[:,2:4,2:4], axis1=1, axis2=2))
+    assert np.mean(np.abs(vfit - v) / sd_v < 3.) > 0.99
+    assert np.allclose(x, x0, atol=0.05)
+    assert 0.8 < np.mean(chi2 / ndof) < 1.2
+
+def test_proper_motion_rejects_outliers_and_missing_epochs():
+    rng = np.random.RandomState(1)
+    t = np.linspace(0., 3000., 10)
+    x0, v, xy, sigma = _tracks(4, t, rng)
+
+    xy[0,4] += 1.          # an outlying epoch
+    xy[1,2:] = np.nan      # measured at only two epochs
+    xy[2,:] = np.nan       # never measured
+    xy[3,1:] = np.nan      # measured once
+
+    x, vfit, cov, chi2, ndof, flags = proper_motion(t, xy, sigma)
+    assert flags[0,4] and flags.sum() == 1
+    assert np.allclose(vfit[0], v[0], atol=1e-4)
+    assert ndof[1] == 0 and np.all(np.isfinite(vfit[1]))
+    assert np.all(np.isnan(vfit[2:])) and np.all(np.isnan(x[2:]))
+    assert np.all(ndof[2:] == 0) and np.all(np.isnan(chi2[2:]))
+    assert np.all(np.isfinite(chi2[0:2]))
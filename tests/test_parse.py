@@ -0,0 +1,161 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from pyBA import parse
+from pyBA.classes import Amap, Bgmap
+from pyBA.parse import (TIE_COLUMNS, objects_from_ties, read_map, read_match,
+                        write_map, write_match)
+
+
+def _match_file(fname, n=20):
+    data = np.zeros(n, dtype=[ (c, float) for c in TIE_COLUMNS ])
+    data['xA'] = np.arange(n)
+    data['yB'] = -np.arange(n)
+    write_match(fname, [('observation time (day)', 736.9)], data)
+    return data
+
+def test_read_match_types_columns_from_every_row(tmpdir):
+    fname = tmpdir.join('m.csv')
+    fname.write('objid,mag\n8647475119823389164,22\n8647475119823389165,22.5\n')
+    header, data = read_match(str(fname), cache=False)
+
+    assert data['objid'].dtype == np.int64
+    assert data['objid'][1] == 8647475119823389165
+    assert data['mag'].dtype == np.float64
+    assert list(data['mag']) == [22., 22.5]
+
+    with open(str(fname)) as f:
+        header, same = read_match(f)
+    assert np.all(same == data)
+
+def test_write_match_leaves_complete_file_on_failure(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('m.dat'))
+    data = _match_file(fname)
+
+    def fail(*args, **kwargs):
+        raise IOError('disk full')
+    monkeypatch.setattr(np, 'savetxt', fail)
+    with pytest.raises(IOError):
+        write_match(fname, {}, data[:5])
+
+    header, first = read_match(fname, cache=False)
+    assert len(first) == len(data)
+    assert header['observation time (day)'] == 736.9
+
+def _cached_source(fname):
+    with np.load(fname + '.cache.npz') as f:
+        return json.loads(str(f['source']))
+
+@pytest.fixture
+def no_parsing(monkeypatch):
+    """ Fails any read_match that parses the text rather than the cache. """
+    def fail(lines):
+        raise AssertionError('match file parsed again')
+    return lambda: monkeypatch.setattr(parse, '_parse_match', fail)
+
+def test_read_match_uses_cache(tmpdir, no_parsing):
+    fname = str(tmpdir.join('m.dat'))
+    data = _match_file(fname)
+    header, first = read_match(fname)
+    assert header['observation time (day)'] == 736.9
+    assert np.all(first['xA'] == data['xA'])
+
+    no_parsing()
+    header, second = read_match(fname)
+    assert np.all(second == first)
+
+def test_read_match_cache_survives_touch(tmpdir, no_parsing):
+    fname = str(tmpdir.join('m.dat'))
+    _match_file(fname)
+    read_match(fname)
+
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 10.))
+    no_parsing()
+    read_match(fname)
+    assert _cached_source(fname)['mtime'] == os.stat(fname).st_mtime
+
+def test_read_match_reparses_changed_file(tmpdir):
+    fname = str(tmpdir.join('m.dat'))
+    _match_file(fname)
+    read_match(fname)
+
+    data = _match_file(fname, n=30)
+    assert np.all(read_match(fname)[1]['xA'] == data['xA'])
+
+def test_read_match_replaces_cache_of_other_version(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('m.dat'))
+    _match_file(fname)
+    monkeypatch.setattr(parse, 'MATCH_CACHE_VERSION', 0)
+    read_match(fname)
+    monkeypatch.undo()
+
+    read_match(fname)
+    assert _cached_source(fname)['version'] == parse.MATCH_CACHE_VERSION
+
+def _map(n=30, seed=0):
+    rng = np.random.RandomState(seed)
+    T = np.zeros((n, 10))
+    T[:,0:2] = rng.uniform(0., 100., (n, 2))
+    T[:,5:7] = T[:,0:2] + [1., -1.] + rng.normal(0., 0.1, (n, 2))
+    T[:,[2,3,7,8]] = 0.01
+    A, B = objects_from_ties(T)
+    P = Bgmap(mu=np.array([1., -1., 0., 0., 0., 1., 1.]), sigma=1e-6 * np.eye(7))
+    D = Amap(P, A, B)
+    D.build_covariance(scale=1000., amp=0.01)
+    return D
+
+def test_read_map_answers_queries_as_written(tmpdir):
+    D = _map()
+    path = str(tmpdir.join('map'))
+    write_map(path, D)
+    E = read_map(path)
+
+    xy = np.random.RandomState(1).uniform(0., 100., (10, 2))
+    for a, b in zip(D.query(xy), E.query(xy)):
+        assert np.allclose(a, b)
+
+    # Only the triangle of the factor in use is kept
+    c, lower = E.chol
+    assert np.all((np.triu(c, 1) if lower else np.tril(c, -1)) == 0.)
+
+def test_write_map_replaces_map_whole(tmpdir, monkeypatch):
+    D = _map()
+    path = str(tmpdir.join('map'))
+    write_map(path, D)
+
+    # An interrupted rewrite leaves the map as it was
+    save = np.save
+    def fail(fname, arr):
+        if fname.endswith('P_mu.npy'):
+            raise IOError('disk full')
+        save(fname, arr)
+    monkeypatch.setattr(np, 'save', fail)
+    with pytest.raises(IOError):
+        write_map(path, D)
+    monkeypatch.undo()
+    assert sorted(os.listdir(path)) == sorted(['ties.npy', 'alpha.npy', 'chol.npy', 'P_mu.npy',
+                                               'P_sigma.npy', 'header.json'])
+
+    xy = np.random.RandomState(1).uniform(0., 100., (10, 2))
+    write_map(path, D)
+    assert not os.path.exists(path + '.tmp')
+    for a, b in zip(D.query(xy), read_map(path).query(xy)):
+        assert np.allclose(a, b)
+
+def test_read_map_rebuilds_objects(tmpdir):
+    D = _map()
+    path = str(tmpdir.join('map'))
+    write_map(path, D)
+    E = read_map(path)
+    assert E.A is None
+
+    xy = np.array([ [20., 30.], [60., 70.] ])
+    assert np.allclose(E.to_surrogate(res=20, ncheck=0).mean(xy),
+                       D.to_surrogate(res=20, ncheck=0).mean(xy))
+    E.build_covariance(scale=800.)
+    assert len(E.A) == len(D.A) and E.d2.shape == D.d2.shape
+    assert np.all(np.isfinite(E.query(xy)[0]))
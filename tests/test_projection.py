@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from pyBA.projection import gnomonic, gnomonic_inverse, jacobian
+
+
+@pytest.mark.parametrize('centre', [ (342.19, -0.90), (0.05, 60.), (180., -89.) ])
+def test_gnomonic_round_trip(centre):
+    rng = np.random.RandomState(0)
+    ra = (centre[0] + rng.uniform(-0.5, 0.5, 1000)) % 360.
+    dec = np.clip(centre[1] + rng.uniform(-0.5, 0.5, 1000), -90., 90.)
+    sigma = np.tile([ [1e-4, 2e-5], [2e-5, 3e-4] ], (1000, 1, 1))
+
+    xi, eta, S = gnomonic(ra, dec, centre, sigma=sigma, chunk=300)
+    ra2, dec2, sigma2 = gnomonic_inverse(xi, eta, centre, sigma=S, chunk=300)
+
+    dra = (ra2 - ra + 180.) % 360. - 180.
+    assert np.abs(dra * np.cos(np.radians(dec))).max() * 3600. < 1e-8
+    assert np.abs(dec2 - dec).max() * 3600. < 1e-8
+    assert np.allclose(sigma2, sigma)
+
+def test_gnomonic_near_tangent_point():
+    # Small offsets are local offsets, in arcsec
+    centre = (10., 30.)
+    xi, eta = gnomonic(10. + 1. / 3600. / np.cos(np.radians(30.)), 30. + 2. / 3600., centre)
+    assert np.isclose(xi, 1., rtol=1e-5) and np.isclose(eta, 2., rtol=1e-5)
+
+    assert np.allclose(jacobian(10., 30., centre), np.eye(2))
+
+def test_gnomonic_keeps_shape():
+    ra = np.full((3, 4), 10.)
+    dec = np.linspace(29., 31., 12).reshape(3, 4)
+    xi, eta = gnomonic(ra, dec, (10., 30.))
+    assert xi.shape == eta.shape == (3, 4)
+    with pytest.raises(ValueError):
+        gnomonic(ra, dec[0], (10., 30.))
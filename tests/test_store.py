@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from pyBA import parse
+from pyBA.classes import Amap, Bgmap
+from pyBA.parse import objects_from_ties
+from pyBA.store import Catstore, Mapstore
+
+
+def _map(seed):
+    rng = np.random.RandomState(seed)
+    T = np.zeros((30, 10))
+    T[:,0:2] = rng.uniform(0., 100., (30, 2))
+    T[:,5:7] = T[:,0:2] + [1., -1.] + rng.normal(0., 0.1, (30, 2))
+    T[:,[2,3,7,8]] = 0.01
+    A, B = objects_from_ties(T)
+    P = Bgmap(mu=np.array([1., -1., 0., 0., 0., 1., 1.]), sigma=1e-6 * np.eye(7))
+    D = Amap(P, A, B)
+    D.build_covariance(scale=1000., amp=0.01)
+    return D
+
+def test_regress_reuses_open_maps(tmpdir, monkeypatch):
+    store = Mapstore(str(tmpdir.join('maps')))
+    maps = [ _map(seed) for seed in range(3) ]
+    for j, D in enumerate(maps):
+        store.add(100 + j, float(j), D)
+
+    opened = []
+    read_map = parse.read_map
+    monkeypatch.setattr(parse, 'read_map', lambda path: opened.append(path) or read_map(path))
+
+    xy = np.array([ [10., 20.], [50., 50.], [np.nan, 0.] ])
+    sigma = np.tile(0.01 * np.eye(2), (3, 1, 1))
+    for i in range(2):
+        mu, S = store.regress(xy, sigma)
+    assert len(opened) == 3
+
+    for j, D in enumerate(maps):
+        expected, _ = D.query(xy[:2], sigma[:2])
+        assert np.allclose(mu[:2,j], expected)
+    assert np.all(np.isnan(mu[2])) and np.all(np.isnan(S[2]))
+
+def _objects(n, seed, ra=(0., 360.), dec=(-90., 90.)):
+    rng = np.random.RandomState(seed)
+    data = np.zeros(n, dtype=[ ('objid', np.int64), ('ra', np.float64), ('dec', np.float64) ])
+    data['objid'] = 1237650000000000000 + rng.randint(0, 2**40, n)
+    data['ra'] = rng.uniform(ra[0], ra[1], n)
+    data['dec'] = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(dec[0])),
+                                                   np.sin(np.radians(dec[1])), n)))
+    return data
+
+def _ids(rows):
+    return np.sort(np.asarray(rows['objid']))
+
+def test_catstore_selections_match_brute_force(tmpdir):
+    data = _objects(5000, 0)
+    store = Catstore(str(tmpdir.join('cat')), key=['objid'], cellsize=5.)
+    store.add(data[:2500])
+    store.add(data[2500:])
+    store = Catstore(str(tmpdir.join('cat')))
+    assert len(store) == len(data)
+
+    # A rectangle across ra = 0
+    rows = store.rect(350., 12., -20., 30.)
+    sel = ((data['ra'] >= 350.) | (data['ra'] <= 12.)) & (data['dec'] >= -20.) & (data['dec'] <= 30.)
+    assert sel.sum() > 0
+    assert np.array_equal(_ids(rows), _ids(data[sel]))
+
+    # Cones at high declination, one reaching over the pole
+    r0, d0 = np.radians(data['ra']), np.radians(data['dec'])
+    for ra, dec, radius in [ (100., 75., 10.), (200., 85., 12.), (3., -80., 8.) ]:
+        r1, d1 = np.radians(ra), np.radians(dec)
+        d = np.degrees(np.arccos(np.clip(np.sin(d0)*np.sin(d1) +
+                                         np.cos(d0)*np.cos(d1)*np.cos(r0 - r1), -1., 1.)))
+        rows = store.cone(ra, dec, radius)
+        assert (d <= radius).sum() > 0
+        assert np.array_equal(_ids(rows), _ids(data[d <= radius]))
+
+def test_catstore_covers_and_dedupes_overlapping_regions(tmpdir):
+    data = _objects(3000, 1, ra=(-10., 20.), dec=(-5., 5.))
+    data['ra'] %= 360.
+    store = Catstore(str(tmpdir.join('cat')), key=['objid'], cellsize=1.)
+
+    inside = lambda r: (((data['ra'] - r[0]) % 360. <= (r[1] - r[0]) % 360.) &
+                        (data['dec'] >= r[2]) & (data['dec'] <= r[3]))
+    regions = [ (350., 5., -5., 5.), (0., 20., -5., 5.) ]
+    for region in regions:
+        store.add(data[inside(region)], region, tag='run=1')
+
+    assert len(store) == len(data)
+    assert np.array_equal(_ids(store.rect(0., 360., -90., 90.)), _ids(data))
+
+    assert store.covers((355., 15., -4., 4.), tag='run=1')
+    assert store.covers((350., 20., -5., 5.), tag='run=1')
+    assert not store.covers((345., 15., -4., 4.), tag='run=1')
+    assert not store.covers((0., 10., -6., 0.), tag='run=1')
+    assert not store.covers((0., 10., -4., 4.))
+    assert not store.covers((0., 10., -4., 4.), tag='run=2')
+
+    store.add(data[inside((0., 10., -5., 5.))], (0., 10., -5., 5.))
+    assert store.covers((0., 10., -4., 4.))
+    assert not store.covers((0., 15., -4., 4.))
+    assert len(store) == len(data)
+
+def test_catstore_empty_adds(tmpdir):
+    store = Catstore(str(tmpdir.join('cat')), key=['objid'])
+    empty = np.zeros(0, dtype=[ ('objid', np.float64), ('ra', np.float64), ('dec', np.float64) ])
+
+    store.add(empty, (10., 20., 0., 5.), tag='run=1')
+    assert store.covers((12., 18., 1., 4.), tag='run=1')
+    assert store.dtype is None and len(store) == 0
+    assert len(store.rect(10., 20., 0., 5.)) == 0
+
+    data = _objects(100, 2, ra=(30., 40.), dec=(0., 5.))
+    store.add(data, (30., 40., 0., 5.))
+    store.add(empty, (40., 50., 0., 5.))
+    assert store.dtype == data.dtype
+    assert np.array_equal(_ids(store.cone(35., 2.5, 10.)), _ids(data))
+    assert store.covers((12., 18., 1., 4.), tag='run=1') and store.covers((30., 50., 0., 5.))
+
+    # Object IDs are not cast to floats, losing digits
+    with pytest.raises(ValueError):
+        store.add(np.zeros(1, dtype=empty.dtype))